@@ -13,7 +13,7 @@ package.domain = org.dash.electrum
 source.dir = .
 
 # (list) Source files to include (let empty to include all the files)
-source.include_exts = py,png,jpg,kv,atlas,ttf,txt,gif,pem,mo,vs,fs,json,csv,gz
+source.include_exts = py,png,jpg,kv,atlas,ttf,txt,gif,pem,mo,vs,fs,json,csv,gz,bin
 
 # (list) Source files to exclude (let empty to not exclude anything)
 source.exclude_exts = spec
@@ -25,8 +25,9 @@ import asyncio
 import threading
 import asyncio
 import itertools
+import bisect
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
+from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List, Iterator
 
 from aiorpcx import TaskGroup
 
@@ -34,7 +35,6 @@ from . import bitcoin, util
 from .bitcoin import COINBASE_MATURITY
 from .dash_ps import PSManager
 from .dash_ps_util import PSCoinRounds, PS_MIXING_TX_TYPES
-from .dash_tx import tx_header_to_tx_type
 from .util import profiler, bfh, TxMinedInfo, UnrelatedTransactionException, with_lock
 from .protx import ProTxManager
 from .transaction import Transaction, TxOutput, TxInput, PartialTxInput, TxOutpoint, PartialTransaction
@@ -105,7 +105,11 @@ class AddressSynchronizer(Logger):
         self._addrs_with_coins_cache = set()
         self._tx_deltas_cache = defaultdict(int)        # txid -> delta
         self._tx_deltas_related_txs = defaultdict(set)  # addr -> set(txids)
-        self._get_addr_balance_cache = {}
+        self._addr_balance_index = {}  # type: Dict[str, Dict[Optional[int], list]]  # see _get_addr_balance_index
+        self._addr_outputs_index = {}  # type: Dict[str, Dict[str, list]]  # see _get_addr_outputs_index
+        # history sorted by (sort key, txid), kept between get_history calls
+        self._history_order = []  # type: List[Tuple[tuple, str]]
+        self._history_sort_keys = {}  # type: Dict[str, tuple]  # txid -> sort key
 
         self.load_and_cleanup()
 
@@ -125,6 +129,10 @@ class AddressSynchronizer(Logger):
         self.psman.load_and_cleanup()
         self.protx_manager.load()
 
+    def remove_unreferenced_txs(self):
+        with self.lock, self.transaction_lock:
+            self.db.remove_unreferenced_txs()
+
     def is_mine(self, address: Optional[str]) -> bool:
         if not address: return False
         return self.db.is_addr_in_history(address)
@@ -207,7 +215,6 @@ class AddressSynchronizer(Logger):
             util.register_callback(self.on_dash_islock, ['dash-islock'])
 
     def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
         self.db.process_and_clear_islocks(self.get_local_height())
 
     def on_dash_islock(self, event, txid):
@@ -220,7 +227,7 @@ class AddressSynchronizer(Logger):
             dash_net = self.network.dash_net
             if dash_net.verify_on_recent_islocks(txid):
                 self.db.add_islock(txid)
-                self._get_addr_balance_cache = {}  # invalidate cache
+                self.invalidate_tx_balances(txid)
                 self.save_db()
                 util.trigger_callback('verified-islock', self, txid)
 
@@ -233,7 +240,7 @@ class AddressSynchronizer(Logger):
             dash_net = self.network.dash_net
             if dash_net.verify_on_recent_islocks(txid):
                 self.db.add_islock(txid)
-                self._get_addr_balance_cache = {}  # invalidate cache
+                self.invalidate_tx_balances(txid)
                 self.save_db()
                 util.trigger_callback('verified-islock', self, txid)
 
@@ -359,7 +366,8 @@ class AddressSynchronizer(Logger):
                         pass
                     else:
                         self.db.add_txi_addr(tx_hash, addr, ser, v)
-                        self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                        self._addr_balance_index.pop(addr, None)  # invalidate cache
+                        self._addr_outputs_index.pop(addr, None)
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
                     continue
@@ -377,7 +385,8 @@ class AddressSynchronizer(Logger):
                 addr = txo.address
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                    self._addr_balance_index.pop(addr, None)  # invalidate cache
+                    self._addr_outputs_index.pop(addr, None)
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
@@ -395,6 +404,8 @@ class AddressSynchronizer(Logger):
                 self.psman._add_tx_ps_data(tx_hash, tx)
             if is_new_tx and not self.is_local_tx(tx_hash):
                 util.trigger_callback('new_transaction', self, tx)
+            if self.synchronizer:
+                self.synchronizer.wakeup()  # more addresses might be needed
             return True
 
     def remove_transaction(self, tx_hash: str) -> None:
@@ -436,7 +447,8 @@ class AddressSynchronizer(Logger):
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
             for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+                self._addr_balance_index.pop(addr, None)  # invalidate cache
+                self._addr_outputs_index.pop(addr, None)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
@@ -466,7 +478,8 @@ class AddressSynchronizer(Logger):
         self.add_transaction(tx, allow_unrelated=True)
         self.find_islock_pair(tx_hash)
 
-    def receive_history_callback(self, addr: str, hist, tx_fees: Dict[str, int]):
+    def receive_history_callback(self, addr: str, hist, tx_fees: Dict[str, int], *,
+                                 status: Optional[str] = None):
         old_hist_hashes = set()
         with self.lock:
             old_hist = self.get_address_history(addr)
@@ -479,7 +492,7 @@ class AddressSynchronizer(Logger):
                     self.db.remove_verified_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
-            self.db.set_addr_history(addr, hist)
+            self.db.set_addr_history(addr, hist, status=status)
 
         local_tx_hist_hashes = list()
         for tx_hash, tx_height in hist:
@@ -574,14 +587,13 @@ class AddressSynchronizer(Logger):
             self.update_tx_deltas_cache_on_tx(rtxid, None, is_added=True)
 
     def is_addr_with_coins(self, addr, local_height):
-        addr_outputs = self.get_addr_outputs(addr)
-        for k, v in list(addr_outputs.items()):
-            if v.spent_height is None:
-                continue
-            if 0 < v.spent_height <= local_height:
-                addr_outputs.pop(k)
-        if addr_outputs:
-            return True
+        for value, is_cb, spending_txid in self._get_addr_outputs_index(addr).values():
+            if spending_txid is None:
+                return True
+            spent_height = self.get_tx_height(spending_txid).height
+            if not 0 < spent_height <= local_height:
+                return True
+        return False
 
     @profiler
     def populate_addrs_with_coins_cache(self):
@@ -614,10 +626,13 @@ class AddressSynchronizer(Logger):
             with self.transaction_lock:
                 self.db.clear_history()
                 self._history_local.clear()
-                self._get_addr_balance_cache = {}  # invalidate cache
+                self._addr_balance_index = {}  # invalidate cache
+                self._addr_outputs_index = {}
                 self._tx_deltas_cache = defaultdict(int)
                 self._tx_deltas_related_txs = defaultdict(set)
                 self._addrs_with_coins_cache = set()
+                self._history_order = []
+                self._history_sort_keys = {}
 
     def get_txpos(self, tx_hash, islock):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -636,6 +651,25 @@ class AddressSynchronizer(Logger):
             else:
                 return (1e10+1, -1)
 
+    def _update_history_order(self, sort_keys: Dict[str, tuple]) -> None:
+        """Updates the sorted history to the new sort keys of its txs.
+        Usually only a few txs are new or got mined, only those are moved.
+        """
+        old_keys = self._history_sort_keys
+        changed = [tx_hash for tx_hash, key in sort_keys.items() if old_keys.get(tx_hash) != key]
+        removed = [tx_hash for tx_hash in old_keys if tx_hash not in sort_keys]
+        if len(changed) + len(removed) > len(sort_keys) // 8:
+            self._history_order = sorted((key, tx_hash) for tx_hash, key in sort_keys.items())
+        else:
+            order = self._history_order
+            for tx_hash in itertools.chain(removed, changed):
+                key = old_keys.get(tx_hash)
+                if key is not None:
+                    del order[bisect.bisect_left(order, (key, tx_hash))]
+            for tx_hash in changed:
+                bisect.insort(order, (sort_keys[tx_hash], tx_hash))
+        self._history_sort_keys = sort_keys
+
     def with_local_height_cached(func):
         # get local height only once, as it's relatively expensive.
         # take care that nested calls work as expected
@@ -664,7 +698,8 @@ class AddressSynchronizer(Logger):
             self.populate_tx_deltas_cache()
         tx_deltas = self._tx_deltas_cache
         # 2. create sorted history
-        history = []
+        history = {}
+        sort_keys = {}
         for tx_hash in tx_deltas:
             delta = tx_deltas[tx_hash]
             tx_mined_status = self.get_tx_height(tx_hash)
@@ -674,11 +709,10 @@ class AddressSynchronizer(Logger):
             else:
                 islock_sort = ''
             fee = self.get_tx_fee(tx_hash)
-            history.append((tx_hash, tx_mined_status, delta, fee,
-                            islock, islock_sort))
-        # tx_hash = x[0], islock = x[4],  islock_sort = x[5]
-        history.sort(key=lambda x: (self.get_txpos(x[0], x[4]), x[5]),
-                     reverse=True)
+            history[tx_hash] = (tx_hash, tx_mined_status, delta, fee, islock)
+            sort_keys[tx_hash] = (self.get_txpos(tx_hash, islock), islock_sort)
+        self._update_history_order(sort_keys)
+        history = [history[tx_hash] for key, tx_hash in reversed(self._history_order)]
         # 3. add balance
         c, u, x = self.get_balance(domain)
         balance = c + u + x
@@ -695,14 +729,10 @@ class AddressSynchronizer(Logger):
         group_delta = None
         group_balance = None
         hist_len = len(history)
-        for i, (tx_hash, tx_mined_status, delta, fee,
-                islock, islock_sort) in enumerate(history):
+        for i, (tx_hash, tx_mined_status, delta, fee, islock) in enumerate(history):
             tx_type = 0
             if show_dip2:
-                tx = self.db.get_transaction(tx_hash)
-                if tx:
-                    raw_bytes = bfh(tx.serialize())
-                    tx_type = tx_header_to_tx_type(raw_bytes[:4])
+                tx_type = self.db.get_tx_type(tx_hash)
             if (group_ps or show_dip2) and not tx_type:  # prefer ProTx type
                 tx_type, completed = self.db.get_ps_tx(tx_hash)
 
@@ -806,24 +836,31 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self.invalidate_tx_balances(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self.invalidate_tx_balances(tx_hash)
                 # tx will be verified only if height > 0
                 self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.add_unverified_tx(tx_hash, tx_height)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self.invalidate_tx_balances(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self.invalidate_tx_balances(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -853,6 +890,7 @@ class AddressSynchronizer(Logger):
                         # into unverified_tx with the old height, and if we get
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
+                        self.invalidate_tx_balances(tx_hash)
                         txs.add(tx_hash)
         return txs
 
@@ -1002,15 +1040,47 @@ class AddressSynchronizer(Logger):
         return received, sent
 
 
-    def get_addr_outputs(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        coins, spent = self.get_addr_io(address)
-        out = {}
+    def _get_addr_outputs_index(self, address: str) -> Dict[str, list]:
+        """Returns the outputs of address, prevout -> [value, is_coinbase,
+        spending txid or None]. Built on first use, and dropped when a tx
+        of the address is added or removed. Heights, islocks and PS rounds
+        are looked up when the outputs are read, as they change more often.
+        """
+        with self.lock, self.transaction_lock:
+            outputs = self._addr_outputs_index.get(address)
+            if outputs is None:
+                outputs = {}
+                related_txns = self._history_local.get(address, ())
+                for tx_hash in related_txns:
+                    for n, (v, is_cb) in self.db.get_txo_addr(tx_hash, address).items():
+                        outputs[tx_hash + ':%d' % n] = [v, is_cb, None]
+                for tx_hash in related_txns:
+                    for txi, v in self.db.get_txi_addr(tx_hash, address):
+                        if txi in outputs:
+                            outputs[txi][2] = tx_hash
+                self._addr_outputs_index[address] = outputs
+            return outputs
+
+    def _iter_addr_outputs(self, address: str, *,
+                           unspent_only: bool = False) -> Iterator[PartialTxInput]:
         psman = self.psman
         if psman.enabled:
             ps_origin_addrs = self.db.get_ps_origin_addrs()
         else:
             ps_origin_addrs = []
-        for prevout_str, v in coins.items():
+        with self.lock, self.transaction_lock:
+            outputs = list(self._get_addr_outputs_index(address).items())
+        heights = {}  # txid -> (height, islock)
+
+        def get_height_and_islock(tx_hash):
+            if tx_hash not in heights:
+                heights[tx_hash] = (self.get_tx_height(tx_hash).height,
+                                    self.db.get_islock(tx_hash))
+            return heights[tx_hash]
+
+        for prevout_str, (value, is_cb, spending_txid) in outputs:
+            if unspent_only and spending_txid is not None:
+                continue
             ps_rounds = None
             ps_denom = self.db.get_ps_denom(prevout_str)
             if ps_denom:
@@ -1028,34 +1098,99 @@ class AddressSynchronizer(Logger):
                 ps_other = self.db.get_ps_other(prevout_str)
                 if ps_other:
                     ps_rounds = int(PSCoinRounds.OTHER)
-            tx_height, value, is_cb, islock = v
             prevout = TxOutpoint.from_str(prevout_str)
             utxo = PartialTxInput(prevout=prevout, is_coinbase_output=is_cb)
             utxo._trusted_address = address
             utxo._trusted_value_sats = value
-            utxo.block_height = tx_height
-            utxo.spent_height, utxo.spent_islock = \
-                spent.get(prevout_str, (None, None))
-            utxo.islock = islock
+            utxo.block_height, utxo.islock = get_height_and_islock(prevout_str[:64])
+            if spending_txid is not None:
+                utxo.spent_height, utxo.spent_islock = get_height_and_islock(spending_txid)
+            else:
+                utxo.spent_height, utxo.spent_islock = None, None
             utxo.ps_rounds = ps_rounds
-            out[prevout] = utxo
-        return out
+            yield utxo
+
+    def get_addr_outputs(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
+        return {utxo.prevout: utxo for utxo in self._iter_addr_outputs(address)}
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        out = self.get_addr_outputs(address)
-        for k, v in list(out.items()):
-            if v.spent_height is not None:
-                out.pop(k)
-        return out
+        return {utxo.prevout: utxo
+                for utxo in self._iter_addr_outputs(address, unspent_only=True)}
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
         received, sent = self.get_addr_io(address)
         return sum([v for height, v, is_cb, islock in received.values()])
 
+    def invalidate_addr_balances(self, addrs=None):
+        """Drops the balance index of addrs, of all addresses if None"""
+        with self.lock:
+            if addrs is None:
+                self._addr_balance_index = {}
+            else:
+                for addr in addrs:
+                    self._addr_balance_index.pop(addr, None)
+
+    def invalidate_tx_balances(self, tx_hash):
+        """Drops the balance index of addresses with coins funded or
+        spent by tx_hash, to call when its height or islock changes"""
+        self.invalidate_addr_balances(
+            itertools.chain(self.db.get_txi_addresses(tx_hash),
+                            self.db.get_txo_addresses(tx_hash)))
+
+    def _get_txo_balance(self, prevout_str, value, is_cb, spending_txid):
+        """Returns the confirmed and unconfirmed amounts txo adds to the
+        balance of its address, and for coinbase outputs, which maturity
+        depends on the local height, (height, value, confirmed)
+        """
+        c = u = 0
+        coinbase = None
+        tx_height = self.get_tx_height(prevout_str[:64]).height
+        confirmed = tx_height > 0 or bool(self.db.get_islock(prevout_str[:64]))
+        if is_cb:
+            coinbase = (tx_height, value, confirmed)
+        elif confirmed:
+            c += value
+        else:
+            u += value
+        if spending_txid is not None:
+            spent_height = self.get_tx_height(spending_txid).height
+            if spent_height > 0 or self.db.get_islock(spending_txid):
+                c -= value
+            else:
+                u -= value
+        return c, u, coinbase
+
+    def _get_addr_balance_index(self, address) -> Dict[Optional[int], list]:
+        """Returns the balance of address by PS rounds of its coins
+        (None for coins which are not PS denoms), rounds -> [confirmed,
+        unconfirmed, coinbase outputs]. Built on first use, and dropped
+        when a tx of the address is added, removed or changes height,
+        and when PS denoms of the address change.
+        """
+        with self.lock, self.transaction_lock:
+            index = self._addr_balance_index.get(address)
+            if index is None:
+                index = {}
+                outputs = self._get_addr_outputs_index(address)
+                for prevout_str, (v, is_cb, spending_txid) in outputs.items():
+                    ps_denom = self.db.get_ps_denom(prevout_str)
+                    rounds = ps_denom[2] if ps_denom else None
+                    bucket = index.get(rounds)
+                    if bucket is None:
+                        bucket = index[rounds] = [0, 0, []]
+                    c, u, coinbase = self._get_txo_balance(prevout_str, v, is_cb,
+                                                           spending_txid)
+                    bucket[0] += c
+                    bucket[1] += u
+                    if coinbase:
+                        bucket[2].append(coinbase)
+                self._addr_balance_index[address] = index
+            return index
+
     @with_local_height_cached
     def get_addr_balance(self, address, *, excluded_coins: Set[str] = None,
-                         min_rounds=None, ps_denoms=None) -> Tuple[int, int, int]:
+                         min_rounds=None) -> Tuple[int, int, int]:
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
 
@@ -1063,44 +1198,47 @@ class AddressSynchronizer(Logger):
         """
         if min_rounds is not None and min_rounds < 0:
             min_rounds = None
-        if ps_denoms is None:
-            ps_denoms = {}
-        # cache is only used if there are no excluded_coins or min_rounds
-        if not excluded_coins and min_rounds is None:
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
         if excluded_coins is None:
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
         c = u = x = 0
         mempool_height = self.get_local_height() + 1  # height of next block
-        for txo, (tx_height, v, is_cb, islock) in received.items():
-            if min_rounds is not None and txo not in ps_denoms:
-                continue
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + COINBASE_MATURITY > mempool_height:
-                x += v
-            elif tx_height > 0 or islock:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                sent_height, sent_islock = sent[txo]
-                if sent_height > 0 or sent_islock:
-                    c -= v
+        with self.lock, self.transaction_lock:
+            buckets = []
+            for rounds, bucket in self._get_addr_balance_index(address).items():
+                if min_rounds is not None and (rounds is None or rounds < min_rounds):
+                    continue
+                c += bucket[0]
+                u += bucket[1]
+                buckets.append(bucket[2])
+            if excluded_coins:
+                outputs = self._get_addr_outputs_index(address)
+                for txo in excluded_coins.intersection(outputs):
+                    if min_rounds is not None:
+                        ps_denom = self.db.get_ps_denom(txo)
+                        if not ps_denom or ps_denom[2] < min_rounds:
+                            continue
+                    ex_c, ex_u, coinbase = self._get_txo_balance(txo, *outputs[txo])
+                    c -= ex_c
+                    u -= ex_u
+                    if coinbase:
+                        # coinbase outputs are summed up below
+                        tx_height, v, confirmed = coinbase
+                        if tx_height + COINBASE_MATURITY > mempool_height:
+                            x -= v
+                        elif confirmed:
+                            c -= v
+                        else:
+                            u -= v
+        for coinbase in buckets:
+            for tx_height, v, confirmed in coinbase:
+                if tx_height + COINBASE_MATURITY > mempool_height:
+                    x += v
+                elif confirmed:
+                    c += v
                 else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins and min_rounds is None:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...);
-            # or new islock
-            self._get_addr_balance_cache[address] = result
-        return result
+                    u += v
+        return c, u, x
 
     @with_local_height_cached
     @profiler
@@ -1146,8 +1284,9 @@ class AddressSynchronizer(Logger):
         for addr in domain:
             if addr not in self._addrs_with_coins_cache:
                 continue
-            txos = self.get_addr_outputs(addr)
-            for txo in txos.values():
+            # spent outputs are only needed for the utxos at a past height
+            txos = self._iter_addr_outputs(addr, unspent_only=not confirmed_spending_only)
+            for txo in txos:
                 if txo.address in ps_ks_domain:
                     txo.is_ps_ks = True
                 else:
@@ -1184,17 +1323,14 @@ class AddressSynchronizer(Logger):
                     excluded_coins: Set[str] = None,
                     include_ps=True, min_rounds=None) -> Tuple[int, int, int]:
         '''min_rounds parameter consider values < 0 same as None'''
-        ps_denoms = {}
-        if min_rounds is not None:
-            if min_rounds < 0:
-                min_rounds = None
-            else:
-                ps_denoms = self.db.get_ps_denoms(min_rounds=min_rounds)
+        if min_rounds is not None and min_rounds < 0:
+            min_rounds = None
         if domain is None:
             if include_ps:
                 domain = self.get_addresses() + self.psman.get_addresses()
             else:
                 if min_rounds is not None:
+                    ps_denoms = self.db.get_ps_denoms(min_rounds=min_rounds)
                     domain = [ps_denom[0] for ps_denom in ps_denoms.values()]
                 else:
                     ps_addrs = self.db.get_ps_addresses()
@@ -1208,8 +1344,7 @@ class AddressSynchronizer(Logger):
         for addr in domain:
             c, u, x = self.get_addr_balance(addr,
                                             excluded_coins=excluded_coins,
-                                            min_rounds=min_rounds,
-                                            ps_denoms=ps_denoms)
+                                            min_rounds=min_rounds)
             cc += c
             uu += u
             xx += x
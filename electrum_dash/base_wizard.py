@@ -24,7 +24,6 @@
 # SOFTWARE.
 
 import os
-import json
 import sys
 import copy
 import traceback
@@ -40,6 +39,7 @@ from .wallet import (Imported_Wallet, Standard_Wallet, Multisig_Wallet,
                      wallet_types, Wallet, Abstract_Wallet)
 from .storage import WalletStorage, StorageEncryptionVersion
 from .wallet_db import WalletDB
+from .json_db import load_json_with_patches
 from .i18n import _
 from .util import (UserCancelled, InvalidPassword, WalletFileException,
                    UserFacingException, multisig_type)
@@ -566,7 +566,7 @@ class BaseWizard(Logger):
 
     def continue_multisig_setup(self, storage):
         self.wallet_type = 'multisig'
-        storage_data = json.loads(storage.read())
+        storage_data = load_json_with_patches(storage.read())
         self.data['wallet_type'] = wallet_type = storage_data['wallet_type']
         m, n = multisig_type(wallet_type)
         self.n = n
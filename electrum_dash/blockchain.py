@@ -21,11 +21,20 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import sys
+import atexit
+import json
+import mmap
+import multiprocessing
 import threading
+import collections.abc
+import concurrent.futures
 import time
-from typing import Optional, Dict, Mapping, Sequence
+from collections import OrderedDict, deque
+from typing import Optional, Dict, Mapping, Sequence, Deque, Tuple, List
 
 from . import util
+from . import x11hash
 from .bitcoin import hash_encode, int_to_hex, rev_hex
 from .constants import CHUNK_SIZE
 from .crypto import sha256d
@@ -43,6 +52,12 @@ MAX_TARGET = 0x00000FFFFF000000000000000000000000000000000000000000000000000000
 POW_TARGET_SPACING = int(2.5 * 60)  # Dash: 2.5 minutes
 POW_DGW3_HEIGHT = 68589
 DGW_PAST_BLOCKS = 24
+HEADER_CACHE_SIZE = 4 * CHUNK_SIZE  # max number of decoded headers kept per chain
+POW_HASH_MIN_BATCH = 256  # smaller batches are hashed in the calling thread
+# appended headers are fsynced once this many are pending, or this many seconds passed
+HEADERS_FSYNC_BATCH = 100
+HEADERS_FSYNC_INTERVAL = 30
+FORK_PRUNE_DEPTH = CHUNK_SIZE  # forks this many blocks behind the best chain are deleted on startup
 
 
 class MissingHeader(Exception):
@@ -51,7 +66,66 @@ class MissingHeader(Exception):
 class InvalidHeader(Exception):
     pass
 
+class Header(collections.abc.Mapping):
+    """A block header backed by its raw 80 bytes. Fields are decoded
+    when accessed, it can be used in place of the header dicts.
+    """
+    __slots__ = ('raw', 'block_height', '_hash')
+
+    FIELDS = ('version', 'prev_block_hash', 'merkle_root', 'timestamp',
+              'bits', 'nonce', 'block_height')
+
+    def __init__(self, raw: bytes, height: int):
+        self.raw = raw
+        self.block_height = height
+        self._hash = None  # type: Optional[str]
+
+    def __getitem__(self, key):
+        raw = self.raw
+        if key == 'version':
+            return int.from_bytes(raw[0:4], byteorder='little')
+        elif key == 'prev_block_hash':
+            return hash_encode(raw[4:36])
+        elif key == 'merkle_root':
+            return hash_encode(raw[36:68])
+        elif key == 'timestamp':
+            return int.from_bytes(raw[68:72], byteorder='little')
+        elif key == 'bits':
+            return int.from_bytes(raw[72:76], byteorder='little')
+        elif key == 'nonce':
+            return int.from_bytes(raw[76:80], byteorder='little')
+        elif key == 'block_height':
+            return self.block_height
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, Header):
+            return self.raw == other.raw and self.block_height == other.block_height
+        return super().__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Header({self.to_dict()!r})'
+
+    def hash(self) -> str:
+        if self._hash is None:
+            self._hash = hash_encode(PoWHash(self.raw))
+        return self._hash
+
+    def to_dict(self) -> dict:
+        return dict(self)
+
+
 def serialize_header(header_dict: dict) -> str:
+    if isinstance(header_dict, Header):
+        return header_dict.raw.hex()
     s = int_to_hex(header_dict['version'], 4) \
         + rev_hex(header_dict['prev_block_hash']) \
         + rev_hex(header_dict['merkle_root']) \
@@ -60,25 +134,18 @@ def serialize_header(header_dict: dict) -> str:
         + int_to_hex(int(header_dict['nonce']), 4)
     return s
 
-def deserialize_header(s: bytes, height: int) -> dict:
+def deserialize_header(s: bytes, height: int) -> Header:
     if not s:
         raise InvalidHeader('Invalid header: {}'.format(s))
     if len(s) != HEADER_SIZE:
         raise InvalidHeader('Invalid header length: {}'.format(len(s)))
-    hex_to_int = lambda s: int.from_bytes(s, byteorder='little')
-    h = {}
-    h['version'] = hex_to_int(s[0:4])
-    h['prev_block_hash'] = hash_encode(s[4:36])
-    h['merkle_root'] = hash_encode(s[36:68])
-    h['timestamp'] = hex_to_int(s[68:72])
-    h['bits'] = hex_to_int(s[72:76])
-    h['nonce'] = hex_to_int(s[76:80])
-    h['block_height'] = height
-    return h
+    return Header(bytes(s), height)
 
 def hash_header(header: dict) -> str:
     if header is None:
         return '0' * 64
+    if isinstance(header, Header):
+        return header.hash()
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
     return hash_raw_header(serialize_header(header))
@@ -88,6 +155,81 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(PoWHash(bfh(header)))
 
 
+_pow_hash_executor = None  # type: Optional[concurrent.futures.Executor]
+_pow_hash_executor_lock = threading.Lock()
+_pow_hash_executor_shut_down = False
+_pow_hash_workers = os.cpu_count() or 1
+
+
+def _get_pow_hash_executor() -> Optional[concurrent.futures.Executor]:
+    global _pow_hash_executor
+    with _pow_hash_executor_lock:
+        if _pow_hash_executor is not None:
+            return _pow_hash_executor
+        workers = _pow_hash_workers
+        if workers < 2 or _pow_hash_executor_shut_down:
+            return None
+        if x11hash.load_libx11hash:
+            # libx11hash is called through ctypes, which releases the GIL
+            _pow_hash_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='pow_hash')
+        elif not getattr(sys, 'frozen', False) and not util.is_android():
+            # workers are spawned, not forked: we have threads by now,
+            # and a forked child would inherit their locks in any state
+            try:
+                _pow_hash_executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            except (ImportError, OSError, NotImplementedError, ValueError) as e:
+                _logger.info(f'cannot use process pool for PoW hashing: {repr(e)}')
+        return _pow_hash_executor
+
+
+def shutdown_pow_hash_executor() -> None:
+    """Stops the workers of hash_headers. Later calls hash in the
+    calling thread.
+    """
+    global _pow_hash_executor, _pow_hash_executor_shut_down
+    with _pow_hash_executor_lock:
+        executor = _pow_hash_executor
+        _pow_hash_executor = None
+        _pow_hash_executor_shut_down = True
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+atexit.register(shutdown_pow_hash_executor)
+
+
+def _pow_hash_many(raw_headers: Sequence[bytes]) -> List[bytes]:
+    return [PoWHash(h) for h in raw_headers]
+
+
+def hash_headers(raw_headers: Sequence[bytes]) -> List[str]:
+    """Returns the hashes of the given raw (80 byte) headers. Large
+    batches are split over a pool of workers. Blocks until they are
+    done, so it should not be called on the event loop.
+    """
+    global _pow_hash_executor
+    raw_headers = [bytes(h) for h in raw_headers]
+    executor = None
+    if len(raw_headers) >= POW_HASH_MIN_BATCH:
+        executor = _get_pow_hash_executor()
+    if executor is None:
+        return [hash_encode(h) for h in _pow_hash_many(raw_headers)]
+    batch_size = -(-len(raw_headers) // _pow_hash_workers)
+    batches = [raw_headers[i:i+batch_size]
+               for i in range(0, len(raw_headers), batch_size)]
+    try:
+        results = list(executor.map(_pow_hash_many, batches))
+    except RuntimeError as e:  # BrokenProcessPool, or shut down meanwhile
+        _logger.info(f'PoW hashing pool unusable: {repr(e)}')
+        with _pow_hash_executor_lock:
+            if _pow_hash_executor is executor:
+                _pow_hash_executor = None
+        return [hash_encode(h) for h in _pow_hash_many(raw_headers)]
+    return [hash_encode(h) for batch in results for h in batch]
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -101,24 +243,70 @@ def read_blockchains(config: 'SimpleConfig'):
                             forkpoint_hash=constants.net.GENESIS,
                             prev_hash=None)
     blockchains[constants.net.GENESIS] = best_chain
+    read_chainwork_index(config)
     # consistency checks
+    best_chain.truncate_torn_tail()
     if best_chain.height() > constants.net.max_checkpoint():
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_headers_file()
             os.unlink(best_chain.path())
             best_chain.update_size()
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
+    forks_index = read_forks_index(config)
     # files are named as: fork2_{forkpoint}_{prev_hash}_{first_hash}
-    l = filter(lambda x: x.startswith('fork2_') and '.' not in x, os.listdir(fdir))
-    l = sorted(l, key=lambda x: int(x.split('_')[1]))  # sort by forkpoint
+    file_sizes = {entry.name: entry.stat().st_size for entry in os.scandir(fdir)
+                  if entry.name.startswith('fork2_') and '.' not in entry.name}
+    l = sorted(file_sizes, key=lambda x: int(x.split('_')[1]))  # sort by forkpoint
 
-    def delete_chain(filename, reason):
+    def delete_chain(filename, reason, chain=None):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
+        if chain is not None:
+            chain.close_headers_file()
         os.unlink(os.path.join(fdir, filename))
 
+    def find_parent(forkpoint, prev_hash, index_entry):
+        # try the parent recorded in the index first
+        if index_entry:
+            parent = blockchains.get(index_entry.get('parent'))
+            if parent and parent.check_hash(forkpoint - 1, prev_hash):
+                return parent
+        for parent in blockchains.values():
+            if parent.check_hash(forkpoint - 1, prev_hash):
+                return parent
+
+    chains_from_index = set()
+
+    def chain_from_index(filename, forkpoint, prev_hash, first_hash, index_entry) -> Optional[Blockchain]:
+        """Returns the chain of a fork file that is unchanged since the
+        index was written, without reading the file.
+        """
+        if not index_entry or index_entry.get('forkpoint') != forkpoint:
+            return None
+        size, tip_hash = index_entry.get('size'), index_entry.get('tip_hash')
+        if not isinstance(size, int) or size <= 0 or file_sizes[filename] != size * HEADER_SIZE:
+            return None
+        if not isinstance(tip_hash, str) or len(tip_hash) != 64:
+            return None
+        # a parent that is unchanged as well still links up; the best
+        # chain might have changed since, its file is open anyway
+        parent = blockchains.get(index_entry.get('parent'))
+        if parent is None:
+            return None
+        if parent.get_id() not in chains_from_index and not parent.check_hash(forkpoint - 1, prev_hash):
+            return None
+        chains_from_index.add(first_hash)
+        return Blockchain(config=config,
+                          forkpoint=forkpoint,
+                          parent=parent,
+                          forkpoint_hash=first_hash,
+                          prev_hash=prev_hash,
+                          size=size,
+                          tip_hash=tip_hash)
+
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
         forkpoint = int(forkpoint)
@@ -128,26 +316,29 @@ def read_blockchains(config: 'SimpleConfig'):
         if forkpoint <= constants.net.max_checkpoint():
             delete_chain(filename, "deleting fork below max checkpoint")
             return
-        # find parent (sorting by forkpoint guarantees it's already instantiated)
-        for parent in blockchains.values():
-            if parent.check_hash(forkpoint - 1, prev_hash):
-                break
-        else:
-            delete_chain(filename, "cannot find parent for chain")
-            return
-        b = Blockchain(config=config,
-                       forkpoint=forkpoint,
-                       parent=parent,
-                       forkpoint_hash=first_hash,
-                       prev_hash=prev_hash)
-        # consistency checks
-        h = b.read_header(b.forkpoint)
-        if first_hash != hash_header(h):
-            delete_chain(filename, "incorrect first hash for chain")
-            return
-        if not b.parent.can_connect(h, check_height=False):
-            delete_chain(filename, "cannot connect chain to parent")
-            return
+        # forks that were checked already are taken from the index
+        # (sorting by forkpoint guarantees the parent is already instantiated)
+        index_entry = forks_index.get(filename)
+        b = chain_from_index(filename, forkpoint, prev_hash, first_hash, index_entry)
+        if b is None:
+            parent = find_parent(forkpoint, prev_hash, index_entry)
+            if parent is None:
+                delete_chain(filename, "cannot find parent for chain")
+                return
+            b = Blockchain(config=config,
+                           forkpoint=forkpoint,
+                           parent=parent,
+                           forkpoint_hash=first_hash,
+                           prev_hash=prev_hash)
+            # consistency checks
+            b.truncate_torn_tail()
+            h = b.read_header(b.forkpoint)
+            if first_hash != hash_header(h):
+                delete_chain(filename, "incorrect first hash for chain", b)
+                return
+            if not b.parent.can_connect(h, check_height=False):
+                delete_chain(filename, "cannot connect chain to parent", b)
+                return
         chain_id = b.get_id()
         assert first_hash == chain_id, (first_hash, chain_id)
         blockchains[chain_id] = b
@@ -155,6 +346,87 @@ def read_blockchains(config: 'SimpleConfig'):
     for filename in l:
         instantiate_chain(filename)
 
+    prune_forks(config)
+    write_forks_index(config)
+
+
+def prune_forks(config: 'SimpleConfig') -> None:
+    """Deletes the forks whose tip is more than 'fork_prune_depth'
+    blocks behind the best chain, unless another fork builds on them.
+    """
+    depth = config.get('fork_prune_depth', FORK_PRUNE_DEPTH)
+    best_height = get_best_chain().height()
+    with blockchains_lock:
+        forks = sorted([b for b in blockchains.values() if b.parent is not None],
+                       key=lambda b: b.forkpoint, reverse=True)
+    for b in forks:
+        if b.height() >= best_height - depth:
+            continue
+        if b.get_direct_children():
+            continue
+        _logger.info(f"[blockchain] pruning stale fork {b.get_id()} at {b.forkpoint}, "
+                     f"height {b.height()}")
+        with b.lock:
+            b.close_headers_file()
+            os.unlink(b.path())
+            with blockchains_lock:
+                blockchains.pop(b.get_id(), None)
+
+
+def _forks_index_path(config: 'SimpleConfig') -> str:
+    return os.path.join(util.get_headers_dir(config), 'forks', 'index.json')
+
+
+def read_forks_index(config: 'SimpleConfig') -> Dict[str, dict]:
+    """Returns the index of fork files: filename -> (forkpoint,
+    parent, size, tip_hash) as written by write_forks_index.
+    """
+    path = _forks_index_path(config)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            forks_index = json.loads(f.read())
+    except (OSError, ValueError) as e:
+        _logger.info(f'[blockchain] cannot read forks index: {repr(e)}')
+        return {}
+    if not isinstance(forks_index, dict) or forks_index.get('net') != constants.net.NET_NAME:
+        return {}
+    return forks_index.get('forks', {})
+
+
+def write_forks_index(config: 'SimpleConfig') -> None:
+    forks = {}
+    with blockchains_lock: chains = list(blockchains.values())
+    for b in chains:
+        if b.parent is None:
+            continue
+        with b.lock:
+            try:
+                forks[os.path.basename(b.path())] = {
+                    'forkpoint': b.forkpoint,
+                    'parent': b.parent.get_id(),
+                    'size': b.size(),
+                    'tip_hash': b.get_hash(b.height()),
+                }
+            except MissingHeader:
+                continue
+    path = _forks_index_path(config)
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'net': constants.net.NET_NAME, 'forks': forks}))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        _logger.info(f'[blockchain] cannot write forks index: {repr(e)}')
+
+
+def sync_headers_files() -> None:
+    """fsync the headers appended to any chain since its last fsync"""
+    with blockchains_lock: chains = list(blockchains.values())
+    for b in chains:
+        b.sync_headers_file()
+
 
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
@@ -164,6 +436,89 @@ _CHAINWORK_CACHE = {
     "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
 }  # type: Dict[str, int]
 
+# The chain work of the last block of each chunk is persisted in
+# 'chainwork_index' in the headers dir, as fixed size records of
+# (block hash, chain work), both 32 bytes big endian. Records are
+# appended; on startup they are checked against the best chain, the
+# ones of other chains are dropped, and the file is rebuilt if any
+# chain work does not match.
+CHAINWORK_RECORD_SIZE = 64
+_chainwork_index_path = None  # type: Optional[str]
+_chainwork_index_lock = threading.Lock()
+
+
+def read_chainwork_index(config: 'SimpleConfig') -> None:
+    global _chainwork_index_path
+    path = os.path.join(util.get_headers_dir(config), 'chainwork_index')
+    with _chainwork_index_lock:
+        _chainwork_index_path = path
+        if constants.net.TESTNET or not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        # only keep the records that are fully written
+        num_records = len(data) // CHAINWORK_RECORD_SIZE
+        records = {}
+        for i in range(num_records):
+            record = data[i*CHAINWORK_RECORD_SIZE : (i+1)*CHAINWORK_RECORD_SIZE]
+            records[bh2u(record[:32])] = int.from_bytes(record[32:], byteorder='big')
+        valid_records = _validate_chainwork_records(records)
+        if valid_records is None:
+            _logger.info('[blockchain] rebuilding chainwork index')
+            os.unlink(path)
+            return
+        if len(valid_records) != num_records or len(data) != num_records * CHAINWORK_RECORD_SIZE:
+            _logger.info(f'[blockchain] dropping {num_records - len(valid_records)} chainwork index records')
+            _write_chainwork_index(path, valid_records)
+        _CHAINWORK_CACHE.update(valid_records)
+
+
+def _validate_chainwork_records(records: Dict[str, int]) -> Optional[Dict[str, int]]:
+    """Checks the records against the chain work computed along the
+    best chain. Returns the records of its chunks, or None if any of
+    them has a wrong chain work."""
+    best_chain = get_best_chain()
+    valid_records = {}
+    running_total = 0
+    num_chunks = max(len(best_chain.checkpoints), (best_chain.height() + 1) // CHUNK_SIZE)
+    for index in range(num_chunks):
+        height = (index + 1) * CHUNK_SIZE - 1
+        running_total += CHUNK_SIZE * best_chain.chainwork_of_header_at_height(height)
+        try:
+            block_hash = best_chain.get_hash(height)
+        except MissingHeader:
+            break
+        work = records.get(block_hash)
+        if work is None:
+            continue
+        if work != running_total:
+            return None
+        valid_records[block_hash] = work
+    return valid_records
+
+
+def _write_chainwork_index(path: str, records: Dict[str, int]) -> None:
+    data = b''.join(bfh(h) + work.to_bytes(32, byteorder='big')
+                    for h, work in records.items())
+    try:
+        with open(path, 'wb') as f:
+            f.write(data)
+    except OSError as e:
+        _logger.info(f'[blockchain] failed to write chainwork index: {repr(e)}')
+
+
+def _append_to_chainwork_index(records: Sequence[Tuple[str, int]]) -> None:
+    with _chainwork_index_lock:
+        if _chainwork_index_path is None or not records:
+            return
+        data = b''.join(bfh(h) + work.to_bytes(32, byteorder='big')
+                        for h, work in records)
+        try:
+            with open(_chainwork_index_path, 'ab') as f:
+                f.write(data)
+        except OSError as e:
+            _logger.info(f'[blockchain] failed to write chainwork index: {repr(e)}')
+
 
 def init_headers_file_for_best_chain():
     b = get_best_chain()
@@ -171,11 +526,11 @@ def init_headers_file_for_best_chain():
     len_checkpoints = len(constants.net.CHECKPOINTS)
     length = HEADER_SIZE * len_checkpoints * CHUNK_SIZE
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        b.close_headers_file()
         with open(filename, 'wb') as f:
             for i in range(len_checkpoints):
-                for height, header_data in b.checkpoints[i][2]:
+                for height, bin_header in b.get_checkpoint_extra_headers(i):
                     f.seek(height*80)
-                    bin_header = util.bfh(header_data)
                     f.write(bin_header)
         util.ensure_sparse_file(filename)
     with b.lock:
@@ -188,7 +543,11 @@ class Blockchain(Logger):
     """
 
     def __init__(self, config: SimpleConfig, forkpoint: int, parent: Optional['Blockchain'],
-                 forkpoint_hash: str, prev_hash: Optional[str]):
+                 forkpoint_hash: str, prev_hash: Optional[str],
+                 *, size: int = None, tip_hash: str = None):
+        """size and tip_hash may be given if they are known (from the
+        forks index), the headers file is then not accessed until used.
+        """
         assert isinstance(forkpoint_hash, str) and len(forkpoint_hash) == 64, forkpoint_hash
         assert (prev_hash is None) or (isinstance(prev_hash, str) and len(prev_hash) == 64), prev_hash
         # assert (parent is None) == (forkpoint == 0)
@@ -201,12 +560,35 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
-        self.update_size()
+        self._headers_mmap = None  # type: Optional[mmap.mmap]
+        self._header_cache = OrderedDict()  # type: OrderedDict[int, Header]
+        self._durable_size = 0  # number of headers known to be fsynced to disk
+        self._tip_hash = None  # type: Optional[Tuple[int, str]]  # (height, hash), if known
+        if size is None:
+            self.update_size()
+        else:
+            self._size = size
+            if tip_hash is not None:
+                self._tip_hash = (self.height(), tip_hash)
+        self._durable_size = self._size
+        self._last_fsync = time.monotonic()
 
     @property
     def checkpoints(self):
         return constants.net.CHECKPOINTS
 
+    def get_checkpoint_hash(self, index: int) -> str:
+        checkpoints = self.checkpoints
+        if isinstance(checkpoints, constants.Checkpoints):
+            return checkpoints.get_hash(index)
+        return checkpoints[index][0]
+
+    def get_checkpoint_extra_headers(self, index: int) -> Sequence[Tuple[int, bytes]]:
+        checkpoints = self.checkpoints
+        if isinstance(checkpoints, constants.Checkpoints):
+            return checkpoints.get_raw_extra_headers(index)
+        return [(height, bfh(header_data)) for height, header_data in checkpoints[index][2]]
+
     def get_max_child(self) -> Optional[int]:
         children = self.get_direct_children()
         return max([x.forkpoint for x in children]) if children else None
@@ -297,10 +679,13 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//HEADER_SIZE if os.path.exists(p) else 0
+        self._durable_size = min(self._durable_size, self._size)
+        self._tip_hash = None
 
     @classmethod
-    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None) -> None:
-        _hash = hash_header(header)
+    def verify_header(cls, header: dict, prev_hash: str, target: int, expected_header_hash: str=None,
+                      *, header_hash: str=None) -> None:
+        _hash = header_hash if header_hash is not None else hash_header(header)
         if expected_header_hash and expected_header_hash != _hash:
             raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
         if prev_hash != header.get('prev_block_hash'):
@@ -318,28 +703,47 @@ class Blockchain(Logger):
             raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
 
     def verify_chunk(self, index: int, data: bytes) -> None:
+        self._verify_chunk(index, data)
+
+    def _verify_chunk(self, index: int, data: bytes,
+                      state: Tuple[str, 'DGWWindow'] = None) -> Tuple[str, 'DGWWindow']:
+        """Verifies chunk at index. If state is given, the chunk directly
+        follows a chunk that was verified but not yet saved, and state is
+        what verifying that chunk returned.
+        """
         num = len(data) // HEADER_SIZE
         start_height = index * CHUNK_SIZE
-        prev_hash = self.get_hash(start_height - 1)
-        chunk_headers = {'empty': True}
+        if state is None:
+            prev_hash = self.get_hash(start_height - 1)
+            # (timestamp, target) of the preceding headers, for DGW v3
+            window = DGWWindow()
+        else:
+            prev_hash, window = state
+        raw_headers = [data[i*HEADER_SIZE : (i+1)*HEADER_SIZE] for i in range(num)]
+        header_hashes = hash_headers(raw_headers)
         for i in range(num):
             height = start_height + i
             try:
                 expected_header_hash = self.get_hash(height)
             except MissingHeader:
                 expected_header_hash = None
-            raw_header = data[i*HEADER_SIZE : (i+1)*HEADER_SIZE]
-            height = index * CHUNK_SIZE + i
-            header = deserialize_header(raw_header, height)
-            target = self.get_target(height, chunk_headers)
-            self.verify_header(header, prev_hash, target, expected_header_hash)
-
-            chunk_headers[height] = header
-            if i == 0:
-                chunk_headers['min_height'] = height
-                chunk_headers['empty'] = False
-            chunk_headers['max_height'] = height
-            prev_hash = hash_header(header)
+            header = deserialize_header(raw_headers[i], height)
+            header._hash = header_hashes[i]
+            if height >= POW_DGW3_HEIGHT:
+                if len(window) < DGW_PAST_BLOCKS:
+                    self._prefill_dgw_window(window, height)
+                target = window.get_target()
+            else:
+                target = MAX_TARGET
+            self.verify_header(header, prev_hash, target, expected_header_hash,
+                               header_hash=header_hashes[i])
+
+            # older headers are not used by DGW v3, and their bits
+            # may not convert to a target (e.g. on regtest)
+            if height >= POW_DGW3_HEIGHT - DGW_PAST_BLOCKS:
+                window.append_header(header)
+            prev_hash = header_hashes[i]
+        return prev_hash, window
 
     @with_lock
     def path(self):
@@ -356,7 +760,15 @@ class Blockchain(Logger):
 
     @with_lock
     def save_chunk(self, index: int, chunk: bytes):
+        """Saves chunk at index. chunk may also hold several consecutive chunks."""
         assert index >= 0, index
+        num_cp_chunks = len(self.checkpoints) - index
+        cp_region_bytes = num_cp_chunks * CHUNK_SIZE * HEADER_SIZE
+        if 0 < cp_region_bytes < len(chunk):
+            # data extends past the checkpoint region, which is saved differently
+            self.save_chunk(index, chunk[:cp_region_bytes])
+            self.save_chunk(index + num_cp_chunks, chunk[cp_region_bytes:])
+            return
         chunk_within_checkpoint_region = index < len(self.checkpoints)
         # chunks in checkpoint region are the responsibility of the 'main chain'
         if chunk_within_checkpoint_region and self.parent is not None:
@@ -374,6 +786,12 @@ class Blockchain(Logger):
         truncate = not chunk_within_checkpoint_region
         self.write(chunk, delta_bytes, truncate)
         self.swap_with_parent()
+        # extend the chainwork index with the new chunks
+        if not chunk_within_checkpoint_region:
+            try:
+                self.get_chainwork()
+            except MissingHeader:
+                pass
 
     def swap_with_parent(self) -> None:
         with self.lock, blockchains_lock:
@@ -422,6 +840,12 @@ class Blockchain(Logger):
             parent_data = f.read(parent_branch_size*HEADER_SIZE)
         self.write(parent_data, 0)
         parent.write(my_data, (forkpoint - parent.forkpoint)*HEADER_SIZE)
+        # both files must be durable before they are renamed
+        self.sync_headers_file()
+        parent.sync_headers_file()
+        # heights map to different files from now on
+        self.close_headers_file()
+        parent.close_headers_file()
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
@@ -431,6 +855,7 @@ class Blockchain(Logger):
         os.replace(child_old_name, parent.path())
         self.update_size()
         parent.update_size()
+        self._durable_size, parent._durable_size = self._size, parent._size
         # update pointers
         blockchains.pop(child_old_id, None)
         blockchains.pop(parent_old_id, None)
@@ -453,6 +878,11 @@ class Blockchain(Logger):
     def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        # the mapping has to be released before the file is modified
+        # (on Windows a mapped file cannot be truncated)
+        self._close_headers_mmap()
+        self._invalidate_header_cache(self.forkpoint + offset // HEADER_SIZE)
+        do_fsync = self._should_fsync(offset, len(data))
         with open(filename, 'rb+') as f:
             if truncate and offset != self._size * HEADER_SIZE:
                 f.seek(offset)
@@ -460,13 +890,71 @@ class Blockchain(Logger):
             f.seek(offset)
             f.write(data)
             f.flush()
-            os.fsync(f.fileno())
+            if do_fsync:
+                os.fsync(f.fileno())
         self.update_size()
+        if do_fsync:
+            self._durable_size = self._size
+            self._last_fsync = time.monotonic()
+
+    def _should_fsync(self, offset: int, length: int) -> bool:
+        if offset < self._durable_size * HEADER_SIZE:
+            return True  # rewriting headers that were already durable
+        pending = (offset + length) // HEADER_SIZE - self._durable_size
+        if pending >= self.config.get('headers_fsync_batch', HEADERS_FSYNC_BATCH):
+            return True
+        interval = self.config.get('headers_fsync_interval', HEADERS_FSYNC_INTERVAL)
+        return time.monotonic() - self._last_fsync >= interval
+
+    @with_lock
+    def sync_headers_file(self) -> None:
+        if self._durable_size == self._size:
+            return
+        filename = self.path()
+        if not os.path.exists(filename):
+            return
+        with open(filename, 'rb+') as f:
+            os.fsync(f.fileno())
+        self._durable_size = self._size
+        self._last_fsync = time.monotonic()
+
+    @with_lock
+    def truncate_torn_tail(self) -> None:
+        """Headers appended after the last fsync might not have made it
+        to disk if we crashed. Truncates the file at the first header of
+        that tail that does not link up with its predecessor.
+        """
+        filename = self.path()
+        if not os.path.exists(filename):
+            return
+        if os.path.getsize(filename) % HEADER_SIZE:
+            self.logger.info('truncating partially written header')
+            self._close_headers_mmap()
+            with open(filename, 'rb+') as f:
+                f.truncate(self._size * HEADER_SIZE)
+                os.fsync(f.fileno())
+        window = self.config.get('headers_fsync_batch', HEADERS_FSYNC_BATCH)
+        start = max(self.height() - window + 1, self.forkpoint + 1,
+                    constants.net.max_checkpoint() + 1)
+        for height in range(start, self.height() + 1):
+            header = self.read_header(height)
+            try:
+                prev_hash = self.get_hash(height - 1)
+            except MissingHeader:
+                prev_hash = None
+            if header is None or header['prev_block_hash'] != prev_hash:
+                self.logger.info(f'truncating torn headers file tail at height {height}')
+                self.write(b'', (height - self.forkpoint) * HEADER_SIZE)
+                break
+        self._durable_size = self._size
 
     @with_lock
     def save_header(self, header: dict) -> None:
         delta = header.get('block_height') - self.forkpoint
-        data = bfh(serialize_header(header))
+        if isinstance(header, Header):
+            data = header.raw
+        else:
+            data = bfh(serialize_header(header))
         # headers are only _appended_ to the end:
         assert delta == self.size(), (delta, self.size())
         assert len(data) == HEADER_SIZE
@@ -474,24 +962,60 @@ class Blockchain(Logger):
         self.swap_with_parent()
 
     @with_lock
-    def read_header(self, height: int) -> Optional[dict]:
+    def read_header(self, height: int) -> Optional[Header]:
         if height < 0:
             return
         if height < self.forkpoint:
             return self.parent.read_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * HEADER_SIZE)
-            h = f.read(HEADER_SIZE)
-            if len(h) < HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
+        header = self._header_cache.get(height)
+        if header is not None:
+            self._header_cache.move_to_end(height)
+            return header
+        h = self._read_raw_header(height - self.forkpoint)
         if h == bytes([0])*HEADER_SIZE:
             return None
-        return deserialize_header(h, height)
+        header = deserialize_header(h, height)
+        self._header_cache[height] = header
+        if len(self._header_cache) > HEADER_CACHE_SIZE:
+            self._header_cache.popitem(last=False)
+        return header
+
+    def _read_raw_header(self, delta: int) -> bytes:
+        start = delta * HEADER_SIZE
+        end = start + HEADER_SIZE
+        if self._headers_mmap is None or len(self._headers_mmap) < end:
+            self._close_headers_mmap()
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < end:
+                    raise Exception('Expected to read a full header. '
+                                    'File is too short for header at offset {}'.format(start))
+                self._headers_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._headers_mmap[start:end]
+
+    def _close_headers_mmap(self) -> None:
+        if self._headers_mmap is not None:
+            self._headers_mmap.close()
+            self._headers_mmap = None
+
+    def _invalidate_header_cache(self, from_height: int = None) -> None:
+        if from_height is None or from_height <= self.forkpoint:
+            self._header_cache.clear()
+            return
+        for height in [h for h in self._header_cache if h >= from_height]:
+            del self._header_cache[height]
+
+    @with_lock
+    def close_headers_file(self) -> None:
+        """Releases the memory mapping of the headers file and drops
+        the decoded headers cache. Must be called before the file is
+        modified, moved or deleted outside of write().
+        """
+        self._close_headers_mmap()
+        self._invalidate_header_cache()
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -512,25 +1036,27 @@ class Blockchain(Logger):
             return True
         return False
 
-    def get_hash(self, height: int) -> str:
-        def is_height_checkpoint():
-            within_cp_range = height <= constants.net.max_checkpoint()
-            at_chunk_boundary = (height+1) % CHUNK_SIZE == 0
-            return within_cp_range and at_chunk_boundary
+    @classmethod
+    def is_height_checkpoint(cls, height: int) -> bool:
+        within_cp_range = height <= constants.net.max_checkpoint()
+        at_chunk_boundary = (height+1) % CHUNK_SIZE == 0
+        return within_cp_range and at_chunk_boundary
 
+    def get_hash(self, height: int) -> str:
         if height == -1:
             return '0000000000000000000000000000000000000000000000000000000000000000'
         elif height == 0:
             return constants.net.GENESIS
-        elif is_height_checkpoint():
+        elif self.is_height_checkpoint(height):
             index = height // CHUNK_SIZE
-            h, t, extra_headers = self.checkpoints[index]
-            return h
-        else:
-            header = self.read_header(height)
-            if header is None:
-                raise MissingHeader(height)
-            return hash_header(header)
+            return self.get_checkpoint_hash(index)
+        tip_hash = self._tip_hash
+        if tip_hash is not None and tip_hash[0] == height:
+            return tip_hash[1]
+        header = self.read_header(height)
+        if header is None:
+            raise MissingHeader(height)
+        return hash_header(header)
 
     def get_target(self, height: int, chunk_headers: Optional[dict]=None) -> int:
         if chunk_headers is None:
@@ -549,44 +1075,28 @@ class Blockchain(Logger):
             min_height = chunk_headers['min_height']
             max_height = chunk_headers['max_height']
 
-        count_blocks = 1
-        while count_blocks <= DGW_PAST_BLOCKS:
-            reading_h = height - count_blocks
+        window = DGWWindow()
+        for reading_h in range(height - DGW_PAST_BLOCKS, height):
             reading_header = self.read_header(reading_h)
             if (not reading_header and not chunk_empty
                     and min_height <= reading_h <= max_height):
                 reading_header = chunk_headers[reading_h]
             if not reading_header:
                 raise MissingHeader()
-            reading_time = reading_header.get('timestamp')
-            reading_target = self.bits_to_target(reading_header.get('bits'))
-
-            if count_blocks == 1:
-                past_target_avg = reading_target
-                last_time = reading_time
-            past_target_avg = (past_target_avg * count_blocks +
-                               reading_target) // (count_blocks + 1)
-
-            count_blocks +=1
-
-        new_target = past_target_avg
-        actual_timespan = last_time - reading_time
-        target_timespan = DGW_PAST_BLOCKS * POW_TARGET_SPACING
-
-        if actual_timespan < target_timespan // 3:
-            actual_timespan = target_timespan // 3
-        if actual_timespan > target_timespan * 3:
-            actual_timespan = target_timespan * 3
-
-        new_target *= actual_timespan
-        new_target //= target_timespan
-
-        if new_target > MAX_TARGET:
-            return MAX_TARGET
+            window.append_header(reading_header)
+        return window.get_target()
 
-        # not any target can be represented in 32 bits:
-        new_target = self.bits_to_target(self.target_to_bits(new_target))
-        return new_target
+    def _prefill_dgw_window(self, window: 'DGWWindow', height: int) -> None:
+        """Completes window (holding the headers right below height)
+        with the older headers read from the chain.
+        """
+        missing = DGW_PAST_BLOCKS - len(window)
+        for reading_h in range(height - DGW_PAST_BLOCKS + missing - 1,
+                               height - DGW_PAST_BLOCKS - 1, -1):
+            reading_header = self.read_header(reading_h)
+            if not reading_header:
+                raise MissingHeader()
+            window.prepend_header(reading_header)
 
     @classmethod
     def bits_to_target(cls, bits: int) -> int:
@@ -600,10 +1110,10 @@ class Blockchain(Logger):
 
     @classmethod
     def target_to_bits(cls, target: int) -> int:
-        c = ("%064x" % target)[2:]
-        while c[:2] == '00' and len(c) > 6:
-            c = c[2:]
-        bitsN, bitsBase = len(c) // 2, int.from_bytes(bfh(c[:6]), byteorder='big')
+        # only the lower 31 bytes of a 256-bit target are encoded
+        target &= (1 << 248) - 1
+        bitsN = max((target.bit_length() + 7) // 8, 3)
+        bitsBase = target >> (8 * (bitsN - 3))
         if bitsBase >= 0x800000:
             bitsN += 1
             bitsBase >>= 8
@@ -626,18 +1136,22 @@ class Blockchain(Logger):
             return height
         last_retarget = height // CHUNK_SIZE * CHUNK_SIZE - 1
         cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
+        while True:
+            running_total = _CHAINWORK_CACHE.get(self.get_hash(cached_height))
+            if running_total is not None or cached_height <= -1:
                 break
             cached_height -= CHUNK_SIZE
         assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
+        new_records = []
         while cached_height < last_retarget:
             cached_height += CHUNK_SIZE
             work_in_single_header = self.chainwork_of_header_at_height(cached_height)
             work_in_chunk = CHUNK_SIZE * work_in_single_header
             running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
+            block_hash = self.get_hash(cached_height)
+            _CHAINWORK_CACHE[block_hash] = running_total
+            new_records.append((block_hash, running_total))
+        _append_to_chainwork_index(new_records)
         cached_height += CHUNK_SIZE
         work_in_single_header = self.chainwork_of_header_at_height(cached_height)
         work_in_last_partial_chunk = (height % CHUNK_SIZE + 1) * work_in_single_header
@@ -668,15 +1182,35 @@ class Blockchain(Logger):
         return True
 
     def connect_chunk(self, idx: int, hexdata: str) -> bool:
-        assert idx >= 0, idx
+        return self.connect_chunks(idx, [hexdata]) == 1
+
+    def connect_chunks(self, start_idx: int, hexdatas: Sequence[str]) -> int:
+        """Verifies consecutive chunks starting at start_idx, and saves
+        the ones up to the first invalid chunk with a single write.
+        Returns the number of chunks connected.
+        """
+        assert start_idx >= 0, start_idx
+        verified = []
+        state = None
+        for i, hexdata in enumerate(hexdatas):
+            idx = start_idx + i
+            try:
+                data = bfh(hexdata)
+                state = self._verify_chunk(idx, data, state)
+            except BaseException as e:
+                self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
+                break
+            verified.append(data)
+            if len(data) < CHUNK_SIZE * HEADER_SIZE:
+                break  # only the last chunk can be partial
+        if not verified:
+            return 0
         try:
-            data = bfh(hexdata)
-            self.verify_chunk(idx, data)
-            self.save_chunk(idx, data)
-            return True
+            self.save_chunk(start_idx, b''.join(verified))
         except BaseException as e:
-            self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
-            return False
+            self.logger.info(f'save_chunk idx {start_idx} failed: {repr(e)}')
+            return 0
+        return len(verified)
 
     def get_checkpoints(self):
         # for each chunk, store the hash of the last block and the target after the chunk
@@ -704,9 +1238,61 @@ class Blockchain(Logger):
         return cp
 
 
+class DGWWindow:
+    """(timestamp, target) pairs of the last DGW_PAST_BLOCKS headers,
+    oldest first. Used to compute Dark Gravity Wave v3 targets
+    incrementally while walking consecutive headers.
+    """
+
+    def __init__(self):
+        self._items = deque(maxlen=DGW_PAST_BLOCKS)  # type: Deque[Tuple[int, int]]
+
+    def __len__(self):
+        return len(self._items)
+
+    def append_header(self, header: dict) -> None:
+        target = Blockchain.bits_to_target(header['bits'])
+        self._items.append((header['timestamp'], target))
+
+    def prepend_header(self, header: dict) -> None:
+        assert len(self._items) < DGW_PAST_BLOCKS
+        target = Blockchain.bits_to_target(header['bits'])
+        self._items.appendleft((header['timestamp'], target))
+
+    def get_target(self) -> int:
+        """Target of the header following the window."""
+        if len(self._items) < DGW_PAST_BLOCKS:
+            raise MissingHeader()
+        last_time, past_target_avg = self._items[-1]
+        count_blocks = 1
+        for reading_time, reading_target in reversed(self._items):
+            past_target_avg = (past_target_avg * count_blocks +
+                               reading_target) // (count_blocks + 1)
+            count_blocks += 1
+
+        new_target = past_target_avg
+        actual_timespan = last_time - reading_time
+        target_timespan = DGW_PAST_BLOCKS * POW_TARGET_SPACING
+
+        if actual_timespan < target_timespan // 3:
+            actual_timespan = target_timespan // 3
+        if actual_timespan > target_timespan * 3:
+            actual_timespan = target_timespan * 3
+
+        new_target *= actual_timespan
+        new_target //= target_timespan
+
+        if new_target > MAX_TARGET:
+            return MAX_TARGET
+
+        # not any target can be represented in 32 bits:
+        new_target = Blockchain.bits_to_target(Blockchain.target_to_bits(new_target))
+        return new_target
+
+
 def check_header(header: dict) -> Optional[Blockchain]:
     """Returns any Blockchain that contains header, or None."""
-    if type(header) is not dict:
+    if not isinstance(header, collections.abc.Mapping):
         return None
     with blockchains_lock: chains = list(blockchains.values())
     for b in chains:
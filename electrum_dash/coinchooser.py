@@ -26,10 +26,10 @@ import attr
 
 from collections import defaultdict
 from math import floor, log10
-from typing import NamedTuple, List, Callable, Optional, Sequence, Union, Dict, Tuple
+from typing import NamedTuple, List, Callable, Optional, Sequence, Union, Dict, Tuple, Set
 from decimal import Decimal
 
-from .bitcoin import sha256, COIN, is_address
+from .bitcoin import sha256, COIN, is_address, var_int
 from .dash_ps_util import PS_DENOMS_VALS, PSFeeTooHigh
 from .transaction import Transaction, TxOutput, PartialTransaction, PartialTxInput, PartialTxOutput
 from .util import NotEnoughFunds
@@ -400,18 +400,10 @@ class CoinChooserRandom(CoinChooserBase):
         candidates = [[buckets[n] for n in c] for c in candidates]
         return [strip_unneeded(c, sufficient_funds) for c in candidates]
 
-    def bucket_candidates_prefer_confirmed(self, buckets: List[Bucket],
-                                           sufficient_funds) -> List[List[Bucket]]:
-        """Returns a list of bucket sets preferring confirmed coins.
-
-        Any bucket can be:
-        1. "confirmed" if it only contains confirmed coins; else
-        2. "unconfirmed" if it does not contain coins with unconfirmed parents
-        3. other: e.g. "unconfirmed parent" or "local"
-
-        This method tries to only use buckets of type 1, and if the coins there
-        are not enough, tries to use the next type but while also selecting
-        all buckets of all previous types.
+    def bucket_sets_by_confirmation(self, buckets: List[Bucket]) -> List[List[Bucket]]:
+        """Splits buckets by the confirmation status of their coins,
+        the preferred ones first, see bucket_candidates_prefer_confirmed.
+        Buckets with PS coins come after the others.
         """
         conf_buckets = []
         unconf_buckets = []
@@ -433,8 +425,23 @@ class CoinChooserRandom(CoinChooserBase):
             elif bkt.min_height < 0 and bkt.max_rounds is not None:
                 ps_other_buckets.append(bkt)
 
-        bucket_sets = [conf_buckets, unconf_buckets, other_buckets,
-                       ps_conf_buckets, ps_unconf_buckets, ps_other_buckets]
+        return [conf_buckets, unconf_buckets, other_buckets,
+                ps_conf_buckets, ps_unconf_buckets, ps_other_buckets]
+
+    def bucket_candidates_prefer_confirmed(self, buckets: List[Bucket],
+                                           sufficient_funds) -> List[List[Bucket]]:
+        """Returns a list of bucket sets preferring confirmed coins.
+
+        Any bucket can be:
+        1. "confirmed" if it only contains confirmed coins; else
+        2. "unconfirmed" if it does not contain coins with unconfirmed parents
+        3. other: e.g. "unconfirmed parent" or "local"
+
+        This method tries to only use buckets of type 1, and if the coins there
+        are not enough, tries to use the next type but while also selecting
+        all buckets of all previous types.
+        """
+        bucket_sets = self.bucket_sets_by_confirmation(buckets)
         already_selected_buckets = []
         already_selected_buckets_value_sum = 0
 
@@ -480,49 +487,234 @@ class CoinChooserPrivacy(CoinChooserRandom):
     def keys(self, coins):
         return [coin.scriptpubkey.hex() for coin in coins]
 
+    def badness(self, buckets: List[Bucket], change: int, *,
+                min_change: float, max_change: float) -> float:
+        # Penalize using many buckets (~inputs)
+        badness = len(buckets) - 1
+        # Penalize change not roughly in output range
+        if change == 0:
+            pass  # no change is great!
+        elif change < min_change:
+            badness += (min_change - change) / (min_change + 10000)
+            # Penalize really small change; under 1 mBTC ~= using 1 more input
+            if change < COIN / 1000:
+                badness += 1
+        elif change > max_change:
+            badness += (change - max_change) / (max_change + 10000)
+            # Penalize large change; 5 BTC excess ~= using 1 more input
+            badness += change / (COIN * 5)
+        # Penalize using high max_rounds buckets
+        max_rounds_badness = 0
+        for b in buckets:
+            max_rounds = b.max_rounds
+            if max_rounds is not None and max_rounds > 0:
+                max_rounds_badness = max(max_rounds_badness,
+                                         max_rounds*1000)
+        badness += max_rounds_badness
+        return badness
+
     def penalty_func(self, base_tx, *, tx_from_buckets):
         min_change = min(o.value for o in base_tx.outputs()) * 0.75
         max_change = max(o.value for o in base_tx.outputs()) * 1.33
 
         def penalty(buckets: List[Bucket]) -> ScoredCandidate:
-            # Penalize using many buckets (~inputs)
-            badness = len(buckets) - 1
             tx, change_outputs = tx_from_buckets(buckets)
             change = sum(o.value for o in change_outputs)
-            # Penalize change not roughly in output range
-            if change == 0:
-                pass  # no change is great!
-            elif change < min_change:
-                badness += (min_change - change) / (min_change + 10000)
-                # Penalize really small change; under 1 mBTC ~= using 1 more input
-                if change < COIN / 1000:
-                    badness += 1
-            elif change > max_change:
-                badness += (change - max_change) / (max_change + 10000)
-                # Penalize large change; 5 BTC excess ~= using 1 more input
-                badness += change / (COIN * 5)
-            # Penalize using high max_rounds buckets
-            max_rounds_badness = 0
-            for b in buckets:
-                max_rounds = b.max_rounds
-                if max_rounds is not None and max_rounds > 0:
-                    max_rounds_badness = max(max_rounds_badness,
-                                             max_rounds*1000)
-            badness += max_rounds_badness
+            badness = self.badness(buckets, change,
+                                   min_change=min_change, max_change=max_change)
             return ScoredCandidate(badness, tx, buckets)
 
         return penalty
 
 
+class CoinChooserBranchAndBound(CoinChooserPrivacy):
+    """Coins of an address are spent together, as with Privacy.
+    First looks for a set of coins which pays for the outputs and fees
+    without leaving change, searching over the values of the coins, net
+    of the fees to spend them. Then compares it with random sets of coins
+    which need a change output, penalizing them as Privacy does.
+    """
+
+    # Maximum number of steps of the search for changeless sets of buckets,
+    # which keeps the search deterministic and bounded.
+    BNB_MAX_TRIES = 100000
+
+    def make_tx(self, *, coins: Sequence[PartialTxInput], inputs: List[PartialTxInput],
+                outputs: List[PartialTxOutput], change_addrs: Sequence[str],
+                fee_estimator_vb: Callable, dust_threshold: int,
+                tx_type=0, extra_payload=b'') -> PartialTransaction:
+        base_tx = PartialTransaction.from_io(inputs[:], outputs[:],
+                                             tx_type=tx_type,
+                                             extra_payload=extra_payload)
+
+        def fee_estimator_w(weight):
+            return fee_estimator_vb(Transaction.virtual_size_from_weight(weight))
+
+        # what is needed to score candidates without building their txs
+        if change_addrs:
+            change_addr = change_addrs[0]
+        elif inputs or coins:
+            # change is sent back to the first input address
+            change_addr = (inputs or coins)[0].address
+        else:
+            change_addr = None
+        if change_addr:
+            change_weight = 4 * Transaction.estimated_output_size_for_address(change_addr)
+        else:
+            change_weight = 0
+        self._input_value = base_tx.input_value()
+        self._spent_amount = base_tx.output_value()
+        self._base_weight = base_tx.estimated_weight()
+        self._change_weight = change_weight
+        self._fee_estimator_w = fee_estimator_w
+        self._dust_threshold = dust_threshold
+        return super().make_tx(coins=coins, inputs=inputs, outputs=outputs,
+                               change_addrs=change_addrs,
+                               fee_estimator_vb=fee_estimator_vb,
+                               dust_threshold=dust_threshold,
+                               tx_type=tx_type, extra_payload=extra_payload)
+
+    def change_of_buckets(self, buckets: Sequence[Bucket]) -> int:
+        """Estimates the change left by spending buckets, 0 if it is
+        below the dust threshold and is added to the fee instead."""
+        bucket_value_sum = sum(b.value for b in buckets)
+        weight = self._get_tx_weight(buckets, base_weight=self._base_weight)
+        change = (self._input_value + bucket_value_sum - self._spent_amount
+                  - self._fee_estimator_w(weight + self._change_weight))
+        return change if change >= self._dust_threshold else 0
+
+    def penalty_func(self, base_tx, *, tx_from_buckets):
+        min_change = min(o.value for o in base_tx.outputs()) * 0.75
+        max_change = max(o.value for o in base_tx.outputs()) * 1.33
+        # only the tx of the winning candidate is built, see choose_buckets
+        self._tx_from_buckets = tx_from_buckets
+
+        def penalty(buckets: List[Bucket]) -> ScoredCandidate:
+            change = self.change_of_buckets(buckets)
+            badness = self.badness(buckets, change,
+                                   min_change=min_change, max_change=max_change)
+            return ScoredCandidate(badness, None, buckets)
+
+        return penalty
+
+    def search_changeless(self, buckets: List[Bucket], target: int,
+                          cost_of_change: int) -> Optional[List[Bucket]]:
+        """Depth-first search for the set of buckets with a sum of effective
+        values in [target, target + cost_of_change), which spent together
+        leave no change. Returns the one with the least excess found within
+        BNB_MAX_TRIES steps, or None.
+        """
+        # shuffle first, so that buckets of same value are in a
+        # deterministic order which depends on the coins
+        buckets = buckets[:]
+        self.p.shuffle(buckets)
+        buckets.sort(key=lambda b: b.effective_value, reverse=True)
+        values = [b.effective_value for b in buckets]
+        n = len(values)
+        remaining = [0] * (n + 1)  # sum of values[i:]
+        for i in reversed(range(n)):
+            remaining[i] = remaining[i + 1] + values[i]
+        if remaining[0] < target:
+            return None
+        best = None
+        best_excess = None
+        selection = []  # indexes of included buckets
+        value = 0
+        i = 0  # next bucket to include or exclude
+        for _ in range(self.BNB_MAX_TRIES):
+            if value + remaining[i] < target or value >= target + cost_of_change:
+                backtrack = True
+            elif value >= target:
+                excess = value - target
+                if best is None or excess < best_excess:
+                    best = selection[:]
+                    best_excess = excess
+                    if excess == 0:
+                        break
+                backtrack = True
+            else:
+                backtrack = False
+            if backtrack:
+                if not selection:
+                    break  # searched everything
+                # exclude the last included bucket, and go on with the next
+                last = selection.pop()
+                value -= values[last]
+                i = last + 1
+            elif (i > 0 and values[i] == values[i - 1]
+                    and (not selection or selection[-1] != i - 1)):
+                # including it would repeat what was tried with the
+                # previous bucket of same value, which was excluded
+                i += 1
+            else:
+                selection.append(i)
+                value += values[i]
+                i += 1
+        if best is None:
+            return None
+        return [buckets[j] for j in best]
+
+    def choose_buckets(self, buckets, sufficient_funds, penalty_func):
+        already_selected_buckets = []
+        already_selected_buckets_value_sum = 0
+        for bkts_choose_from in self.bucket_sets_by_confirmation(buckets):
+            value_sum = sum(bucket.value for bucket in bkts_choose_from)
+            if sufficient_funds(already_selected_buckets + bkts_choose_from,
+                                bucket_value_sum=already_selected_buckets_value_sum + value_sum):
+                break
+            already_selected_buckets += bkts_choose_from
+            already_selected_buckets_value_sum += value_sum
+        else:
+            raise NotEnoughFunds()
+
+        def sfunds(bkts, *, bucket_value_sum):
+            bucket_value_sum += already_selected_buckets_value_sum
+            return sufficient_funds(already_selected_buckets + bkts,
+                                    bucket_value_sum=bucket_value_sum)
+
+        candidates = []
+        # effective value needed from bkts_choose_from, to pay for the
+        # outputs and the fee of the tx without inputs and change
+        target = (self._spent_amount - self._input_value
+                  + self._fee_estimator_w(self._base_weight)
+                  - sum(b.effective_value for b in already_selected_buckets))
+        cost_of_change = self._dust_threshold + (
+            self._fee_estimator_w(self._base_weight + self._change_weight)
+            - self._fee_estimator_w(self._base_weight))
+        changeless = self.search_changeless(bkts_choose_from, target, cost_of_change)
+        if changeless is not None and sfunds(changeless,
+                                             bucket_value_sum=sum(b.value for b in changeless)):
+            candidates.append(already_selected_buckets + changeless)
+        candidates += [already_selected_buckets + c
+                       for c in self.bucket_candidates_any(bkts_choose_from, sfunds)]
+        candidates = [strip_unneeded(c, sufficient_funds) for c in candidates]
+        scored_candidates = [penalty_func(cand) for cand in candidates]
+        winner = min(scored_candidates, key=lambda x: x.penalty)
+        self.logger.info(f"Total number of buckets: {len(buckets)}")
+        self.logger.info(f"Num candidates considered: {len(candidates)}. "
+                         f"Changeless found: {changeless is not None}. "
+                         f"Winning penalty: {winner.penalty}")
+        tx, change = self._tx_from_buckets(winner.buckets)
+        return winner._replace(tx=tx)
+
+
 @attr.s
 class PSTxCandidate:
-    tx = attr.ib(type=PartialTransaction)
+    coins = attr.ib(type=List[PartialTxInput])
     fee = attr.ib(type=int)
     estimated_fee = attr.ib(type=int)
     use_ps_rounds = attr.ib(type=int)
     use_repeated_txids = attr.ib(type=bool)
 
 
+class PSCoin(NamedTuple):
+    coin: PartialTxInput
+    value: int
+    ps_rounds: int
+    txid: str
+    size: int                     # estimated serialized input size
+
+
 class CoinChooserPrivateSend:
 
     def __init__(self, psman):
@@ -537,15 +729,29 @@ class CoinChooserPrivateSend:
                                 and x.value_sats() in PS_DENOMS_VALS, coins))
         if not all_coins:
             raise NotEnoughFunds()
+        ps_coins = [PSCoin(c, c.value_sats(), c.ps_rounds, c.prevout.txid.hex(),
+                           Transaction.estimated_input_weight(c) // 4)
+                    for c in all_coins]
+        # sorted once, in the order select_candidate_txs goes through them
+        by_value = sorted(range(len(ps_coins)),
+                          key=lambda i: ps_coins[i].value, reverse=True)
         max_rounds = max([c.ps_rounds for c in all_coins])
         txs = []
+        searched = set()
         use_repeated_txids = False
         use_ps_rounds = min_rounds
         while not (use_repeated_txids and use_ps_rounds > max_rounds):
-            coins = self.select_coins(all_coins, use_ps_rounds,
-                                      use_repeated_txids)
-            txs += self.select_candidate_txs(coins, base_tx, fee_estimator_vb,
-                                             use_ps_rounds, use_repeated_txids)
+            selected = self.select_coins(ps_coins, use_ps_rounds,
+                                         use_repeated_txids)
+            coins = tuple(i for i in by_value if i in selected)
+            # same coins give the same txs, which lose to the ones
+            # found with lower rounds or without repeated txids
+            if coins not in searched:
+                searched.add(coins)
+                txs += self.select_candidate_txs([ps_coins[i] for i in coins],
+                                                 base_tx, fee_estimator_vb,
+                                                 use_ps_rounds,
+                                                 use_repeated_txids)
             if use_ps_rounds <= max_rounds:
                 use_ps_rounds += 1
             if use_ps_rounds > max_rounds and not use_repeated_txids:
@@ -565,66 +771,80 @@ class CoinChooserPrivateSend:
                           x.fee - x.estimated_fee <= max_fee_overhead, txs))
         if not txs:
             raise PSFeeTooHigh(self.psman, fee)
-        return txs[0].tx
+        tx = PartialTransaction.from_io(base_tx.inputs()[:],
+                                        base_tx.outputs()[:],
+                                        tx_type=base_tx.tx_type,
+                                        extra_payload=base_tx.extra_payload)
+        tx.add_inputs(txs[0].coins)
+        return tx
 
-    def select_coins(self, coins, max_rounds, use_repeated_txids):
-        coins = list(filter(lambda x: x.ps_rounds <= max_rounds, coins))
-        if use_repeated_txids:
-            return coins
-        selected = []
-        used_txids = []
-        for c in coins:
-            txid = c.prevout.txid.hex()
-            if txid in used_txids:
+    def select_coins(self, coins: Sequence[PSCoin], max_rounds,
+                     use_repeated_txids) -> Set[int]:
+        """Returns the indexes of coins with ps_rounds <= max_rounds,
+        without the coins from txids seen before if not use_repeated_txids.
+        """
+        selected = set()
+        used_txids = set()
+        for i, c in enumerate(coins):
+            if c.ps_rounds > max_rounds:
                 continue
-            selected.append(c)
-            used_txids.append(txid)
+            if not use_repeated_txids:
+                if c.txid in used_txids:
+                    continue
+                used_txids.add(c.txid)
+            selected.add(i)
         return selected
 
-    def select_candidate_txs(self, coins, base_tx, fee_estimator_vb,
+    def select_candidate_txs(self, coins: Sequence[PSCoin], base_tx, fee_estimator_vb,
                              use_ps_rounds, use_repeated_txids):
+        """Goes through coins, sorted by value in descending order, and
+        returns the candidate txs spending the first coins and one more.
+        Tx sizes are the size of base_tx plus the sizes of inputs.
+        """
         spent_amount = base_tx.output_value()
-        selected = []
-        if sum([c.value_sats() for c in coins]) < spent_amount:
+        if sum([c.value for c in coins]) < spent_amount:
             return []
-        coins = sorted(coins, key=lambda x: x.value_sats(), reverse=True)
+        # base_tx has no inputs, so its inputs count takes one byte
+        base_size = base_tx.estimated_size() - 1
+        selected = []
         skip_value = 0
         inputs_val = 0
+        inputs_size = 0
         txs = []
         for c in coins:
-            val = c.value_sats()
+            val = c.value
             if val == skip_value:
                 continue
             if inputs_val + val <= spent_amount:
                 inputs_val += val
-                selected.append(c)
+                inputs_size += c.size
+                selected.append(c.coin)
                 continue
-            tx = PartialTransaction.from_io(base_tx.inputs()[:],
-                                            base_tx.outputs()[:],
-                                            tx_type=base_tx.tx_type,
-                                            extra_payload=base_tx.extra_payload)
-            tx.add_inputs(selected + [c])
-            input_value = tx.input_value()
-            estimated_fee = fee_estimator_vb(tx.estimated_size())
-            fee = input_value - spent_amount
+            num_inputs = len(selected) + 1
+            size = (base_size + len(var_int(num_inputs)) // 2
+                    + inputs_size + c.size)
+            estimated_fee = fee_estimator_vb(size)
+            fee = inputs_val + val - spent_amount
             if fee < estimated_fee:
                 inputs_val += val
-                selected.append(c)
+                inputs_size += c.size
+                selected.append(c.coin)
                 continue
             elif fee - estimated_fee >= PS_DENOMS_VALS[0]:
-                txs.append(PSTxCandidate(tx, fee, estimated_fee, use_ps_rounds,
-                                         use_repeated_txids))
+                txs.append(PSTxCandidate(selected + [c.coin], fee, estimated_fee,
+                                         use_ps_rounds, use_repeated_txids))
                 skip_value = val
                 continue
             else:
-                txs.append(PSTxCandidate(tx, fee, estimated_fee, use_ps_rounds,
-                                         use_repeated_txids))
+                txs.append(PSTxCandidate(selected + [c.coin], fee, estimated_fee,
+                                         use_ps_rounds, use_repeated_txids))
                 break
         return txs
 
 
 COIN_CHOOSERS = {
     'Privacy': CoinChooserPrivacy,
+    'BranchAndBound': CoinChooserBranchAndBound,
 }
 
 def get_name(config):
@@ -24,8 +24,10 @@
 # SOFTWARE.
 
 import os
-import gzip
 import json
+import mmap
+import struct
+from typing import Sequence, Tuple, List, Optional
 
 from .logging import get_logger
 from .util import inv_dict, all_subclasses
@@ -45,16 +47,102 @@ def read_json(filename, default):
     return r
 
 
-def read_json_gz(filename, default):
+# Binary checkpoints file:
+#   magic (4 bytes), number of checkpoints N (uint32)
+#   N records: block hash (32 bytes), target (32 bytes big endian)
+#   N offsets (uint32) of the extra headers blocks
+#   extra headers blocks: height of the first header (uint32),
+#       number of headers n (uint16), n raw headers (80 bytes each)
+#       at decreasing heights
+# All integers other than the target are little endian.
+CHECKPOINTS_MAGIC = b'DCP1'
+_CP_HEADER = struct.Struct('<4sI')
+_CP_RECORD_SIZE = 64
+_CP_OFFSET = struct.Struct('<I')
+_CP_BLOCK_HEADER = struct.Struct('<IH')
+_CP_HEADER_SIZE = 80
+
+
+class Checkpoints(Sequence):
+    """Read-only sequence of (hash, target, extra_headers) checkpoints,
+    backed by a memory mapped binary checkpoints file. Entries are only
+    decoded when accessed.
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = _CP_HEADER.unpack_from(self._data, 0)
+        if magic != CHECKPOINTS_MAGIC:
+            raise Exception(f'unexpected checkpoints file magic: {magic}')
+        self._offsets_start = _CP_HEADER.size + self._count * _CP_RECORD_SIZE
+        if len(self._data) < self._offsets_start + self._count * _CP_OFFSET.size:
+            raise Exception('checkpoints file is too short')
+
+    def __len__(self):
+        return self._count
+
+    def _check_index(self, index: int) -> int:
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('checkpoint index out of range')
+        return index
+
+    def get_hash(self, index: int) -> str:
+        index = self._check_index(index)
+        start = _CP_HEADER.size + index * _CP_RECORD_SIZE
+        return self._data[start:start+32].hex()
+
+    def get_target(self, index: int) -> int:
+        index = self._check_index(index)
+        start = _CP_HEADER.size + index * _CP_RECORD_SIZE + 32
+        return int.from_bytes(self._data[start:start+32], byteorder='big')
+
+    def get_raw_extra_headers(self, index: int) -> List[Tuple[int, bytes]]:
+        index = self._check_index(index)
+        offset, = _CP_OFFSET.unpack_from(self._data, self._offsets_start + index * _CP_OFFSET.size)
+        height, num = _CP_BLOCK_HEADER.unpack_from(self._data, offset)
+        start = offset + _CP_BLOCK_HEADER.size
+        return [(height - i, self._data[start + i*_CP_HEADER_SIZE : start + (i+1)*_CP_HEADER_SIZE])
+                for i in range(num)]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        extra_headers = [[height, raw.hex()] for height, raw in self.get_raw_extra_headers(index)]
+        return self.get_hash(index), self.get_target(index), extra_headers
+
+
+def serialize_checkpoints(checkpoints: Sequence) -> bytes:
+    """Serializes (hash, target, extra_headers) checkpoints in the
+    binary checkpoints format (see Checkpoints).
+    """
+    count = len(checkpoints)
+    records = []
+    offsets = []
+    blocks = []
+    offset = _CP_HEADER.size + count * (_CP_RECORD_SIZE + _CP_OFFSET.size)
+    for h, target, extra_headers in checkpoints:
+        records.append(bytes.fromhex(h) + target.to_bytes(32, byteorder='big'))
+        heights = [height for height, _ in extra_headers]
+        if heights and heights != list(range(heights[0], heights[0] - len(heights), -1)):
+            raise Exception('extra headers must be at consecutive decreasing heights')
+        block = _CP_BLOCK_HEADER.pack(heights[0] if heights else 0, len(heights))
+        block += b''.join(bytes.fromhex(raw) for _, raw in extra_headers)
+        offsets.append(_CP_OFFSET.pack(offset))
+        blocks.append(block)
+        offset += len(block)
+    return b''.join([_CP_HEADER.pack(CHECKPOINTS_MAGIC, count)] + records + offsets + blocks)
+
+
+def read_checkpoints(filename: str) -> Sequence:
     path = os.path.join(os.path.dirname(__file__), filename)
     try:
-        with gzip.open(path, 'rb') as f:
-            data = f.read()
-            r = json.loads(data.decode('utf-8'))
-    except:
-        _logger.info(f'file not found: {filename}')
-        r = default
-    return r
+        return Checkpoints(path)
+    except Exception as e:
+        _logger.info(f'cannot read checkpoints {filename}: {repr(e)}')
+        return []
 
 
 GIT_REPO_URL = "https://github.com/akhavr/electrum-dash"
@@ -94,7 +182,7 @@ class BitcoinMainnet(AbstractNet):
     GENESIS = "00000ffd590b1485b3caadc19b22e6379c733355108f107a430458cdf3407ab6"
     DEFAULT_PORTS = {'t': '50001', 's': '50002'}
     DEFAULT_SERVERS = read_json('servers.json', {})
-    CHECKPOINTS = read_json_gz('checkpoints.json.gz', [])
+    CHECKPOINTS = read_checkpoints('checkpoints.bin')
 
     XPRV_HEADERS = {
         'standard':    0x0488ade4,  # xprv
@@ -120,7 +208,7 @@ class BitcoinTestnet(AbstractNet):
     GENESIS = "00000bafbc94add76cb75e2ec92894837288a481e5c005f6563d91623bf8bc2c"
     DEFAULT_PORTS = {'t': '51001', 's': '51002'}
     DEFAULT_SERVERS = read_json('servers_testnet.json', {})
-    CHECKPOINTS = read_json_gz('checkpoints_testnet.json.gz', [])
+    CHECKPOINTS = read_checkpoints('checkpoints_testnet.bin')
 
     XPRV_HEADERS = {
         'standard':    0x04358394,  # tprv
@@ -46,6 +46,7 @@ from .util import log_exceptions, ignore_exceptions, randrange
 from .wallet import Wallet, Abstract_Wallet
 from .storage import WalletStorage
 from .wallet_db import WalletDB
+from .tx_store import get_tx_store_path
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
@@ -464,7 +465,7 @@ class Daemon(Logger):
                 return
             storage.decrypt(password)
         # read data, pass it to db
-        db = WalletDB(storage.read(), manual_upgrades=manual_upgrades)
+        db = WalletDB(storage.read(), manual_upgrades=manual_upgrades, storage=storage)
         if db.upgrade_done:
             storage.backup_old_version()
         if getattr(storage, 'backup_message', None):
@@ -503,6 +504,9 @@ class Daemon(Logger):
         self.stop_wallet(path)
         if os.path.exists(path):
             os.unlink(path)
+            tx_store_path = get_tx_store_path(path)
+            if os.path.exists(tx_store_path):
+                os.unlink(tx_store_path)
             return True
         return False
 
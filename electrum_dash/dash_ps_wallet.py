@@ -5,7 +5,6 @@ import copy
 import random
 import threading
 import time
-from collections import Counter
 from enum import IntEnum
 from math import floor, ceil
 
@@ -823,6 +822,7 @@ class PSDataMixin:
     def add_ps_denom(self, outpoint, denom):
         '''Add outpoint as ps_denom, denom data is (addr, value, rounds)'''
         self.wallet.db._add_ps_denom(outpoint, denom)
+        self.wallet.invalidate_addr_balances([denom[0]])
         self._ps_denoms_amount_cache += denom[1]
         if denom[2] < self.mix_rounds:  # if rounds < mix_rounds
             self._denoms_to_mix_cache[outpoint] = denom
@@ -831,18 +831,18 @@ class PSDataMixin:
         '''Pop outpoint from ps_denom'''
         denom = self.wallet.db._pop_ps_denom(outpoint)
         if denom:
+            self.wallet.invalidate_addr_balances([denom[0]])
             self._ps_denoms_amount_cache -= denom[1]
             self._denoms_to_mix_cache.pop(outpoint, None)
         return denom
 
     def calc_denoms_by_values(self):
         '''Calc and return dict: denom value => denoms count'''
-        denoms_values = [denom[1]
-                         for denom in self.wallet.db.get_ps_denoms().values()]
-        if not denoms_values:
+        denoms_count = self.wallet.db.get_ps_denoms_count_by_value()
+        if not denoms_count:
             return {}
         denoms_by_values = {denom_val: 0 for denom_val in PS_DENOMS_VALS}
-        denoms_by_values.update(Counter(denoms_values))
+        denoms_by_values.update(denoms_count)
         return denoms_by_values
 
     def add_ps_spending_denom(self, outpoint, wfl_uuid):
@@ -14,6 +14,7 @@ from electrum_dash.dash_ps_util import (PSPossibleDoubleSpendError,
                                         PSSpendToPSAddressesError, PSStates)
 from electrum_dash.storage import WalletStorage, StorageReadWriteError
 from electrum_dash.wallet_db import WalletDB
+from electrum_dash.tx_store import get_tx_store_path
 from electrum_dash.wallet import Wallet, InternalAddressCorruption, Abstract_Wallet
 from electrum_dash.wallet import update_password_for_directory
 
@@ -737,7 +738,7 @@ class ElectrumWindow(App, Logger):
             wizard.run('new')
         else:
             assert storage.is_past_initial_decryption()
-            db = WalletDB(storage.read(), manual_upgrades=False)
+            db = WalletDB(storage.read(), manual_upgrades=False, storage=storage)
             assert not db.requires_upgrade()
             if db.upgrade_done:
                 storage.backup_old_version()
@@ -1540,6 +1541,8 @@ class ElectrumWindow(App, Logger):
                 return
         self.stop_wallet()
         os.unlink(wallet_path)
+        if os.path.exists(get_tx_store_path(wallet_path)):
+            os.unlink(get_tx_store_path(wallet_path))
         self.show_error(_("Wallet removed: {}").format(basename))
         new_path = self.electrum_config.get_wallet_path(use_gui_last_wallet=True)
         self.load_wallet_by_name(new_path)
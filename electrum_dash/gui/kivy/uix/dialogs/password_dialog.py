@@ -392,7 +392,7 @@ class BaseOpenWalletDialog(AbstractPasswordDialog):
         else:
             # it is a bit wasteful load the wallet here and load it again in main_window,
             # but that is fine, because we are progressively enforcing storage encryption.
-            db = WalletDB(self.storage.read(), manual_upgrades=False)
+            db = WalletDB(self.storage.read(), manual_upgrades=False, storage=self.storage)
             if db.upgrade_done:
                 self.storage.backup_old_version()
                 self.app.show_backup_msg()
@@ -369,7 +369,7 @@ class ElectrumGui(Logger):
                     wizard.show_message(_('Saved unfinished multisig wallet'))
                     return
             else:
-                db = WalletDB(storage.read(), manual_upgrades=False)
+                db = WalletDB(storage.read(), manual_upgrades=False, storage=storage)
                 if db.upgrade_done:
                     storage.backup_old_version()
                 wizard.run_upgrades(storage, db)
@@ -3,7 +3,6 @@
 # file LICENCE or http://www.opensource.org/licenses/mit-license.php
 
 import os
-import json
 import sys
 import threading
 import traceback
@@ -19,6 +18,7 @@ from PyQt5.QtWidgets import (QWidget, QDialog, QLabel, QHBoxLayout, QMessageBox,
 
 from electrum_dash.wallet import Wallet, Abstract_Wallet
 from electrum_dash.storage import WalletStorage, StorageReadWriteError
+from electrum_dash.json_db import load_json_with_patches
 from electrum_dash.util import UserCancelled, InvalidPassword, WalletFileException, get_new_wallet_name
 from electrum_dash.base_wizard import (BaseWizard, HWD_SETUP_DECRYPT_WALLET,
                                        GoBack, ReRunDialog, SaveAndExit)
@@ -399,7 +399,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
-            self.data = json.loads(storage.read())
+            self.data = load_json_with_patches(storage.read())
             self.run(action)
             for k, v in self.data.items():
                 db.put(k, v)
@@ -53,7 +53,7 @@ class ElectrumGui:
             password = getpass.getpass('Password:', stream=None)
             storage.decrypt(password)
 
-        db = WalletDB(storage.read(), manual_upgrades=False)
+        db = WalletDB(storage.read(), manual_upgrades=False, storage=storage)
         if db.upgrade_done:
             storage.backup_old_version()
         if db.check_unfinished_multisig():
@@ -182,6 +182,29 @@ class NotificationSession(RPCSession):
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    async def send_batch_request(self, requests: Sequence[Tuple[str, List]], *, timeout=None) -> List[Any]:
+        """Sends the (method, params) requests as one JSON-RPC batch.
+        Returns the results in the order of the requests, with the
+        error of each failed request in place of its result.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch {list(requests)} (id: {msg_id})")
+
+        async def send_batch():
+            async with self.send_batch() as batch:
+                for method, params in requests:
+                    batch.add_request(method, params)
+            return batch.results
+        try:
+            results = await asyncio.wait_for(send_batch(), timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            raise RequestTimedOut(f'batch request timed out (id: {msg_id})') from e
+        except CodeMessageError as e:
+            self.maybe_log(f"--> {repr(e)} (id: {msg_id})")
+            raise
+        self.maybe_log(f"--> {results} (id: {msg_id})")
+        return list(results)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -374,6 +397,9 @@ class Interface(Logger):
 
         self.fee_estimates_eta = {}  # type: Dict[int, int]
 
+        # cleared if the server does not answer batch requests
+        self.supports_batch_requests = True
+
         # Dump network messages (only for this interface).  Set at runtime from the console.
         self.debug = False
 
@@ -598,15 +624,139 @@ class Interface(Logger):
         if can_return_early and index in self._requested_chunks:
             return
         self.logger.info(f"requesting chunk from height {height}")
-        size = 2016
-        if tip is not None:
-            size = min(size, tip - index * 2016 + 1)
-            size = max(size, 0)
         try:
             self._requested_chunks.add(index)
-            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
+            hexdata = await self._fetch_chunk(index, tip)
         finally:
             self._requested_chunks.discard(index)
+        # verifying hashes the headers, which blocks: done in a thread
+        conn = await asyncio.get_event_loop().run_in_executor(
+            None, self.blockchain.connect_chunk, index, hexdata)
+        if not conn:
+            return conn, 0
+        return conn, len(hexdata) // (HEADER_SIZE * 2)
+
+    async def request_chunks(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Pipelined variant of request_chunk for catching up from height to tip.
+        Keeps several chunk requests in flight, spread over the connected
+        servers, and connects the chunks in order, saving consecutive
+        chunks that arrived with a single write.
+        Returns whether any chunk could be connected and the number of
+        headers connected, counted from the start of the chunk at height.
+        """
+        if not is_non_negative_integer(height):
+            raise Exception(f"{repr(height)} is not a block height")
+        first_index = height // 2016
+        last_index = tip // 2016
+        max_in_flight = max(1, self.network.config.get('header_chunks_in_flight', 4))
+        interfaces = self._get_interfaces_for_chunks(tip)
+        self.logger.info(f"requesting chunks from height {height} to {tip}, "
+                         f"using {len(interfaces)} server(s)")
+
+        async def fetch(index: int, iface: 'Interface') -> Tuple['Interface', str]:
+            if iface is not self:
+                try:
+                    return iface, await iface._fetch_chunk(index, tip)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.info(f"failed to get chunk {index} from {iface.server}: {repr(e)}")
+            return self, await self._fetch_chunk(index, tip)
+
+        tasks = {}  # type: Dict[int, asyncio.Future]
+        next_index = first_index
+        num_headers = 0
+        try:
+            while next_index <= last_index or tasks:
+                while next_index <= last_index and len(tasks) < max_in_flight:
+                    iface = interfaces[(next_index - first_index) % len(interfaces)]
+                    tasks[next_index] = asyncio.ensure_future(fetch(next_index, iface))
+                    self._requested_chunks.add(next_index)
+                    next_index += 1
+                # connect chunks in order; wait for the lowest one,
+                # then take all the consecutive ones that arrived as well
+                index = min(tasks)
+                await asyncio.wait([tasks[index]])
+                batch = []  # type: List[Tuple[Interface, str]]
+                while index in tasks and tasks[index].done():
+                    batch.append(tasks.pop(index).result())
+                    self._requested_chunks.discard(index)
+                    index += 1
+                start_index = index - len(batch)
+                if any(source is not self for source, _ in batch):
+                    batch = await self._check_chunks_from_other_servers(start_index, batch, tip)
+                num_connected = await asyncio.get_event_loop().run_in_executor(
+                    None, self.blockchain.connect_chunks, start_index, [hexdata for _, hexdata in batch])
+                num_headers += sum(len(hexdata) for _, hexdata in batch[:num_connected]) // (HEADER_SIZE * 2)
+                if num_connected == len(batch):
+                    util.trigger_callback('network_updated')
+                    continue
+                failed_index = start_index + num_connected
+                source, _ = batch[num_connected]
+                if source is self:
+                    break
+                # the other server might be on a different chain; retry with ours
+                self.logger.info(f"chunk {failed_index} from {source.server} did not connect, "
+                                 f"requesting it from main server")
+                conn, count = await self.request_chunk(failed_index * 2016, tip)
+                if not conn:
+                    break
+                num_headers += count
+                util.trigger_callback('network_updated')
+                # put the rest of the batch back, refetching what came from the other server
+                for index, (source_, hexdata) in enumerate(batch[num_connected+1:], start=failed_index+1):
+                    if source_ is source:
+                        tasks[index] = asyncio.ensure_future(fetch(index, self))
+                    else:
+                        tasks[index] = asyncio.get_event_loop().create_future()
+                        tasks[index].set_result((source_, hexdata))
+                    self._requested_chunks.add(index)
+        finally:
+            for index, task in tasks.items():
+                task.cancel()
+                self._requested_chunks.discard(index)
+        return num_headers > 0, num_headers
+
+    async def _check_chunks_from_other_servers(
+            self, start_index: int, batch: List[Tuple['Interface', str]], tip: int,
+    ) -> List[Tuple['Interface', str]]:
+        """Chunks are only checked for PoW and linkage when connected.
+        The consecutive chunks are kept if the last header from another
+        server is the one of this server at that height, as the headers
+        before it link up to it; otherwise the chunks from other servers
+        are fetched again from this server.
+        """
+        last = max(i for i, (source, _) in enumerate(batch) if source is not self)
+        num_headers = sum(len(hexdata) for _, hexdata in batch[:last+1]) // (HEADER_SIZE * 2)
+        tip_height = start_index * 2016 + num_headers - 1
+        header = await self.get_block_header(tip_height, 'catchup')
+        if blockchain.serialize_header(header) == batch[last][1][-HEADER_SIZE * 2:].lower():
+            return batch
+        self.logger.info(f"chunks {start_index} to {start_index + len(batch) - 1} from other servers "
+                         f"are not on the chain of the main server, requesting them from it")
+        return [(source, hexdata) if source is self else (self, await self._fetch_chunk(index, tip))
+                for index, (source, hexdata) in enumerate(batch, start=start_index)]
+
+    def _get_interfaces_for_chunks(self, tip: int) -> List['Interface']:
+        interfaces = [self]
+        if not self.network.config.get('header_sync_multi_server', True):
+            return interfaces
+        with self.network.interfaces_lock:
+            others = list(self.network.interfaces.values())
+        for iface in others:
+            if iface is self or iface.tip < tip:
+                continue
+            if not iface.session or iface.session.is_closing():
+                continue
+            interfaces.append(iface)
+        return interfaces
+
+    async def _fetch_chunk(self, index: int, tip=None) -> str:
+        size = 2016
+        if tip is not None:
+            size = min(size, tip - index * 2016 + 1)
+            size = max(size, 0)
+        res = await self.session.send_request('blockchain.block.headers', [index * 2016, size])
         assert_dict_contains_field(res, field_name='count')
         assert_dict_contains_field(res, field_name='hex')
         assert_dict_contains_field(res, field_name='max')
@@ -620,10 +770,7 @@ class Interface(Logger):
             raise RequestCorrupted(f"server uses too low 'max' count for block.headers: {res['max']} < 2016")
         if res['count'] != size:
             raise RequestCorrupted(f"expected {size} headers but only got {res['count']}")
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+        return res['hex']
 
     def is_main_server(self) -> bool:
         return (self.network.interface == self or
@@ -758,7 +905,10 @@ class Interface(Logger):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if next_height // 2016 > height // 2016:
+                    could_connect, num_headers = await self.request_chunks(height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
@@ -933,7 +1083,27 @@ class Interface(Logger):
             raise Exception(f"{repr(tx_height)} is not a block height")
         # do request
         res = await self.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
-        # check response
+        self._check_merkle(res)
+        return res
+
+    async def get_merkles_for_transactions(self, tx_hashes: Sequence[str],
+                                           tx_height: int) -> List[Union[dict, CodeMessageError]]:
+        """Requests the merkle branches of txs in the same block in a batch.
+        Returns the branch, or the error of the server, of each txid.
+        """
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        if not is_non_negative_integer(tx_height):
+            raise Exception(f"{repr(tx_height)} is not a block height")
+        res = await self._send_batch_request([('blockchain.transaction.get_merkle', [tx_hash, tx_height])
+                                              for tx_hash in tx_hashes])
+        for merkle in res:
+            if not isinstance(merkle, CodeMessageError):
+                self._check_merkle(merkle)
+        return res
+
+    def _check_merkle(self, res) -> None:
         block_height = assert_dict_contains_field(res, field_name='block_height')
         merkle = assert_dict_contains_field(res, field_name='merkle')
         pos = assert_dict_contains_field(res, field_name='pos')
@@ -943,13 +1113,54 @@ class Interface(Logger):
         assert_list_or_tuple(merkle)
         for item in merkle:
             assert_hash256_str(item)
-        return res
+
+    async def _send_batch_request(self, requests: Sequence[Tuple[str, List]]) -> List[Any]:
+        """Like NotificationSession.send_batch_request, but the requests
+        are sent one by one if the server does not support batches.
+        """
+        if self.supports_batch_requests and len(requests) > 1:
+            try:
+                return await self.session.send_batch_request(requests)
+            except (RequestTimedOut, CodeMessageError) as e:
+                self.logger.info(f"batch request failed, sending requests one by one: {repr(e)}")
+                if (isinstance(e, CodeMessageError)
+                        and e.code in (JSONRPC.PARSE_ERROR, JSONRPC.INVALID_REQUEST)):
+                    # the server does not understand batches
+                    self.supports_batch_requests = False
+        results = [None] * len(requests)  # type: List[Any]
+
+        async def send_request(i, method, params):
+            try:
+                results[i] = await self.session.send_request(method, params)
+            except CodeMessageError as e:
+                results[i] = e
+        async with TaskGroup() as group:
+            for i, (method, params) in enumerate(requests):
+                await group.spawn(send_request(i, method, params))
+        return results
 
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
         raw = await self.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
-        # validate response
+        self._check_transaction(tx_hash, raw)
+        return raw
+
+    async def get_transactions(self, tx_hashes: Sequence[str]) -> List[Union[str, CodeMessageError]]:
+        """Requests the transactions in a batch. Returns the raw tx, or
+        the error of the server (e.g. tx not found), of each txid.
+        """
+        for tx_hash in tx_hashes:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+        res = await self._send_batch_request([('blockchain.transaction.get', [tx_hash])
+                                              for tx_hash in tx_hashes])
+        for tx_hash, raw in zip(tx_hashes, res):
+            if not isinstance(raw, CodeMessageError):
+                self._check_transaction(tx_hash, raw)
+        return res
+
+    def _check_transaction(self, tx_hash: str, raw) -> None:
         if not is_hex_str(raw):
             raise RequestCorrupted(f"received garbage (non-hex) as tx data (txid {tx_hash}): {raw!r}")
         tx = Transaction(raw)
@@ -959,14 +1170,29 @@ class Interface(Logger):
             raise RequestCorrupted(f"cannot deserialize received transaction (txid {tx_hash})") from e
         if tx.txid() != tx_hash:
             raise RequestCorrupted(f"received tx does not match expected txid {tx_hash} (got {tx.txid()})")
-        return raw
 
     async def get_history_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
             raise Exception(f"{repr(sh)} is not a scripthash")
         # do request
         res = await self.session.send_request('blockchain.scripthash.get_history', [sh])
-        # check response
+        self._check_history(sh, res)
+        return res
+
+    async def get_histories_for_scripthashes(self, shs: Sequence[str]) -> List[List[dict]]:
+        """Requests the histories in a batch."""
+        for sh in shs:
+            if not is_hash256_str(sh):
+                raise Exception(f"{repr(sh)} is not a scripthash")
+        res = await self._send_batch_request([('blockchain.scripthash.get_history', [sh])
+                                              for sh in shs])
+        for sh, hist in zip(shs, res):
+            if isinstance(hist, CodeMessageError):
+                raise hist
+            self._check_history(sh, hist)
+        return res
+
+    def _check_history(self, sh: str, res) -> None:
         assert_list_or_tuple(res)
         prev_height = 1
         for tx_item in res:
@@ -989,7 +1215,6 @@ class Interface(Logger):
             # a recently mined tx could be included in both last block and mempool?
             # Still, it's simplest to just disregard the response.
             raise RequestCorrupted(f"server history has non-unique txids for sh={sh}")
-        return res
 
     async def listunspent_for_scripthash(self, sh: str) -> List[dict]:
         if not is_hash256_str(sh):
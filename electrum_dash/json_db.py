@@ -25,9 +25,13 @@
 import threading
 import copy
 import json
+from typing import List, Optional, Sequence, Tuple
 
 from . import util
-from .logging import Logger
+from .logging import Logger, get_logger
+
+
+_logger = get_logger(__name__)
 
 JsonDBJsonEncoder = util.MyEncoder
 
@@ -45,17 +49,113 @@ def locked(func):
     return wrapper
 
 
+def key_path(path: Sequence[str], key: Optional[str]) -> str:
+    """Returns the JSON pointer of 'key' in the container at 'path'."""
+    items = list(path) if key is None else list(path) + [key]
+    return ''.join('/' + str(x).replace('~', '~0').replace('/', '~1')
+                   for x in items)
+
+
+def apply_patch(data, patch: dict):
+    """Applies a change record written by JsonDB.add_patch to the
+    plain json data, and returns the data.
+    """
+    keys = [k.replace('~1', '/').replace('~0', '~')
+            for k in patch['path'].split('/')[1:]]
+    op = patch['op']
+    if not keys:
+        if op != 'replace':
+            raise Exception(f'unexpected patch: {patch!r}')
+        return patch['value']
+    parent = data
+    for k in keys[:-1]:
+        parent = parent[int(k)] if isinstance(parent, list) else parent[k]
+    key = keys[-1]
+    if isinstance(parent, list):
+        if op == 'add' and key == '-':
+            parent.append(patch['value'])
+        elif op == 'add':
+            parent.insert(int(key), patch['value'])
+        elif op == 'replace':
+            parent[int(key)] = patch['value']
+        elif op == 'remove':
+            del parent[int(key)]
+        else:
+            raise Exception(f'unexpected patch: {patch!r}')
+    elif op in ('add', 'replace'):
+        parent[key] = patch['value']
+    elif op == 'remove':
+        parent.pop(key, None)
+    else:
+        raise Exception(f'unexpected patch: {patch!r}')
+    return data
+
+
+def parse_json_with_patches(s: str) -> Tuple[dict, bool]:
+    """Parses a json document followed by the change records appended
+    to it (see WalletDB._append_pending_changes). An unparsable last
+    record is the remainder of an interrupted append, it is dropped.
+    Returns the data and whether a record was dropped.
+    """
+    try:
+        items = json.loads('[' + s + ']')
+        torn = False
+    except json.JSONDecodeError:
+        items, torn = _load_complete_records(s)
+    if not items:
+        raise ValueError('empty document')
+    data = items[0]
+    for patch in items[1:]:
+        data = apply_patch(data, patch)
+    return data, torn
+
+
+def load_json_with_patches(s: str):
+    return parse_json_with_patches(s)[0]
+
+
+def _load_complete_records(s: str) -> Tuple[list, bool]:
+    decoder = json.JSONDecoder()
+    # the document itself is written at once, it must be complete
+    item, pos = decoder.raw_decode(s, _skip_ws(s, 0))
+    items = [item]
+    while True:
+        pos = _skip_ws(s, pos)
+        if pos == len(s):
+            return items, False
+        if s[pos] != ',':
+            break
+        try:
+            item, pos = decoder.raw_decode(s, _skip_ws(s, pos + 1))
+        except json.JSONDecodeError:
+            break
+        items.append(item)
+    _logger.warning(f'dropping incomplete change record at offset {pos}')
+    return items, True
+
+
+def _skip_ws(s: str, pos: int) -> int:
+    while pos < len(s) and s[pos] in ' \t\n\r':
+        pos += 1
+    return pos
+
+
 class StoredObject:
 
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
-        if self.db:
-            self.db.set_modified(True)
         object.__setattr__(self, key, value)
+        if self.db:
+            if self._path is not None:
+                self.db.add_patch({'op': 'replace', 'path': key_path(self._path, None), 'value': self})
+            else:
+                self.db.set_modified(True)
 
-    def set_db(self, db):
-        self.db = db
+    def set_db(self, db, path=None):
+        object.__setattr__(self, 'db', db)
+        object.__setattr__(self, '_path', path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -74,9 +174,16 @@ class StoredDict(dict):
         self.db = db
         self.lock = self.db.lock if self.db else threading.RLock()
         self.path = path
-        # recursively convert dicts to StoredDict
+        # nested dicts and lists are converted on first access,
+        # so that loading a large db does not walk all of it
+        self._lazy_keys = set()
         for k, v in list(data.items()):
-            self.__setitem__(k, v)
+            if type(v) in (dict, list):
+                k = self.convert_key(k)
+                dict.__setitem__(self, k, v)
+                self._lazy_keys.add(k)
+            else:
+                self.__setitem__(k, v, patch=False)
 
     def convert_key(self, key):
         """Convert int keys to str keys, as only those are allowed in json."""
@@ -86,18 +193,26 @@ class StoredDict(dict):
         return str(int(key)) if isinstance(key, int) else key
 
     @locked
-    def __setitem__(self, key, v):
+    def __setitem__(self, key, v, patch=True):
         key = self.convert_key(key)
         is_new = key not in self
         # early return to prevent unnecessary disk writes
         if not is_new and self[key] == v:
             return
+        v = self._convert(key, v)
+        # set item
+        dict.__setitem__(self, key, v)
+        if self.db and patch:
+            op = 'add' if is_new else 'replace'
+            self.db.add_patch({'op': op, 'path': key_path(self.path, key), 'value': v})
+
+    def _convert(self, key, v):
         # recursively set db and path
         if isinstance(v, StoredDict):
             v.db = self.db
             v.path = self.path + [key]
             for k, vv in v.items():
-                v[k] = vv
+                v.__setitem__(k, vv, patch=False)
         # recursively convert dict to StoredDict.
         # _convert_dict is called breadth-first
         elif isinstance(v, dict):
@@ -111,22 +226,38 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
-        # set item
+            v.set_db(self.db, self.path + [key])
+        # track changes of lists and sets
+        if isinstance(v, list):
+            v = StoredList(v, self.db, self.path + [key])
+        elif isinstance(v, set):
+            v = StoredSet(v, self.db, self.path + [key])
+        return v
+
+    def _materialize(self, key):
+        """Converts the value of key left as loaded by __init__."""
+        self._lazy_keys.discard(key)
+        v = self._convert(key, dict.__getitem__(self, key))
         dict.__setitem__(self, key, v)
-        if self.db:
-            self.db.set_modified(True)
+        return v
+
+    def _materialize_all(self):
+        for key in list(self._lazy_keys):
+            self._materialize(key)
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
+        self._lazy_keys.discard(key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch({'op': 'remove', 'path': key_path(self.path, key)})
 
     @locked
     def __getitem__(self, key):
         key = self.convert_key(key)
+        if key in self._lazy_keys:
+            return self._materialize(key)
         return dict.__getitem__(self, key)
 
     @locked
@@ -137,20 +268,286 @@ class StoredDict(dict):
     @locked
     def pop(self, key, v=_RaiseKeyError):
         key = self.convert_key(key)
-        if v is _RaiseKeyError:
-            r = dict.pop(self, key)
-        else:
-            r = dict.pop(self, key, v)
+        if key not in self:
+            if v is _RaiseKeyError:
+                raise KeyError(key)
+            return v
+        if key in self._lazy_keys:
+            self._materialize(key)
+        r = dict.pop(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.add_patch({'op': 'remove', 'path': key_path(self.path, key)})
         return r
 
     @locked
     def get(self, key, default=None):
         key = self.convert_key(key)
+        if key in self._lazy_keys:
+            return self._materialize(key)
         return dict.get(self, key, default)
 
+    # the methods below would expose values not converted yet
+
+    @locked
+    def items(self):
+        self._materialize_all()
+        return dict.items(self)
+
+    @locked
+    def values(self):
+        self._materialize_all()
+        return dict.values(self)
+
+    def __iter__(self):
+        # also makes dict(self) use __getitem__
+        return dict.__iter__(self)
+
+    @locked
+    def copy(self):
+        return dict(self.items())
+
+    @locked
+    def popitem(self):
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    @locked
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.__setitem__(key, default)
+        return self[key]
+
+    @locked
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self.__setitem__(k, v)
+
+    @locked
+    def clear(self):
+        if not self:
+            return
+        dict.clear(self)
+        self._lazy_keys.clear()
+        if self.db:
+            self.db.add_patch({'op': 'replace', 'path': key_path(self.path, None), 'value': {}})
+
+
+class StoredList(list):
+    """A list stored in a StoredDict. Changes are recorded as patches.
+    Lists and dicts nested in it are tracked too, their changes replace
+    the whole list.
+    """
+
+    def __init__(self, data, db, path, *, root: 'StoredList' = None):
+        self.db = db
+        self.lock = self.db.lock if self.db else threading.RLock()
+        self.path = path
+        self.root = root  # the list stored at path, if nested in it
+        list.__init__(self, (self._track(x) for x in data))
+
+    def _track(self, item):
+        if isinstance(item, list):
+            return StoredList(item, self.db, self.path, root=self.root or self)
+        if isinstance(item, dict):
+            return _NestedDict(item, self.root or self)
+        return item
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(x, memo) for x in self]
+
+    def _add_patch(self, op, index=None, value=None):
+        if not self.db:
+            return
+        if self.root is not None:
+            self.root._add_patch('replace')
+            return
+        if index is None:  # the whole list changed
+            op, path, value = 'replace', key_path(self.path, None), list(self)
+        else:
+            path = key_path(self.path, str(index))
+        patch = {'op': op, 'path': path}
+        if op != 'remove':
+            patch['value'] = value
+        self.db.add_patch(patch)
+
+    @locked
+    def append(self, item):
+        item = self._track(item)
+        list.append(self, item)
+        self._add_patch('add', '-', item)
+
+    @locked
+    def insert(self, index, item):
+        item = self._track(item)
+        list.insert(self, index, item)
+        if 0 <= index < len(self) - 1:
+            self._add_patch('add', index, item)
+        else:
+            self._add_patch('replace')
+
+    @locked
+    def pop(self, index=-1):
+        r = list.pop(self, index)
+        self._add_patch('remove', index if index >= 0 else len(self) + 1 + index)
+        return r
+
+    @locked
+    def remove(self, item):
+        index = self.index(item)
+        list.remove(self, item)
+        self._add_patch('remove', index)
+
+    @locked
+    def __setitem__(self, index, item):
+        if isinstance(index, int):
+            item = self._track(item)
+        else:
+            item = [self._track(x) for x in item]
+        list.__setitem__(self, index, item)
+        if isinstance(index, int):
+            self._add_patch('replace', index if index >= 0 else len(self) + index, item)
+        else:
+            self._add_patch('replace')
+
+    @locked
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._add_patch('replace')
+
+    @locked
+    def __iadd__(self, other):
+        list.__iadd__(self, [self._track(x) for x in other])
+        self._add_patch('replace')
+        return self
+
+    @locked
+    def extend(self, items):
+        list.extend(self, [self._track(x) for x in items])
+        self._add_patch('replace')
+
+    @locked
+    def clear(self):
+        list.clear(self)
+        self._add_patch('replace')
+
+    @locked
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._add_patch('replace')
+
+    @locked
+    def reverse(self):
+        list.reverse(self)
+        self._add_patch('replace')
+
+
+class _NestedDict(dict):
+    """A dict nested in a StoredList. Changes replace the whole list."""
+
+    def __init__(self, data, root: StoredList):
+        self.root = root
+        dict.__init__(self, ((k, root._track(v)) for k, v in data.items()))
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def _changed(self):
+        with self.root.lock:
+            self.root._add_patch('replace')
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self.root._track(value))
+        self._changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed()
+
+    def pop(self, key, *args):
+        r = dict.pop(self, key, *args)
+        self._changed()
+        return r
+
+    def popitem(self):
+        r = dict.popitem(self)
+        self._changed()
+        return r
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            dict.__setitem__(self, k, self.root._track(v))
+        self._changed()
 
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+
+class StoredSet(set):
+    """A set stored in a StoredDict, written as a list. Additions are
+    recorded as patches, removals replace the whole list.
+    """
+
+    def __init__(self, data, db, path):
+        set.__init__(self, data)
+        self.db = db
+        self.lock = self.db.lock if self.db else threading.RLock()
+        self.path = path
+
+    def __deepcopy__(self, memo):
+        return {copy.deepcopy(x, memo) for x in self}
+
+    def _add_patch(self, item=None):
+        if not self.db:
+            return
+        if item is not None:
+            patch = {'op': 'add', 'path': key_path(self.path, '-'), 'value': item}
+        else:
+            patch = {'op': 'replace', 'path': key_path(self.path, None), 'value': list(self)}
+        self.db.add_patch(patch)
+
+    @locked
+    def add(self, item):
+        if item in self:
+            return
+        set.add(self, item)
+        self._add_patch(item)
+
+    @locked
+    def discard(self, item):
+        if item not in self:
+            return
+        set.discard(self, item)
+        self._add_patch()
+
+    @locked
+    def remove(self, item):
+        set.remove(self, item)
+        self._add_patch()
+
+    @locked
+    def pop(self):
+        r = set.pop(self)
+        self._add_patch()
+        return r
+
+    @locked
+    def update(self, *others):
+        for other in others:
+            for item in other:
+                self.add(item)
+
+    @locked
+    def clear(self):
+        if not self:
+            return
+        set.clear(self)
+        self._add_patch()
 
 
 class JsonDB(Logger):
@@ -160,14 +557,29 @@ class JsonDB(Logger):
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        # change records not yet written, and whether there are also
+        # changes not covered by them (then the whole db is written)
+        self.pending_changes = []  # type: List[str]
+        self._needs_full_write = False
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
+            self._needs_full_write = b
+            if not b:
+                self.pending_changes = []
 
     def modified(self):
         return self._modified
 
+    def add_patch(self, patch: dict) -> None:
+        with self.lock:
+            self.pending_changes.append(json.dumps(patch, cls=JsonDBJsonEncoder))
+            self._modified = True
+
+    def needs_full_write(self) -> bool:
+        return self._needs_full_write
+
     @locked
     def get(self, key, default=None):
         v = self.data.get(key)
@@ -183,8 +595,18 @@ class JsonDB(Logger):
         except:
             self.logger.info(f"json error: cannot save {repr(key)} ({repr(value)})")
             return False
+        if not isinstance(self.data, StoredDict):
+            # changes are only recorded once the data is loaded
+            self._needs_full_write = True
+        old_value = self.data.get(key)
         if value is not None:
-            if self.data.get(key) != value:
+            if type(old_value) is dict and isinstance(self.data, StoredDict):
+                # plain dicts (e.g. keystores) are changed in place, so
+                # comparing with value would not reveal the change
+                self.data.__setitem__(key, copy.deepcopy(value), patch=False)
+                self.add_patch({'op': 'replace', 'path': key_path([], key), 'value': value})
+                return old_value != value
+            if old_value != value:
                 self.data[key] = copy.deepcopy(value)
                 return True
         elif key in self.data:
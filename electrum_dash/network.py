@@ -32,7 +32,8 @@ import socket
 import json
 import sys
 import asyncio
-from typing import NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any
+from typing import (NamedTuple, Optional, Sequence, List, Dict, Tuple, TYPE_CHECKING, Iterable, Set, Any,
+                    Union)
 import traceback
 import concurrent
 from concurrent import futures
@@ -889,6 +890,14 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     async def get_merkle_for_transaction(self, tx_hash: str, tx_height: int) -> dict:
         return await self.interface.get_merkle_for_transaction(tx_hash=tx_hash, tx_height=tx_height)
 
+    @best_effort_reliable
+    async def get_merkles_for_transactions(self, tx_hashes: Sequence[str],
+                                           tx_height: int) -> List[Union[dict, UntrustedServerReturnedError]]:
+        res = await self.interface.get_merkles_for_transactions(tx_hashes=tx_hashes, tx_height=tx_height)
+        return [UntrustedServerReturnedError(original_exception=r)
+                if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in res]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
         if timeout is None:
@@ -1368,10 +1377,16 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     def export_checkpoints(self, path):
         """Run manually to generate blockchain checkpoints.
         Kept for console use only.
+        Paths ending with '.bin' get the binary checkpoints format
+        that is shipped, anything else gets json.
         """
         cp = self.blockchain().get_checkpoints()
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(cp, indent=4))
+        if path.endswith('.bin'):
+            with open(path, 'wb') as f:
+                f.write(constants.serialize_checkpoints(cp))
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(cp, indent=4))
 
     async def _start(self):
         assert not self.taskgroup
@@ -1430,6 +1445,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interface = None
         self.interfaces = {}
         self._connecting_ifaces.clear()
+        blockchain.sync_headers_files()
+        blockchain.write_forks_index(self.config)
+        if full_shutdown:
+            blockchain.shutdown_pow_hash_executor()
         self._closing_ifaces.clear()
         if not full_shutdown:
             util.trigger_callback('network_updated')
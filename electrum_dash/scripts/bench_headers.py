@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# Benchmarks the header verification hot paths of blockchain.py.
+#
+# Recorded mainnet headers are the ones shipped with the checkpoints
+# (the last headers of every retarget period). As mainnet chunks can not
+# be verified without downloading them, verify_chunk, read_header and
+# get_target_dgw_v3 run on a synthetic regtest chain past the DGW v3
+# activation height. On regtest, verify_header does not compare bits and
+# proof of work, everything else (hashing, deserialization, linking,
+# DGW targets) is the same as on mainnet.
+#
+# usage: python3 -m electrum_dash.scripts.bench_headers [--chunks N] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from electrum_dash import blockchain, constants, x11hash
+from electrum_dash.blockchain import (Blockchain, CHUNK_SIZE, HEADER_SIZE, POW_DGW3_HEIGHT,
+                                      deserialize_header, hash_header, hash_headers,
+                                      serialize_header)
+from electrum_dash.simple_config import SimpleConfig
+from electrum_dash.util import bfh, print_msg, json_encode
+from electrum_dash.version import ELECTRUM_VERSION
+
+
+def measure(func: Callable[[], None], num_headers: int, repeat: int) -> Dict[str, float]:
+    """Runs func repeat times, func processes num_headers headers per run.
+    Time is the best run, allocated bytes are from an extra run under
+    tracemalloc (which slows down the code it traces).
+    """
+    best = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        func()
+        allocated, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'headers': num_headers,
+        'seconds': best,
+        'headers_per_sec': num_headers / best if best else None,
+        'peak_bytes_per_header': peak / num_headers,
+    }
+
+
+def recorded_mainnet_headers() -> List[bytes]:
+    checkpoints = constants.BitcoinMainnet.CHECKPOINTS
+    raw_headers = []
+    for index in range(len(checkpoints)):
+        raw_headers.extend(raw for height, raw in checkpoints.get_raw_extra_headers(index))
+    return raw_headers
+
+
+def x11_backends() -> Dict[str, Callable[[bytes], bytes]]:
+    backends = {}
+    try:
+        import x11_hash
+        backends['x11_hash'] = x11_hash.getPoWHash
+    except ImportError:
+        pass
+    try:
+        from ctypes import cdll, create_string_buffer, byref
+        name = {'darwin': 'libx11hash.dylib',
+                'win32': 'libx11hash-0.dll'}.get(sys.platform, 'libx11hash.so')
+        lib_x11_hash = cdll.LoadLibrary(name).x11_hash
+    except OSError:
+        pass
+    else:
+        def get_pow_hash(header):
+            hash_out = create_string_buffer(32)
+            lib_x11_hash(header, byref(hash_out))
+            return hash_out.raw
+        backends['libx11hash'] = get_pow_hash
+    return backends
+
+
+def build_synthetic_chain(config: SimpleConfig, num_chunks: int) -> Blockchain:
+    """Writes a regtest chain of linked headers, num_chunks of them
+    past the DGW v3 activation height, and returns it.
+    """
+    first_index = POW_DGW3_HEIGHT // CHUNK_SIZE + 1
+    num_headers = (first_index + num_chunks) * CHUNK_SIZE
+    path = os.path.join(config.path, 'blockchain_headers')
+    prev_hash = '00' * 32
+    with open(path, 'wb') as f:
+        for height in range(num_headers):
+            header = {
+                'version': 0x20000000,
+                'prev_block_hash': prev_hash,
+                'merkle_root': '%064x' % height,
+                'timestamp': 1500000000 + 150 * height + (height * 7919) % 300,
+                'bits': 0x1e0ffff0,
+                'nonce': height,
+                'block_height': height,
+            }
+            raw = bfh(serialize_header(header))
+            f.write(raw)
+            prev_hash = hash_header(header)
+    return Blockchain(config=config, forkpoint=0, parent=None,
+                      forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+
+def bench_recorded_headers(results: dict, repeat: int) -> None:
+    raw_headers = recorded_mainnet_headers()
+    n = len(raw_headers)
+    results['deserialize_header'] = measure(
+        lambda: [deserialize_header(raw, 0) for raw in raw_headers], n, repeat)
+    # headers memoize their hash, so hash fresh ones
+    results['hash_header'] = measure(
+        lambda: [hash_header(deserialize_header(raw, 0)) for raw in raw_headers], n, repeat)
+    results['hash_headers'] = measure(lambda: hash_headers(raw_headers), n, repeat)
+    backends = x11_backends()
+    reference = None
+    for name, get_pow_hash in backends.items():
+        hashes = [get_pow_hash(raw) for raw in raw_headers]
+        if reference is None:
+            reference = hashes
+        elif hashes != reference:
+            raise Exception(f'x11 backend {name} returned different hashes')
+        results[f'x11.{name}'] = measure(
+            lambda: [get_pow_hash(raw) for raw in raw_headers], n, repeat)
+
+
+def bench_chainwork(results: dict, repeat: int) -> None:
+    tmp_dir = tempfile.mkdtemp()
+    saved_cache = dict(blockchain._CHAINWORK_CACHE)
+    try:
+        config = SimpleConfig({'electrum_path': tmp_dir})
+        chain = Blockchain(config=config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        height = constants.net.max_checkpoint()
+
+        def get_chainwork():
+            # only the virtual block before genesis, so that all of it is computed
+            blockchain._CHAINWORK_CACHE.clear()
+            blockchain._CHAINWORK_CACHE['00' * 32] = 0
+            chain.get_chainwork(height)
+        results['get_chainwork'] = measure(get_chainwork, height + 1, repeat)
+        chain.close_headers_file()
+    finally:
+        blockchain._CHAINWORK_CACHE.clear()
+        blockchain._CHAINWORK_CACHE.update(saved_cache)
+        shutil.rmtree(tmp_dir)
+
+
+def bench_synthetic_chain(results: dict, num_chunks: int, repeat: int) -> None:
+    tmp_dir = tempfile.mkdtemp()
+    constants.set_regtest()
+    try:
+        config = SimpleConfig({'electrum_path': tmp_dir})
+        chain = build_synthetic_chain(config, num_chunks)
+        first_index = chain.height() // CHUNK_SIZE - num_chunks + 1
+        first_height = first_index * CHUNK_SIZE
+        heights = range(first_height, chain.height() + 1)
+        n = len(heights)
+        with open(chain.path(), 'rb') as f:
+            f.seek(first_height * HEADER_SIZE)
+            chunks = [f.read(CHUNK_SIZE * HEADER_SIZE) for i in range(num_chunks)]
+
+        def verify_chunks():
+            for i, data in enumerate(chunks):
+                chain.verify_chunk(first_index + i, data)
+
+        def read_headers():
+            chain._header_cache.clear()
+            for height in heights:
+                chain.read_header(height)
+
+        def get_targets():
+            for height in heights:
+                chain.get_target_dgw_v3(height, {'empty': True})
+
+        results['verify_chunk'] = measure(verify_chunks, n, repeat)
+        results['read_header'] = measure(read_headers, n, repeat)
+        results['get_target_dgw_v3'] = measure(get_targets, n, repeat)
+        chain.close_headers_file()
+    finally:
+        constants.set_mainnet()
+        shutil.rmtree(tmp_dir)
+
+
+def main(argv: Optional[List[str]] = None) -> dict:
+    parser = argparse.ArgumentParser(description='benchmark header verification')
+    parser.add_argument('--chunks', type=int, default=2,
+                        help='number of synthetic chunks to verify')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per benchmark, the best one is reported')
+    parser.add_argument('--output', help='write results to this json file')
+    args = parser.parse_args(argv)
+
+    results = {}
+    bench_recorded_headers(results, args.repeat)
+    bench_chainwork(results, args.repeat)
+    bench_synthetic_chain(results, args.chunks, args.repeat)
+    report = {
+        'version': ELECTRUM_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'x11_backend': 'libx11hash' if x11hash.load_libx11hash else 'x11_hash',
+        'time': int(time.time()),
+        'results': results,
+    }
+    for name, r in results.items():
+        print_msg(f"{name:20} {r['headers_per_sec']:14,.0f} headers/s "
+                  f"{r['peak_bytes_per_header']:10,.1f} peak bytes/header")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(json_encode(report))
+    return report
+
+
+if __name__ == '__main__':
+    main()
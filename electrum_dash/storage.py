@@ -31,12 +31,15 @@ import random
 import time
 import zlib
 from enum import IntEnum
+from typing import Optional, Tuple
 
 from . import ecc
+from . import crypto
 from .util import (profiler, InvalidPassword, WalletFileException, bfh, standardize_path,
                    test_read_write_permissions)
 
 from .wallet_db import WalletDB
+from .tx_store import get_tx_store_path
 from .logging import Logger
 
 
@@ -55,6 +58,31 @@ class StorageEncryptionVersion(IntEnum):
 class StorageReadWriteError(Exception): pass
 
 
+# change records appended to the wallet file are consolidated into a new
+# snapshot once they take more than half the size of the snapshot
+APPENDED_CHANGES_MIN_SIZE = 256 * 1024
+
+# Encrypted wallet files are written as a stream of lines: a header with
+# the magic and an ephemeral pubkey, then chunks of the zlib compressed
+# data, each encrypted with chacha20-poly1305 on its own. The key is
+# derived from ECDH between the ephemeral key and the storage key, the
+# nonce is the chunk index and the header is authenticated with every
+# chunk. Each chunk starts with a flag, authenticated as well, that marks
+# the last chunk of a write or append, so that chunks missing at the end
+# are noticed. Files written as a single ECIES message (BIE1, BIE2) are
+# still read, and are rewritten in the chunked format on the next full write.
+STREAM_ENCRYPTION_MAGICS = {
+    b'BIS1': StorageEncryptionVersion.USER_PASSWORD,
+    b'BIS2': StorageEncryptionVersion.XPUB_PASSWORD,
+}
+LEGACY_ENCRYPTION_MAGICS = {
+    b'BIE1': StorageEncryptionVersion.USER_PASSWORD,
+    b'BIE2': StorageEncryptionVersion.XPUB_PASSWORD,
+}
+ENCRYPTED_CHUNK_SIZE = 256 * 1024  # in characters of plaintext
+CHUNK_MORE, CHUNK_LAST = b'\x00', b'\x01'
+
+
 # TODO: Rename to Storage
 class WalletStorage(Logger):
 
@@ -70,13 +98,25 @@ class WalletStorage(Logger):
             test_read_write_permissions(self.path)
         except IOError as e:
             raise StorageReadWriteError(e) from e
+        # the stream format is decrypted straight from the file
+        self._stream_header = None  # type: Optional[bytes]
+        self._stream_key = None  # type: Optional[bytes]
+        self._next_chunk_index = 0
+        # the file can not be appended to: its last chunks were cut off by
+        # an interrupted append, or the password changed since it was written
+        self._needs_rewrite = False
+        # raw transactions are kept in a separate file, see tx_store.py
+        self._tx_store_key = None  # type: Optional[bytes]
+        self.raw = ''
+        self._encryption_version = StorageEncryptionVersion.PLAINTEXT
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
-                self.raw = f.read()
-            self._encryption_version = self._init_encryption_version()
-        else:
-            self.raw = ''
-            self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+                first_line = f.readline()
+                self._init_encryption_version(first_line)
+                if self._stream_header is None:
+                    self.raw = first_line + f.read()
+        # sizes of the last full write and of the changes appended to it
+        self._set_sizes(self.raw)
 
     @property
     def write_attempts(self):
@@ -97,13 +137,21 @@ class WalletStorage(Logger):
     def read(self):
         return self.decrypted if self.is_encrypted() else self.raw
 
+    def _set_sizes(self, plaintext: str) -> None:
+        pos = plaintext.find(',\n{')
+        self._snapshot_size = len(plaintext) if pos < 0 else pos
+        self._appended_size = len(plaintext) - self._snapshot_size
+
     def write(self, data: str) -> None:
-        s = self.encrypt_before_writing(data)
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         write_attempts = self.write_attempts
         while write_attempts > 0:
             with open(temp_path, "w", encoding='utf-8') as f:
-                f.write(s)
+                if self.pubkey:
+                    self._start_encrypted_stream(f)
+                    self._write_encrypted_chunks(f, data)
+                else:
+                    f.write(data)
                 f.flush()
                 os.fsync(f.fileno())
 
@@ -129,9 +177,36 @@ class WalletStorage(Logger):
                 continue
             os.chmod(self.path, mode)
             self._file_exists = True
+            self._snapshot_size = len(data)
+            self._appended_size = 0
+            self._needs_rewrite = False
             self.logger.info(f"saved {self.path}")
             break
 
+    def append(self, data: str) -> None:
+        """Appends change records to the wallet file. When encrypted,
+        they are encrypted separately, one message per line.
+        """
+        assert self.file_exists()
+        assert not self.needs_consolidation()
+        with open(self.path, "a", encoding='utf-8') as f:
+            if self.pubkey:
+                self._write_encrypted_chunks(f, data)
+            else:
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._appended_size += len(data)
+        self.logger.info(f"appended {len(data)} chars to {self.path}")
+
+    def needs_consolidation(self) -> bool:
+        """Whether the next write should rewrite the whole file."""
+        if self._needs_rewrite:
+            return True
+        if self.pubkey and self._stream_key is None:
+            return True  # legacy encryption
+        return self._appended_size > max(APPENDED_CHANGES_MIN_SIZE, self._snapshot_size // 2)
+
     def file_exists(self) -> bool:
         return self._file_exists
 
@@ -162,20 +237,22 @@ class WalletStorage(Logger):
         ECIES, private key derived from a password,
         1: password is provided by user
         2: password is derived from an xpub; used with hw wallets
+
+        Either is written in the chunked stream format, see STREAM_ENCRYPTION_MAGICS.
         """
         return self._encryption_version
 
-    def _init_encryption_version(self):
+    def _init_encryption_version(self, first_line: str) -> None:
         try:
-            magic = base64.b64decode(self.raw)[0:4]
-            if magic == b'BIE1':
-                return StorageEncryptionVersion.USER_PASSWORD
-            elif magic == b'BIE2':
-                return StorageEncryptionVersion.XPUB_PASSWORD
-            else:
-                return StorageEncryptionVersion.PLAINTEXT
+            header = base64.b64decode(first_line)
         except:
-            return StorageEncryptionVersion.PLAINTEXT
+            return
+        magic = header[0:4]
+        if magic in STREAM_ENCRYPTION_MAGICS and len(header) == 37:
+            self._stream_header = header
+            self._encryption_version = STREAM_ENCRYPTION_MAGICS[magic]
+        elif magic in LEGACY_ENCRYPTION_MAGICS:
+            self._encryption_version = LEGACY_ENCRYPTION_MAGICS[magic]
 
     @staticmethod
     def get_eckey_from_password(password):
@@ -183,38 +260,94 @@ class WalletStorage(Logger):
         ec_key = ecc.ECPrivkey.from_arbitrary_size_secret(secret)
         return ec_key
 
-    def _get_encryption_magic(self):
+    def _get_encryption_magic(self, magics=LEGACY_ENCRYPTION_MAGICS):
         v = self._encryption_version
-        if v == StorageEncryptionVersion.USER_PASSWORD:
-            return b'BIE1'
-        elif v == StorageEncryptionVersion.XPUB_PASSWORD:
-            return b'BIE2'
-        else:
-            raise WalletFileException('no encryption magic for version: %s' % v)
+        for magic, version in magics.items():
+            if version == v:
+                return magic
+        raise WalletFileException('no encryption magic for version: %s' % v)
 
     def decrypt(self, password) -> None:
         if self.is_past_initial_decryption():
             return
         ec_key = self.get_eckey_from_password(password)
-        if self.raw:
+        if self._stream_header is not None:
+            s = self._decrypt_stream(ec_key)
+        elif self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-            s = s.decode('utf8')
+            # changes appended by older versions are separate messages
+            s = ''.join(zlib.decompress(ec_key.decrypt_message(part, enc_magic)).decode('utf8')
+                        for part in self.raw.split('\n') if part)
+            self.raw = ''
         else:
             s = ''
         self.pubkey = ec_key.get_public_key_hex()
+        self._tx_store_key = self._get_tx_store_key(ec_key)
         self.decrypted = s
+        self._set_sizes(s)
 
-    def encrypt_before_writing(self, plaintext: str) -> str:
-        s = plaintext
-        if self.pubkey:
-            s = bytes(s, 'utf8')
-            c = zlib.compress(s, level=zlib.Z_BEST_SPEED)
-            enc_magic = self._get_encryption_magic()
-            public_key = ecc.ECPubkey(bfh(self.pubkey))
-            s = public_key.encrypt_message(c, enc_magic)
-            s = s.decode('utf8')
-        return s
+    @staticmethod
+    def _chunk_nonce(index: int) -> bytes:
+        return index.to_bytes(12, byteorder='big')
+
+    def _decrypt_stream(self, ec_key: ecc.ECPrivkey) -> str:
+        ephemeral_pubkey = ecc.ECPubkey(self._stream_header[4:])
+        ecdh_key = (ephemeral_pubkey * ec_key.secret_scalar).get_public_key_bytes(compressed=True)
+        key = hashlib.sha256(ecdh_key).digest()
+        with open(self.path, "r", encoding='utf-8') as f:
+            f.readline()  # header
+            lines = [line for line in f if line.strip()]
+        pieces = []
+        num_complete = 0  # chunks up to the last chunk of a write
+        for index, line in enumerate(lines):
+            try:
+                data = base64.b64decode(line)
+                flag = data[:1]
+                if flag not in (CHUNK_MORE, CHUNK_LAST):
+                    raise ValueError('unknown chunk flag')
+                c = crypto.chacha20_poly1305_decrypt(
+                    key=key, nonce=self._chunk_nonce(index),
+                    associated_data=self._stream_header + flag, data=data[1:])
+            except ValueError:
+                if index == 0:
+                    raise InvalidPassword()
+                # only a partial last line is left by an interrupted append
+                if index < len(lines) - 1 or line.endswith('\n'):
+                    raise WalletFileException(f'wallet file is corrupted at chunk {index}')
+                break
+            pieces.append(zlib.decompress(c).decode('utf8'))
+            if flag == CHUNK_LAST:
+                num_complete = index + 1
+        if num_complete == 0 and lines:
+            raise WalletFileException('wallet file is truncated')
+        if num_complete < len(lines):
+            # remainder of an interrupted append, overwritten by the next write
+            self.logger.warning(f'dropping {len(lines) - num_complete} incomplete chunks of {self.path}')
+            self._needs_rewrite = True
+        self._stream_key = key
+        self._next_chunk_index = num_complete
+        return ''.join(pieces[:num_complete])
+
+    def _start_encrypted_stream(self, f) -> None:
+        """Writes the header of a new stream, with a new key."""
+        ephemeral = ecc.ECPrivkey.generate_random_key()
+        public_key = ecc.ECPubkey(bfh(self.pubkey))
+        ecdh_key = (public_key * ephemeral.secret_scalar).get_public_key_bytes(compressed=True)
+        magic = self._get_encryption_magic(STREAM_ENCRYPTION_MAGICS)
+        self._stream_header = magic + ephemeral.get_public_key_bytes(compressed=True)
+        self._stream_key = hashlib.sha256(ecdh_key).digest()
+        self._next_chunk_index = 0
+        f.write(base64.b64encode(self._stream_header).decode('ascii') + '\n')
+
+    def _write_encrypted_chunks(self, f, data: str) -> None:
+        for i in range(0, len(data), ENCRYPTED_CHUNK_SIZE):
+            flag = CHUNK_LAST if i + ENCRYPTED_CHUNK_SIZE >= len(data) else CHUNK_MORE
+            c = zlib.compress(data[i:i+ENCRYPTED_CHUNK_SIZE].encode('utf8'), level=zlib.Z_BEST_SPEED)
+            c = crypto.chacha20_poly1305_encrypt(
+                key=self._stream_key, nonce=self._chunk_nonce(self._next_chunk_index),
+                associated_data=self._stream_header + flag, data=c)
+            f.write(base64.b64encode(flag + c).decode('ascii') + '\n')
+            self._next_chunk_index += 1
 
     def check_password(self, password) -> None:
         """Raises an InvalidPassword exception on invalid password"""
@@ -235,10 +368,30 @@ class WalletStorage(Logger):
         if password and enc_version != StorageEncryptionVersion.PLAINTEXT:
             ec_key = self.get_eckey_from_password(password)
             self.pubkey = ec_key.get_public_key_hex()
+            self._tx_store_key = self._get_tx_store_key(ec_key)
             self._encryption_version = enc_version
         else:
             self.pubkey = None
+            self._tx_store_key = None
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        # the next write starts a new stream with the new key
+        self._stream_header = None
+        self._stream_key = None
+        self._needs_rewrite = True
+
+    @staticmethod
+    def _get_tx_store_key(ec_key: ecc.ECPrivkey) -> bytes:
+        return hashlib.sha256(b'tx_store' + ec_key.get_secret_bytes()).digest()
+
+    def get_tx_store_path_and_key(self) -> Tuple[Optional[str], Optional[bytes]]:
+        """Returns where the transactions of the wallet are kept, and the
+        key they are encrypted with. The path is None if they can not be
+        kept in a tx store: the storage has no path, or it is encrypted
+        with a key we do not know (e.g. a backup).
+        """
+        if not self.path or self.is_encrypted() and self._tx_store_key is None:
+            return None, None
+        return get_tx_store_path(self.path), self._tx_store_key
 
     def basename(self) -> str:
         return os.path.basename(self.path)
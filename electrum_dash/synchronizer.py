@@ -23,44 +23,131 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import asyncio
-import hashlib
-from typing import Dict, List, TYPE_CHECKING, Tuple, Set
+import random
+import time
+from typing import Dict, List, TYPE_CHECKING, Tuple, Set, Any, Callable, Awaitable, Optional
 from collections import defaultdict
 import logging
 
 from aiorpcx import TaskGroup, run_in_thread, RPCError
+from aiorpcx.jsonrpc import CodeMessageError
 
 from . import util
 from .transaction import Transaction, PartialTransaction
-from .util import bh2u, make_aiohttp_session, NetworkJobOnDefaultServer, random_shuffled_copy
+from .util import (make_aiohttp_session, NetworkJobOnDefaultServer, random_shuffled_copy,
+                   history_status)
 from .bitcoin import address_to_scripthash, is_address
 from .logging import Logger
-from .interface import GracefulDisconnect, NetworkTimeout
+from .interface import GracefulDisconnect, NetworkTimeout, RequestTimedOut, RequestCorrupted
 
 if TYPE_CHECKING:
     from .network import Network
+    from .interface import Interface
     from .address_synchronizer import AddressSynchronizer
 
 
 class SynchronizerFailure(Exception): pass
+class ShardFailure(Exception): pass
 
 
-def history_status(h):
-    if not h:
-        return None
-    status = ''
-    for tx_hash, height in h:
-        status += tx_hash + ':%d:' % height
-    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+# share of the statuses received from other servers that are checked
+# against the main server, see SynchronizerBase._cross_check_status
+STATUS_CROSS_CHECK_RATIO = 0.05
+
+
+class RequestBatcher:
+    """Coalesces the requests made concurrently into batches, sent by
+    'send_batch' (a list of args -> a list of results or exceptions).
+    Batches grow while the server answers them within 'target_time'
+    and shrink when it does not.
+    """
+
+    MIN_BATCH_SIZE = 1
+    MAX_BATCH_SIZE = 100
+    NUM_WORKERS = 5  # batches in flight
+
+    def __init__(self, send_batch: Callable[[List[Any]], Awaitable[List[Any]]], *,
+                 semaphore: asyncio.Semaphore, target_time: float):
+        self._send_batch = send_batch
+        self._semaphore = semaphore
+        self.target_time = target_time
+        self.batch_size = 10
+        self._pending = []  # type: List[Tuple[Any, asyncio.Future]]
+        self._has_pending = asyncio.Event()
+
+    async def request(self, arg):
+        fut = asyncio.get_event_loop().create_future()
+        self._pending.append((arg, fut))
+        self._has_pending.set()
+        return await fut
+
+    async def run(self, *, taskgroup: TaskGroup):
+        for i in range(self.NUM_WORKERS):
+            await taskgroup.spawn(self._send_batches())
+
+    def _take_batch(self) -> List[Tuple[Any, asyncio.Future]]:
+        batch = [(arg, fut) for arg, fut in self._pending[:self.batch_size]
+                 if not fut.done()]  # not cancelled
+        self._pending = self._pending[self.batch_size:]
+        if not self._pending:
+            self._has_pending.clear()
+        return batch
+
+    async def _send_batches(self):
+        while True:
+            await self._has_pending.wait()
+            await asyncio.sleep(0)  # let requests spawned together queue up
+            async with self._semaphore:
+                # requests that came in while waiting join the batch
+                batch = self._take_batch()
+                if not batch:
+                    continue
+                t0 = time.monotonic()
+                try:
+                    results = await self._send_batch([arg for arg, fut in batch])
+                except BaseException:
+                    for arg, fut in batch:
+                        fut.cancel()
+                    raise
+                elapsed = time.monotonic() - t0
+            if elapsed > self.target_time:
+                self.batch_size = max(self.MIN_BATCH_SIZE, self.batch_size // 2)
+            elif len(batch) == self.batch_size:
+                self.batch_size = min(self.MAX_BATCH_SIZE, self.batch_size * 2)
+            for (arg, fut), result in zip(batch, results):
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+
+
+class SubscriptionShard:
+    """Scripthashes subscribed on a server other than the main one."""
+
+    def __init__(self, interface: 'Interface'):
+        self.interface = interface
+        self.scripthashes = set()  # type: Set[str]
+        self.statuses = {}  # type: Dict[str, Optional[str]]  # last status received
+        self.status_queue = asyncio.Queue()
+        self.history_batcher = None  # type: Optional[RequestBatcher]
 
 
 class SynchronizerBase(NetworkJobOnDefaultServer):
     """Subscribe over the network to a set of addresses, and monitor their statuses.
     Every time a status changes, run a coroutine provided by the subclass.
+
+    With the 'subscription_shards' config option set to more than one,
+    the subscriptions are spread over that many servers (the main one
+    included). A shard whose server disconnects, fails a request or
+    reports statuses that the main server does not confirm is dropped,
+    and its scripthashes are subscribed again on the others.
     """
     def __init__(self, network: 'Network'):
         self.asyncio_loop = network.asyncio_loop
         self._reset_request_counters()
+        self._num_addrs_added = 0
 
         NetworkJobOnDefaultServer.__init__(self, network)
 
@@ -73,23 +160,81 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
+        # subscriptions on other servers than the main one
+        self._shards = []  # type: List[SubscriptionShard]
+        self._shard_of = {}  # type: Dict[str, SubscriptionShard]  # scripthash -> shard
+        self._num_main_subscriptions = 0
 
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
         try:
             async with taskgroup as group:
+                for shard in self._select_shards():
+                    self._shards.append(shard)
+                    await self._start_shard(shard)
                 await group.spawn(self.send_subscriptions())
                 await group.spawn(self.handle_status())
                 await group.spawn(self.main())
         finally:
             # we are being cancelled now
             self.session.unsubscribe(self.status_queue)
+            for shard in self._shards:
+                if shard.interface.session:
+                    shard.interface.session.unsubscribe(shard.status_queue)
+
+    def _select_shards(self) -> List[SubscriptionShard]:
+        num_shards = int(self.network.config.get('subscription_shards', 1))
+        if num_shards <= 1:
+            return []
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        interfaces = [iface for iface in interfaces
+                      if iface is not self.interface
+                      and iface.ready.done() and not iface.got_disconnected.is_set()
+                      and iface.blockchain == self.interface.blockchain]
+        interfaces = random.sample(interfaces, min(len(interfaces), num_shards - 1))
+        return [SubscriptionShard(iface) for iface in interfaces]
+
+    async def _start_shard(self, shard: SubscriptionShard):
+        self.logger.info(f'using subscription shard on {shard.interface.server}')
+        await self.taskgroup.spawn(self._handle_shard_status(shard))
+        await self.taskgroup.spawn(self._drop_shard_on_disconnect(shard))
+
+    def _pick_shard(self) -> Optional[SubscriptionShard]:
+        """Returns the least used shard, None for the main server."""
+        shard = min(self._shards, key=lambda x: len(x.scripthashes), default=None)
+        if shard is None or self._num_main_subscriptions <= len(shard.scripthashes):
+            return None
+        return shard
+
+    def _drop_shard(self, shard: SubscriptionShard, reason) -> None:
+        if shard not in self._shards:
+            return
+        self.logger.info(f'dropping subscription shard on {shard.interface.server}: {reason}')
+        self._shards.remove(shard)
+        if shard.interface.session:
+            shard.interface.session.unsubscribe(shard.status_queue)
+        shard.status_queue.put_nowait(None)  # stops _handle_shard_status
+        # subscribe again on the other servers
+        for h in shard.scripthashes:
+            self._shard_of.pop(h, None)
+            addr = self.scripthash_to_address[h]
+            if addr not in self.requested_addrs:
+                self.requested_addrs.add(addr)
+                self.add_queue.put_nowait(addr)
+        shard.scripthashes.clear()
+        self._wakeup_event.set()
+
+    async def _drop_shard_on_disconnect(self, shard: SubscriptionShard):
+        await shard.interface.got_disconnected.wait()
+        self._drop_shard(shard, 'disconnected')
 
     def _reset_request_counters(self):
         self._requests_sent = 0
         self._requests_answered = 0
 
     def add(self, addr):
+        self._num_addrs_added += 1
         asyncio.run_coroutine_threadsafe(self._add_address(addr), self.asyncio_loop)
 
     async def _add_address(self, addr: str):
@@ -98,6 +243,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         if addr in self.requested_addrs: return
         self.requested_addrs.add(addr)
         self.add_queue.put_nowait(addr)
+        self._wakeup_event.set()
 
     def remove_addr(self, addr):
         asyncio.run_coroutine_threadsafe(self._remove_address(addr),
@@ -116,19 +262,40 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
+        async def subscribe_on_shard(shard, h) -> bool:
+            shard.scripthashes.add(h)
+            self._shard_of[h] = shard
+            try:
+                async with self._network_request_semaphore:
+                    await shard.interface.session.subscribe('blockchain.scripthash.subscribe', [h],
+                                                            shard.status_queue)
+            except Exception as e:
+                shard.scripthashes.discard(h)
+                if self._shard_of.get(h) is shard:
+                    del self._shard_of[h]
+                if not (isinstance(e, RPCError) and e.message == 'history too large'):
+                    self._drop_shard(shard, repr(e))
+                return False  # try the main server
+            # the shard might have been dropped while we were waiting
+            return shard in self._shards
+
         async def subscribe_to_address(addr):
             h = address_to_scripthash(addr)
             self.scripthash_to_address[h] = addr
             self._requests_sent += 1
-            try:
-                async with self._network_request_semaphore:
-                    await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
+            shard = self._pick_shard()
+            if shard is None or not await subscribe_on_shard(shard, h):
+                self._num_main_subscriptions += 1
+                try:
+                    async with self._network_request_semaphore:
+                        await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
+                except RPCError as e:
+                    if e.message == 'history too large':  # no unique error code
+                        raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+                    raise
             self._requests_answered += 1
-            self.requested_addrs.remove(addr)
+            self.requested_addrs.discard(addr)
+            self._wakeup_event.set()
 
         while True:
             addr = await self.add_queue.get()
@@ -140,6 +307,44 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
             addr = self.scripthash_to_address[h]
             await self.taskgroup.spawn(self._on_address_status, addr, status)
             self._processed_some_notifications = True
+            self._wakeup_event.set()
+
+    async def _handle_shard_status(self, shard: SubscriptionShard):
+        while True:
+            item = await shard.status_queue.get()
+            if item is None:
+                return  # shard dropped
+            h, status = item
+            if self._shard_of.get(h) is not shard:
+                continue  # subscribed on another server since
+            shard.statuses[h] = status
+            addr = self.scripthash_to_address[h]
+            await self.taskgroup.spawn(self._on_address_status, addr, status)
+            if random.random() < STATUS_CROSS_CHECK_RATIO:
+                await self.taskgroup.spawn(self._cross_check_status(shard, h))
+            self._processed_some_notifications = True
+            self._wakeup_event.set()
+
+    async def _cross_check_status(self, shard: SubscriptionShard, h: str):
+        """Drops the shard if the main server does not agree with the
+        status it reported for h.
+        """
+        timeout = self.network.get_network_timeout_seconds(NetworkTimeout.Generic)
+        for attempt in range(2):
+            if attempt:
+                # the statuses might just have been racing a new block
+                await asyncio.sleep(timeout)
+            try:
+                async with self._network_request_semaphore:
+                    result = await self.interface.get_history_for_scripthash(h)
+            except (CodeMessageError, RequestTimedOut, RequestCorrupted) as e:
+                # the main server is to blame, not the shard
+                self.logger.info(f'skipping status check of {h}: {repr(e)}')
+                return
+            status = history_status([(item['tx_hash'], item['height']) for item in result])
+            if shard not in self._shards or status == shard.statuses.get(h):
+                return
+        self._drop_shard(shard, f'status of {h} not confirmed by the main server')
 
     def num_requests_sent_and_answered(self) -> Tuple[int, int]:
         return self._requests_sent, self._requests_answered
@@ -165,10 +370,43 @@ class Synchronizer(SynchronizerBase):
         self.requested_tx = {}
         self.requested_histories = set()
         self._stale_histories = dict()  # type: Dict[str, asyncio.Task]
+        # coalesce get_history and transaction.get requests into batches
+        target_time = self.network.get_network_timeout_seconds(NetworkTimeout.Generic) / 4
+        self._history_batcher = RequestBatcher(
+            lambda shs: self.interface.get_histories_for_scripthashes(shs),
+            semaphore=self._network_request_semaphore, target_time=target_time)
+        self._tx_batcher = RequestBatcher(
+            lambda tx_hashes: self.interface.get_transactions(tx_hashes),
+            semaphore=self._network_request_semaphore, target_time=target_time)
 
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    async def _start_shard(self, shard):
+        async def send_batch(shs):
+            try:
+                return await shard.interface.get_histories_for_scripthashes(shs)
+            except Exception as e:
+                self._drop_shard(shard, repr(e))
+                return [ShardFailure()] * len(shs)
+        shard.history_batcher = RequestBatcher(
+            send_batch, semaphore=self._network_request_semaphore,
+            target_time=self._history_batcher.target_time)
+        await self.taskgroup.spawn(shard.history_batcher.run(taskgroup=self.taskgroup))
+        await super()._start_shard(shard)
+
+    async def _get_history(self, h: str) -> Tuple[list, Optional[SubscriptionShard]]:
+        """Requests the history of h from the server it is subscribed on,
+        returns it and the shard it came from (None for the main server).
+        """
+        shard = self._shard_of.get(h)
+        if shard is not None:
+            try:
+                return await shard.history_batcher.request(h), shard
+            except ShardFailure:
+                pass
+        return await self._history_batcher.request(h), None
+
     def is_up_to_date(self):
         return (not self.requested_addrs
                 and not self.requested_histories
@@ -176,8 +414,7 @@ class Synchronizer(SynchronizerBase):
                 and not self._stale_histories)
 
     async def _on_address_status(self, addr, status):
-        history = self.wallet.db.get_addr_history(addr)
-        if history_status(history) == status:
+        if self.wallet.db.get_addr_status(addr) == status:
             return
         # No point in requesting history twice for the same announced status.
         # However if we got announced a new status, we should request history again:
@@ -188,8 +425,7 @@ class Synchronizer(SynchronizerBase):
         self._stale_histories.pop(addr, asyncio.Future()).cancel()
         h = address_to_scripthash(addr)
         self._requests_sent += 1
-        async with self._network_request_semaphore:
-            result = await self.interface.get_history_for_scripthash(h)
+        result, shard = await self._get_history(h)
         self._requests_answered += 1
         self.logger.info(f"receiving history {addr} {len(result)}")
         hist = list(map(lambda item: (item['tx_hash'], item['height']), result))
@@ -205,17 +441,24 @@ class Synchronizer(SynchronizerBase):
             async def disconnect_if_still_stale():
                 timeout = self.network.get_network_timeout_seconds(NetworkTimeout.Generic)
                 await asyncio.sleep(timeout)
+                if shard is not None:
+                    # don't blame the main server, subscribe on another one
+                    self._stale_histories.pop(addr, None)
+                    self._drop_shard(shard, f'history of {addr} still stale')
+                    return
                 raise SynchronizerFailure(f"timeout reached waiting for addr {addr}: history still stale")
             self._stale_histories[addr] = await self.taskgroup.spawn(disconnect_if_still_stale)
         else:
             self._stale_histories.pop(addr, asyncio.Future()).cancel()
             # Store received history
-            self.wallet.receive_history_callback(addr, hist, tx_fees)
+            self.wallet.receive_history_callback(addr, hist, tx_fees, status=status)
             # Request transactions we don't have
             await self._request_missing_txs(hist)
 
         # Remove request; this allows up_to_date to be True
         self.requested_histories.discard((addr, status))
+        # new history might need new addresses
+        self._wakeup_event.set()
 
     async def _request_missing_txs(self, hist, *, allow_server_not_finding_tx=False):
         # "hist" is a list of [tx_hash, tx_height] lists
@@ -237,12 +480,12 @@ class Synchronizer(SynchronizerBase):
     async def _get_transaction(self, tx_hash, *, allow_server_not_finding_tx=False):
         self._requests_sent += 1
         try:
-            async with self._network_request_semaphore:
-                raw_tx = await self.interface.get_transaction(tx_hash)
+            raw_tx = await self._tx_batcher.request(tx_hash)
         except RPCError as e:
             # most likely, "No such mempool or blockchain transaction"
             if allow_server_not_finding_tx:
                 self.requested_tx.pop(tx_hash)
+                self._wakeup_event.set()
                 return
             else:
                 raise
@@ -254,8 +497,11 @@ class Synchronizer(SynchronizerBase):
         tx_height = self.requested_tx.pop(tx_hash)
         self.wallet.receive_tx_callback(tx_hash, tx, tx_height)
         self.logger.info(f"received tx {tx_hash} height: {tx_height} bytes: {len(raw_tx)}")
+        self._wakeup_event.set()
 
     async def main(self):
+        await self.taskgroup.spawn(self._history_batcher.run(taskgroup=self.taskgroup))
+        await self.taskgroup.spawn(self._tx_batcher.run(taskgroup=self.taskgroup))
         self.wallet.set_up_to_date(False)
         # request missing txns, if any
         for addr in random_shuffled_copy(self.wallet.db.get_history()):
@@ -274,18 +520,25 @@ class Synchronizer(SynchronizerBase):
             if addr in unsubscribed_addrs:
                 continue
             await self._add_address(addr)
-        # main loop
+        # main loop, woken up by new statuses, histories and txs
         while True:
-            await asyncio.sleep(0.1)
+            await self._wait_for_wakeup()
+            num_added = self._num_addrs_added
             await run_in_thread(self.wallet.synchronize)
+            useful = num_added != self._num_addrs_added
             up_to_date = self.is_up_to_date()
             if (up_to_date != self.wallet.is_up_to_date()
                     or up_to_date and self._processed_some_notifications):
                 self._processed_some_notifications = False
                 if up_to_date:
                     self._reset_request_counters()
+                    self.logger.debug(f'wakeups (useful/total): '
+                                      f'{self._num_useful_wakeups}/{self._num_wakeups}')
                 self.wallet.set_up_to_date(up_to_date)
                 util.trigger_callback('wallet_updated', self.wallet)
+                useful = True
+            if useful:
+                self._num_useful_wakeups += 1
 
 
 class Notifier(SynchronizerBase):
@@ -1,10 +1,12 @@
+import concurrent.futures
 import shutil
 import tempfile
 import os
+from unittest import mock
 
 from electrum_dash import constants, blockchain
 from electrum_dash.simple_config import SimpleConfig
-from electrum_dash.blockchain import Blockchain, deserialize_header, hash_header
+from electrum_dash.blockchain import Blockchain, deserialize_header, hash_header, serialize_header
 from electrum_dash.util import bh2u, bfh, make_dir
 
 from . import ElectrumTestCase
@@ -384,6 +386,279 @@ class TestBlockchain(ElectrumTestCase):
         self.assertEqual([chain_u], self.get_chains_that_contain_header_helper(self.HEADERS['O']))
         self.assertEqual([chain_z, chain_l], self.get_chains_that_contain_header_helper(self.HEADERS['I']))
 
+    def test_check_header_with_header_records(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFO':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        self._append_header(chain_l, self.HEADERS['H'])
+
+        self.assertIsInstance(self.HEADERS['C'], blockchain.Header)
+        self.assertEqual(chain_u, blockchain.check_header(self.HEADERS['O']))
+        self.assertEqual(chain_l, blockchain.check_header(self.HEADERS['H']))
+        self.assertIn(blockchain.check_header(self.HEADERS['C']), (chain_u, chain_l))
+        # as read back from the headers file
+        header = chain_u.read_header(3)
+        self.assertIsInstance(header, blockchain.Header)
+        self.assertIn(blockchain.check_header(header), (chain_u, chain_l))
+        self.assertIsNone(blockchain.check_header(self.HEADERS['P']))
+        self.assertIsNone(blockchain.check_header(None))
+
+    def test_verify_chunk_of_regtest_headers(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        self._append_header(chain_u, self.HEADERS['A'])
+        # regtest bits (0x207fffff) are not valid targets for DGW v3
+        chunk = bfh(''.join(serialize_header(self.HEADERS[name])
+                            for name in 'ABCDEFOPQRSTU'))
+        chain_u.verify_chunk(0, chunk)
+        chain_u.save_chunk(0, chunk)
+        self.assertEqual(13, chain_u.size())
+        self.assertEqual(self.HEADERS['U'], chain_u.read_header(12))
+
+    @mock.patch.object(blockchain, 'CHUNK_SIZE', 4)
+    def test_connect_chunks_checks_stored_headers(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQRSTU':
+            self._append_header(chain_u, self.HEADERS[name])
+        def chunk(names):
+            return ''.join(serialize_header(self.HEADERS[name]) for name in names)
+        # the second chunk conflicts with the stored headers
+        self.assertEqual(1, chain_u.connect_chunks(0, [chunk('ABCD'), chunk('EFGH'), chunk('IJKL')]))
+        self.assertEqual(4, chain_u.size())
+        self.assertEqual(3, chain_u.connect_chunks(0, [chunk('ABCD'), chunk('EFOP'), chunk('QRST')]))
+        self.assertEqual(self.HEADERS['T'], chain_u.read_header(11))
+
+    def test_read_header_cache_is_invalidated_on_write(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFO':
+            self._append_header(chain_u, self.HEADERS[name])
+        self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+        # cached headers are immutable
+        with self.assertRaises(TypeError):
+            chain_u.read_header(6)['nonce'] = 42
+        # overwrite tip with a sibling header
+        chain_u.write(bfh(blockchain.serialize_header(self.HEADERS['G'])), 6 * 80)
+        self.assertEqual(self.HEADERS['G'], chain_u.read_header(6))
+        # truncate
+        chain_u.write(b'', 5 * 80)
+        self.assertEqual(5, chain_u.size())
+        self.assertIsNone(chain_u.read_header(6))
+        self.assertEqual(self.HEADERS['E'], chain_u.read_header(4))
+
+    def test_appended_headers_are_fsynced_in_batches(self):
+        self.config.set_key('headers_fsync_batch', 3)
+        self.config.set_key('headers_fsync_interval', 1000)
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        with mock.patch('os.fsync') as fsync:
+            for name in 'ABCDEFO':
+                self._append_header(chain_u, self.HEADERS[name])
+            self.assertEqual(2, fsync.call_count)
+            self.assertEqual(7 * 80, os.stat(chain_u.path()).st_size)
+            blockchain.sync_headers_files()
+            self.assertEqual(3, fsync.call_count)
+            blockchain.sync_headers_files()
+            self.assertEqual(3, fsync.call_count)
+            # overwriting durable headers is fsynced right away
+            chain_l = chain_u.fork(self.HEADERS['G'])
+            self._append_header(chain_l, self.HEADERS['H'])
+            self.assertEqual(0, chain_l.forkpoint)  # swapped
+            self.assertEqual(chain_u._size, chain_u._durable_size)
+            self.assertEqual(chain_l._size, chain_l._durable_size)
+
+    def test_truncate_torn_tail(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFO':
+            self._append_header(chain_u, self.HEADERS[name])
+        # header Q does not connect to O, followed by a partial header
+        with open(chain_u.path(), 'ab') as f:
+            f.write(bfh(blockchain.serialize_header(self.HEADERS['Q'])))
+            f.write(b'\x00' * 30)
+        chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        self.assertEqual(8, chain_u.size())
+        chain_u.truncate_torn_tail()
+        self.assertEqual(7, chain_u.size())
+        self.assertEqual(7 * 80, os.stat(chain_u.path()).st_size)
+        self.assertEqual(self.HEADERS['O'], chain_u.read_header(6))
+
+
+    def _setup_fork_files(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain_u.path(), 'w+').close()
+        for name in 'ABCDEFOPQRSTU':
+            self._append_header(chain_u, self.HEADERS[name])
+        chain_l = chain_u.fork(self.HEADERS['G'])
+        for name in 'HIJKL':
+            self._append_header(chain_l, self.HEADERS[name])
+        blockchain.sync_headers_files()
+        for b in (chain_u, chain_l):
+            b.close_headers_file()
+        blockchain.blockchains = {}
+        return chain_l.path()
+
+    def test_forks_index_skips_checks_of_unchanged_forks(self):
+        fork_path = self._setup_fork_files()
+        blockchain.read_blockchains(self.config)
+        self.assertEqual(2, len(blockchain.blockchains))
+        forks_index = blockchain.read_forks_index(self.config)
+        self.assertEqual([os.path.basename(fork_path)], list(forks_index))
+        self.assertEqual(6, forks_index[os.path.basename(fork_path)]['size'])
+        blockchain.blockchains = {}
+        with mock.patch.object(Blockchain, 'truncate_torn_tail', autospec=True,
+                               side_effect=Blockchain.truncate_torn_tail) as f:
+            blockchain.read_blockchains(self.config)
+            self.assertEqual(1, f.call_count)  # best chain only
+        self.assertEqual(2, len(blockchain.blockchains))
+        # the fork file is not read until it is used
+        chain_l = blockchain.blockchains[hash_header(self.HEADERS['G'])]
+        self.assertEqual(11, chain_l.height())
+        self.assertIsNone(chain_l._headers_mmap)
+        self.assertEqual(hash_header(self.HEADERS['L']), chain_l.get_hash(11))
+        blockchain.write_forks_index(self.config)
+        self.assertIsNone(chain_l._headers_mmap)
+        self.assertEqual(self.HEADERS['K'], chain_l.read_header(10))
+        # a fork that changed since the index was written is checked again
+        with open(fork_path, 'ab') as f:
+            f.write(b'\x00' * 30)
+        blockchain.blockchains = {}
+        with mock.patch.object(Blockchain, 'truncate_torn_tail', autospec=True,
+                               side_effect=Blockchain.truncate_torn_tail) as f:
+            blockchain.read_blockchains(self.config)
+            self.assertEqual(2, f.call_count)
+        self.assertEqual(6 * 80, os.stat(fork_path).st_size)
+
+    def test_stale_forks_are_pruned(self):
+        fork_path = self._setup_fork_files()
+        self.config.set_key('fork_prune_depth', 2)
+        blockchain.read_blockchains(self.config)
+        self.assertEqual(2, len(blockchain.blockchains))  # fork tip is 1 block behind
+        self.config.set_key('fork_prune_depth', 0)
+        blockchain.blockchains = {}
+        blockchain.read_blockchains(self.config)
+        self.assertEqual([constants.net.GENESIS], list(blockchain.blockchains))
+        self.assertFalse(os.path.exists(fork_path))
+        self.assertEqual({}, blockchain.read_forks_index(self.config))
+
+class TestChainworkIndex(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        blockchain.blockchains = {}
+        self._saved_cache = dict(blockchain._CHAINWORK_CACHE)
+        blockchain.read_blockchains(self.config)
+        self.index_path = os.path.join(self.electrum_path, 'chainwork_index')
+
+    def tearDown(self):
+        blockchain._CHAINWORK_CACHE.clear()
+        blockchain._CHAINWORK_CACHE.update(self._saved_cache)
+        blockchain._chainwork_index_path = None
+        super().tearDown()
+
+    def _reload(self):
+        blockchain._CHAINWORK_CACHE.clear()
+        blockchain._CHAINWORK_CACHE.update(self._saved_cache)
+        blockchain.read_chainwork_index(self.config)
+
+    def test_chainwork_is_persisted(self):
+        best_chain = blockchain.get_best_chain()
+        height = constants.net.max_checkpoint()
+        work = best_chain.get_chainwork(height + 1)
+        num_chunks = len(constants.net.CHECKPOINTS)
+        self.assertEqual(num_chunks * blockchain.CHAINWORK_RECORD_SIZE,
+                         os.path.getsize(self.index_path))
+        self._reload()
+        self.assertEqual(work - best_chain.chainwork_of_header_at_height(height + 1),
+                         blockchain._CHAINWORK_CACHE[best_chain.get_hash(height)])
+        with mock.patch.object(best_chain, 'chainwork_of_header_at_height',
+                               wraps=best_chain.chainwork_of_header_at_height) as f:
+            self.assertEqual(work, best_chain.get_chainwork(height + 1))
+            self.assertEqual(1, f.call_count)  # only the partial chunk
+
+    def test_invalid_index_is_dropped(self):
+        best_chain = blockchain.get_best_chain()
+        best_chain.get_chainwork(constants.net.max_checkpoint())
+        with open(self.index_path, 'rb+') as f:
+            f.seek(32)
+            f.write(b'\xff')
+        self._reload()
+        self.assertFalse(os.path.exists(self.index_path))
+        self.assertEqual(len(self._saved_cache), len(blockchain._CHAINWORK_CACHE))
+
+    def test_records_of_other_chains_are_dropped(self):
+        best_chain = blockchain.get_best_chain()
+        best_chain.get_chainwork(constants.net.max_checkpoint())
+        self._reload()
+        cache = dict(blockchain._CHAINWORK_CACHE)
+        size = os.path.getsize(self.index_path)
+        with open(self.index_path, 'ab') as f:
+            f.write(b'\x01' * 32 + (10**30).to_bytes(32, byteorder='big'))
+        self._reload()
+        self.assertEqual(size, os.path.getsize(self.index_path))
+        self.assertEqual(cache, blockchain._CHAINWORK_CACHE)
+
+    def test_torn_record_is_truncated(self):
+        best_chain = blockchain.get_best_chain()
+        best_chain.get_chainwork(constants.net.max_checkpoint())
+        size = os.path.getsize(self.index_path)
+        with open(self.index_path, 'ab') as f:
+            f.write(b'\x01' * 10)
+        self._reload()
+        self.assertEqual(size, os.path.getsize(self.index_path))
+
+
+class TestCheckpoints(ElectrumTestCase):
+
+    def test_serialize_roundtrip(self):
+        checkpoints = [(hash_header(TestBlockchain.HEADERS['U']), 2**200 + 12345,
+                        [[12, blockchain.serialize_header(TestBlockchain.HEADERS['U'])],
+                         [11, blockchain.serialize_header(TestBlockchain.HEADERS['T'])]]),
+                       (hash_header(TestBlockchain.HEADERS['Z']), blockchain.MAX_TARGET, [])]
+        path = os.path.join(self.electrum_path, 'checkpoints.bin')
+        with open(path, 'wb') as f:
+            f.write(constants.serialize_checkpoints(checkpoints))
+        cps = constants.Checkpoints(path)
+        self.assertEqual(2, len(cps))
+        for i, (h, target, extra_headers) in enumerate(checkpoints):
+            self.assertEqual((h, target, extra_headers), cps[i])
+            self.assertEqual(h, cps.get_hash(i))
+            self.assertEqual(target, cps.get_target(i))
+        self.assertEqual([(12, bfh(checkpoints[0][2][0][1])), (11, bfh(checkpoints[0][2][1][1]))],
+                         cps.get_raw_extra_headers(0))
+        self.assertEqual(cps[1], cps[-1])
+        self.assertEqual([cps[1]], cps[1:])
+        with self.assertRaises(IndexError):
+            cps[2]
+
+    def test_shipped_checkpoints(self):
+        cps = constants.BitcoinMainnet.CHECKPOINTS
+        self.assertIsInstance(cps, constants.Checkpoints)
+        h, target, extra_headers = cps[10]
+        self.assertEqual(25, len(extra_headers))
+        self.assertEqual(11 * constants.CHUNK_SIZE - 1, extra_headers[0][0])
+        self.assertEqual(h, hash_header(deserialize_header(bfh(extra_headers[0][1]), extra_headers[0][0])))
+
 
 class TestVerifyHeader(ElectrumTestCase):
 
@@ -399,6 +674,24 @@ class TestVerifyHeader(ElectrumTestCase):
     def test_valid_header(self):
         Blockchain.verify_header(self.header, self.prev_hash, self.target)
 
+    def test_header_record(self):
+        header_dict = {
+            'version': 0x20000000,
+            'prev_block_hash': self.prev_hash,
+            'merkle_root': '80e32e0d26681792f122d3a44fcd2bfaa64b33ba1b0fbc02c03d5dd6e8f334f0',
+            'timestamp': 1593498337,
+            'bits': 420989726,
+            'nonce': 3266984010,
+            'block_height': 1296288,
+        }
+        self.assertEqual(header_dict, self.header)
+        self.assertEqual(self.header, header_dict)
+        self.assertEqual(header_dict, self.header.to_dict())
+        self.assertEqual(self.valid_header, blockchain.serialize_header(self.header))
+        self.assertEqual(hash_header(dict(header_dict)), hash_header(self.header))
+        with self.assertRaises(KeyError):
+            self.header['height']
+
     def test_expected_hash_mismatch(self):
         with self.assertRaises(Exception):
             Blockchain.verify_header(self.header, self.prev_hash, self.target,
@@ -414,6 +707,69 @@ class TestVerifyHeader(ElectrumTestCase):
             Blockchain.verify_header(self.header, self.prev_hash, other_target)
 
     def test_insufficient_pow(self):
+        header = deserialize_header(bfh(serialize_header(dict(self.header, nonce=42))),
+                                    self.header['block_height'])
+        self.assertEqual(42, header['nonce'])
+        with self.assertRaisesRegex(Exception, 'insufficient proof of work'):
+            Blockchain.verify_header(header, self.prev_hash, self.target)
+
+    def test_precomputed_hash(self):
+        header_hash, = blockchain.hash_headers([bfh(self.valid_header)])
+        self.assertEqual(hash_header(self.header), header_hash)
+        Blockchain.verify_header(self.header, self.prev_hash, self.target,
+                                 header_hash=header_hash)
         with self.assertRaises(Exception):
-            self.header["nonce"] = 42
-            Blockchain.verify_header(self.header, self.prev_hash, self.target)
+            Blockchain.verify_header(self.header, self.prev_hash, self.target,
+                                     header_hash='ff' * 32)
+
+    def test_hash_headers(self):
+        headers = list(TestBlockchain.HEADERS.values())
+        raw_headers = [bfh(blockchain.serialize_header(h)) for h in headers]
+        self.assertEqual([hash_header(h) for h in headers],
+                         blockchain.hash_headers(raw_headers))
+        self.assertEqual([], blockchain.hash_headers([]))
+
+    @mock.patch.object(blockchain, '_pow_hash_executor', None)
+    @mock.patch.object(blockchain, '_pow_hash_executor_shut_down', False)
+    @mock.patch.object(blockchain, '_pow_hash_workers', 2)
+    @mock.patch.object(blockchain, 'POW_HASH_MIN_BATCH', 2)
+    def test_hash_headers_after_shutdown(self):
+        headers = list(TestBlockchain.HEADERS.values())
+        raw_headers = [bfh(blockchain.serialize_header(h)) for h in headers]
+        expected = [hash_header(h) for h in headers]
+        self.assertEqual(expected, blockchain.hash_headers(raw_headers))
+        executor = blockchain._pow_hash_executor
+        self.assertIsNotNone(executor)
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            # not forked from this process, which has threads
+            self.assertEqual('spawn', executor._mp_context.get_start_method())
+        blockchain.shutdown_pow_hash_executor()
+        self.assertIsNone(blockchain._pow_hash_executor)
+        # the pool is not created again
+        self.assertEqual(expected, blockchain.hash_headers(raw_headers))
+        self.assertIsNone(blockchain._pow_hash_executor)
+
+
+class TestDGW(ElectrumTestCase):
+
+    def test_target_to_bits_roundtrip(self):
+        for bits in (0x1b0404cb, 0x1d00ffff, 0x1e0fffff, 0x19015f53, 0x03008000):
+            self.assertEqual(bits, Blockchain.target_to_bits(Blockchain.bits_to_target(bits)))
+        self.assertEqual(0x03000000, Blockchain.target_to_bits(0))
+        self.assertEqual(0x04008000, Blockchain.target_to_bits(0x800000))
+
+    def test_window_target_matches_checkpoint_headers(self):
+        checked = 0
+        for _, _, extra_headers in constants.net.CHECKPOINTS[-20:]:
+            headers = [deserialize_header(bfh(raw), height)
+                       for height, raw in sorted(extra_headers)]
+            window = blockchain.DGWWindow()
+            with self.assertRaises(blockchain.MissingHeader):
+                window.get_target()
+            for header in headers[:-1]:
+                window.append_header(header)
+            self.assertEqual(blockchain.DGW_PAST_BLOCKS, len(window))
+            target = window.get_target()
+            self.assertEqual(headers[-1]['bits'], Blockchain.target_to_bits(target))
+            checked += 1
+        self.assertEqual(20, checked)
@@ -1,4 +1,5 @@
-from electrum_dash.coinchooser import CoinChooserPrivacy
+from electrum_dash.coinchooser import (CoinChooserPrivacy, CoinChooserBranchAndBound,
+                                        Bucket, PRNG)
 from electrum_dash.util import NotEnoughFunds
 
 from . import ElectrumTestCase
@@ -18,3 +19,26 @@ class TestCoinChooser(ElectrumTestCase):
             coin_chooser.bucket_candidates_any([], sufficient_funds)
         with self.assertRaises(NotEnoughFunds):
             coin_chooser.bucket_candidates_prefer_confirmed([], sufficient_funds)
+
+    def test_search_changeless(self):
+        def bucket(desc, effective_value):
+            return Bucket(desc=desc, weight=0, value=effective_value,
+                          effective_value=effective_value, coins=[],
+                          min_height=1, max_rounds=None)
+        buckets = [bucket(str(i), v)
+                   for i, v in enumerate([5000, 3000, 3000, 2000, 700, 10])]
+        coin_chooser = CoinChooserBranchAndBound(enable_output_value_rounding=False)
+        coin_chooser.p = PRNG(b'coins')
+
+        def search(target, cost_of_change):
+            res = coin_chooser.search_changeless(buckets, target, cost_of_change)
+            return None if res is None else sorted(b.effective_value for b in res)
+        self.assertEqual([3000, 5000], search(8000, 1))
+        self.assertEqual([10, 700, 2000, 5000], search(7705, 10))
+        self.assertEqual([700, 3000], search(3600, 200))
+        self.assertEqual([5000], search(4500, 600))
+        self.assertEqual(None, search(4500, 100))
+        self.assertEqual(None, search(14000, 1000))
+        # equal values are tried once
+        coin_chooser.BNB_MAX_TRIES = 10
+        self.assertEqual([700, 2000, 3000, 3000, 5000], search(13700, 1))
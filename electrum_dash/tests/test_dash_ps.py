@@ -14,6 +14,7 @@ from electrum_dash.address_synchronizer import (TX_HEIGHT_LOCAL,
                                                 TX_HEIGHT_UNCONF_PARENT,
                                                 TX_HEIGHT_UNCONFIRMED)
 from electrum_dash.bitcoin import COIN
+from electrum_dash.coinchooser import CoinChooserPrivateSend, PSCoin
 from electrum_dash.dash_ps_util import (COLLATERAL_VAL, CREATE_COLLATERAL_VAL,
                                         CREATE_COLLATERAL_VALS, PS_DENOMS_VALS,
                                         MIN_DENOM_VAL, PSMinRoundsCheckFailed,
@@ -624,6 +625,51 @@ class PSWalletTestCase(TestCaseForTestnet):
         assert len(self.wallet.db.get_ps_addresses(min_rounds=2)) == 77
         assert len(self.wallet.db.get_ps_addresses(min_rounds=3)) == 0
 
+    def test_ps_indexes(self):
+        w = self.wallet
+        psman = w.psman
+        coro = psman.find_untracked_ps_txs(log=False)
+        asyncio.get_event_loop().run_until_complete(coro)
+
+        def indexes():
+            db = w.db
+            return (copy.deepcopy(db._ps_denoms_by_rounds),
+                    copy.deepcopy(db._ps_denoms_by_value),
+                    copy.deepcopy(db._ps_reserved_by_data),
+                    Counter(db._ps_addrs), Counter(db._ps_unspent_addrs))
+
+        def check_indexes():
+            kept = indexes()
+            w.db._load_ps_indexes()
+            assert kept == indexes()
+
+        check_indexes()
+        outpoint, denom = list(w.db.get_ps_denoms(min_rounds=2).items())[0]
+        assert outpoint in w.db.get_ps_denoms(min_rounds=2, max_rounds=2)
+        assert outpoint not in w.db.get_ps_denoms(max_rounds=1)
+        psman.pop_ps_denom(outpoint)
+        w.db.add_ps_spent_denom(outpoint, denom)
+        check_indexes()
+        assert denom[0] not in w.db.get_unspent_ps_addresses()
+        assert denom[0] in w.db.get_ps_addresses()
+        w.db.pop_ps_spent_denom(outpoint)
+        assert denom[0] not in w.db.get_ps_addresses()
+        psman.add_ps_denom(outpoint, denom)
+        psman.add_ps_denom(outpoint, (denom[0], denom[1], denom[2] + 1))
+        check_indexes()
+        assert outpoint in w.db.get_ps_denoms(min_rounds=3)
+
+        res = psman.reserve_addresses(2, data='uuid')
+        check_indexes()
+        assert w.db.select_ps_reserved(data='uuid') == res
+        assert w.db.select_ps_reserved(for_change=True, data='uuid') == []
+        psman.pop_ps_reserved(res[0])
+        check_indexes()
+        assert w.db.select_ps_reserved(data='uuid') == res[1:]
+
+        w.db.clear_ps_data()
+        assert indexes() == ({}, {}, {}, Counter(), Counter())
+
     def test_get_spendable_coins(self):
         C_RNDS = PSCoinRounds.COLLATERAL
         psman = self.wallet.psman
@@ -795,6 +841,84 @@ class PSWalletTestCase(TestCaseForTestnet):
         coins = self.wallet.get_utxos(min_rounds=3)
         assert len(coins) == 0
 
+    def test_addr_balance_index(self):
+        w = self.wallet
+        psman = w.psman
+
+        def scan_addr_balance(addr, excluded_coins, min_rounds):
+            ps_denoms = w.db.get_ps_denoms(min_rounds=min_rounds)
+            received, sent = w.get_addr_io(addr)
+            c = u = 0
+            for txo, (tx_height, v, is_cb, islock) in received.items():
+                if min_rounds is not None and txo not in ps_denoms:
+                    continue
+                if txo in excluded_coins:
+                    continue
+                c += v
+                if txo in sent:
+                    c -= v
+            return c, u, 0
+
+        def check_balances():
+            coins = [c.prevout.to_str() for c in w.get_utxos(include_ps=True)]
+            excluded_coins = set(coins[::3])
+            for addr in w.get_addresses() + psman.get_addresses():
+                for min_rounds in [None, 0, 1, 2, 3]:
+                    for excluded in [set(), excluded_coins]:
+                        assert w.get_addr_balance(addr, excluded_coins=excluded,
+                                                  min_rounds=min_rounds) == \
+                            scan_addr_balance(addr, excluded, min_rounds)
+
+        check_balances()
+        coro = psman.find_untracked_ps_txs(log=False)
+        asyncio.get_event_loop().run_until_complete(coro)
+        check_balances()
+
+        # the index follows changes of PS denoms
+        outpoint, denom = list(w.db.get_ps_denoms(min_rounds=2).items())[0]
+        addr = denom[0]
+        assert w.get_addr_balance(addr, min_rounds=2)[0] >= denom[1]
+        balance = w.get_addr_balance(addr, min_rounds=2)
+        psman.pop_ps_denom(outpoint)
+        assert w.get_addr_balance(addr, min_rounds=2)[0] == balance[0] - denom[1]
+        psman.add_ps_denom(outpoint, denom)
+        assert w.get_addr_balance(addr, min_rounds=2) == balance
+
+        # and heights of txs
+        txid = outpoint.split(':')[0]
+        w.add_unverified_tx(txid, TX_HEIGHT_UNCONFIRMED)
+        c, u, x = w.get_addr_balance(addr, min_rounds=2)
+        assert u >= denom[1]
+        assert (c + u, x) == (balance[0], 0)
+
+    def test_addr_outputs_index(self):
+        w = self.wallet
+        for addr in w.get_addresses():
+            coins, spent = w.get_addr_io(addr)
+            outputs = w.get_addr_outputs(addr)
+            assert set(coins) == {o.prevout.to_str() for o in outputs.values()}
+            for o in outputs.values():
+                prevout_str = o.prevout.to_str()
+                assert (o.block_height, o.value_sats(), o.islock) == \
+                    (coins[prevout_str][0], coins[prevout_str][1],
+                     coins[prevout_str][3])
+                assert (o.spent_height, o.spent_islock) == \
+                    spent.get(prevout_str, (None, None))
+            assert set(w.get_addr_utxo(addr)) == \
+                {k for k, o in outputs.items() if o.spent_height is None}
+
+        # removing the spending tx makes the spent output a coin again
+        coin = next(c for c in w.get_utxos(include_ps=True)
+                    if w.db.get_txi_addresses(c.prevout.txid.hex()))
+        txid = coin.prevout.txid.hex()
+        addr = w.db.get_txi_addresses(txid)[0]
+        prevout = next(k for k, o in w.get_addr_outputs(addr).items()
+                       if o.spent_height is not None
+                       and w.db.get_spent_outpoint(k.txid.hex(), k.out_idx) == txid)
+        assert prevout not in w.get_addr_utxo(addr)
+        w.remove_transaction(txid)
+        assert prevout in w.get_addr_utxo(addr)
+
     def test_keep_amount(self):
         psman = self.wallet.psman
         assert psman.keep_amount == psman.DEFAULT_KEEP_AMOUNT
@@ -2928,6 +3052,35 @@ class PSWalletTestCase(TestCaseForTestnet):
         with self.assertRaises(NotEnoughFunds):
             tx = w.make_unsigned_transaction(coins=coins, outputs=outputs)
 
+    def test_make_unsigned_transaction_branch_and_bound(self):
+        w = self.wallet
+        psman = w.psman
+        coro = psman.find_untracked_ps_txs(log=False)
+        asyncio.get_event_loop().run_until_complete(coro)
+        self.config.set_key('coin_chooser', 'BranchAndBound')
+        spend_to = 'yiXJV2PodX4uuadFtt6e7wMTNkydHpp8ns'
+        coins = w.get_spendable_coins(domain=None)
+        for amount in [0.0123, 0.123, 1.23, 5.123]:
+            amount_duffs = to_duffs(amount)
+            outputs = [PartialTxOutput.from_address_and_value(spend_to, amount_duffs)]
+            tx = w.make_unsigned_transaction(coins=coins, outputs=outputs)
+            assert tx.get_fee() >= tx.estimated_size()
+            assert amount_duffs in [o.value for o in tx.outputs()]
+            tx2 = w.make_unsigned_transaction(coins=coins, outputs=outputs)
+            assert tx.txid() == tx2.txid()
+
+        # an address paying the amount and the fee is spent without change
+        addr_coins = defaultdict(list)
+        for c in coins:
+            addr_coins[c.address].append(c)
+        addr = max(addr_coins, key=lambda a: sum(c.value_sats() for c in addr_coins[a]))
+        addr_value = sum(c.value_sats() for c in addr_coins[addr])
+        amount_duffs = addr_value - 200 * len(addr_coins[addr])
+        outputs = [PartialTxOutput.from_address_and_value(spend_to, amount_duffs)]
+        tx = w.make_unsigned_transaction(coins=coins, outputs=outputs)
+        assert [o.value for o in tx.outputs()] == [amount_duffs]
+        assert {txin.address for txin in tx.inputs()} == {addr}
+
     def test_make_unsigned_transaction_include_ps(self):
         w = self.wallet
         psman = w.psman
@@ -3051,6 +3204,30 @@ class PSWalletTestCase(TestCaseForTestnet):
         assert min(test_fees) == 1000
         assert max(test_fees) == 100011
 
+    def test_coin_chooser_privatesend_estimated_sizes(self):
+        w = self.wallet
+        psman = w.psman
+        coro = psman.find_untracked_ps_txs(log=False)
+        asyncio.get_event_loop().run_until_complete(coro)
+        spend_to = 'yiXJV2PodX4uuadFtt6e7wMTNkydHpp8ns'
+        coins = w.get_spendable_coins(None, min_rounds=2)
+        coin_chooser = CoinChooserPrivateSend(psman)
+        ps_coins = [PSCoin(c, c.value_sats(), c.ps_rounds, c.prevout.txid.hex(),
+                           Transaction.estimated_input_weight(c) // 4)
+                    for c in coins]
+        ps_coins.sort(key=lambda c: c.value, reverse=True)
+        for amount in [0.001, 0.0123, 0.123, 1.23, 2.5]:
+            outputs = [PartialTxOutput.from_address_and_value(spend_to,
+                                                              to_duffs(amount))]
+            base_tx = PartialTransaction.from_io([], outputs)
+            txs = coin_chooser.select_candidate_txs(ps_coins, base_tx,
+                                                    lambda size: size, 2, True)
+            assert txs
+            for cand in txs:
+                tx = PartialTransaction.from_io(cand.coins, outputs)
+                assert cand.estimated_fee == tx.estimated_size()
+                assert cand.fee == tx.get_fee()
+
     def test_make_unsigned_transaction_high_fees(self):
         C_RNDS = PSCoinRounds.COLLATERAL
         w = self.wallet
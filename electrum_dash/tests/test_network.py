@@ -1,19 +1,30 @@
 import asyncio
 import tempfile
+import threading
 import unittest
 
+from aiorpcx import RPCError, TaskGroup
+from aiorpcx.jsonrpc import JSONRPC
+
 from electrum_dash import constants
 from electrum_dash.simple_config import SimpleConfig
 from electrum_dash import blockchain
-from electrum_dash.interface import Interface, ServerAddr
+from electrum_dash.interface import Interface, ServerAddr, RequestTimedOut
+from electrum_dash.synchronizer import RequestBatcher, SynchronizerBase, SubscriptionShard
 from electrum_dash.crypto import sha256
+from electrum_dash.logging import get_logger
 from electrum_dash.util import bh2u
 
 from . import ElectrumTestCase
 
 
 class MockTaskGroup:
-    async def spawn(self, x): return
+    async def spawn(self, x):
+        x.close()  # the interface is driven by the tests instead
+        return asyncio.ensure_future(asyncio.sleep(0))
+
+class MockSession:
+    def is_closing(self): return False
 
 class MockNetwork:
     taskgroup = MockTaskGroup()
@@ -116,7 +127,235 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(('catchup', 7), asyncio.get_event_loop().run_until_complete(ifa.sync_until(8, next_height=6)))
         self.assertEqual(self.interface.q.qsize(), 0)
 
+    def _setup_chunk_sync(self, *, other_tip=None, bad_chunks_from_other=(), off_chain_from_other=()):
+        # chunk data is one header: zeros on the chain of the main server,
+        # ff does not connect, 01 connects but is on another chain
+        fetched = []
+        connected = []
+        connected_data = []
+        connect_threads = set()
+
+        class MockChunkInterface:
+            def __init__(self, name, tip):
+                self.server, self.tip = name, tip
+                self.session = None
+            async def _fetch_chunk(iface, index, tip=None):
+                await asyncio.sleep(0.001 * (index % 3))
+                fetched.append((index, iface.server))
+                if iface.server == 'other' and index in bad_chunks_from_other:
+                    return 'ff' * blockchain.HEADER_SIZE
+                if iface.server == 'other' and index in off_chain_from_other:
+                    return '01' * blockchain.HEADER_SIZE
+                return '00' * blockchain.HEADER_SIZE
+
+        class MockChain:
+            def connect_chunks(chain, start_idx, hexdatas):
+                connect_threads.add(threading.current_thread())
+                num = 0
+                for hexdata in hexdatas:
+                    if hexdata.startswith('ff'):
+                        break
+                    connected_data.append(hexdata)
+                    num += 1
+                connected.append((start_idx, num))
+                return num
+            def connect_chunk(chain, idx, hexdata):
+                return chain.connect_chunks(idx, [hexdata]) == 1
+
+        async def get_block_header(height, assert_mode):
+            return blockchain.deserialize_header(bytes(blockchain.HEADER_SIZE), height)
+
+        ifa = self.interface
+        ifa.blockchain = MockChain()
+        ifa.get_block_header = get_block_header
+        ifa._fetch_chunk = MockChunkInterface('main', ifa.tip)._fetch_chunk
+        ifa.network.interfaces_lock = threading.Lock()
+        ifa.network.interfaces = {}
+        if other_tip is not None:
+            other = MockChunkInterface('other', other_tip)
+            other.session = MockSession()
+            ifa.network.interfaces['other'] = other
+        self.connected_data = connected_data
+        self.connect_threads = connect_threads
+        return fetched, connected
+
+    def test_request_chunks_in_order(self):
+        fetched, connected = self._setup_chunk_sync()
+        res = asyncio.get_event_loop().run_until_complete(self.interface.request_chunks(0, 9 * 2016 + 5))
+        self.assertEqual((True, 10), res)
+        self.assertEqual(list(range(10)), sorted(index for index, _ in fetched))
+        # chunks are connected in order, without gaps
+        next_idx = 0
+        for start_idx, num in connected:
+            self.assertEqual(next_idx, start_idx)
+            next_idx += num
+        self.assertEqual(10, next_idx)
+        # verified off the event loop
+        self.assertNotIn(threading.current_thread(), self.connect_threads)
+
+    def test_request_chunks_refetches_bad_chunk_from_main_server(self):
+        fetched, connected = self._setup_chunk_sync(other_tip=10 * 2016, bad_chunks_from_other=(3,))
+        res = asyncio.get_event_loop().run_until_complete(self.interface.request_chunks(0, 7 * 2016))
+        self.assertEqual((True, 8), res)
+        self.assertIn((3, 'other'), fetched)
+        self.assertIn((3, 'main'), fetched)
+        self.assertIn((1, 'other'), fetched)
+
+    def test_request_chunks_checks_chunks_from_other_server(self):
+        fetched, connected = self._setup_chunk_sync(other_tip=10 * 2016, off_chain_from_other=(3,))
+        res = asyncio.get_event_loop().run_until_complete(self.interface.request_chunks(0, 7 * 2016))
+        self.assertEqual((True, 8), res)
+        self.assertIn((3, 'other'), fetched)
+        self.assertIn((3, 'main'), fetched)
+        self.assertEqual(['00' * blockchain.HEADER_SIZE] * 8, self.connected_data)
+
+    def test_request_batcher_coalesces_requests(self):
+        batches = []
+
+        async def send_batch(args):
+            batches.append(args)
+            await asyncio.sleep(0.001)
+            return [RPCError(1, 'not found') if arg == 7 else arg * 2 for arg in args]
+
+        async def run():
+            results = {}
+
+            async def request(arg):
+                try:
+                    results[arg] = await batcher.request(arg)
+                except RPCError as e:
+                    results[arg] = e.message
+            batcher = RequestBatcher(send_batch, semaphore=asyncio.Semaphore(100), target_time=10)
+            async with TaskGroup() as group:
+                await batcher.run(taskgroup=group)
+                for arg in range(100):
+                    await group.spawn(request(arg))
+                while len(results) < 100:
+                    await asyncio.sleep(0.001)
+                await group.cancel_remaining()
+            return results
+        results = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual('not found', results.pop(7))
+        self.assertEqual({arg: arg * 2 for arg in range(100) if arg != 7}, results)
+        self.assertEqual(list(range(100)), sorted(sum(batches, [])))
+        self.assertLess(len(batches), 20)
+
+    def test_batch_requests_fall_back_to_single_requests(self):
+        sent = []
+
+        class MockBatchSession:
+            async def send_batch_request(self, requests):
+                sent.append(requests)
+                raise RPCError(-32600, 'batches not supported')
+
+            async def send_request(self, method, params):
+                sent.append((method, params))
+                if params == ['bb']:
+                    raise RPCError(2, 'missing')
+                return params[0]
+        self.interface.session = MockBatchSession()
+        requests = [('m', ['aa']), ('m', ['bb'])]
+        res = asyncio.get_event_loop().run_until_complete(self.interface._send_batch_request(requests))
+        self.assertEqual('aa', res[0])
+        self.assertEqual('missing', res[1].message)
+        self.assertFalse(self.interface.supports_batch_requests)
+        self.assertEqual([requests] + requests, sent)
+        # the server is not asked for batches again
+        asyncio.get_event_loop().run_until_complete(self.interface._send_batch_request(requests))
+        self.assertEqual(1 + 2 * len(requests), len(sent))
+
+    def test_failed_batch_request_falls_back_once(self):
+        sent = []
+
+        class MockBatchSession:
+            error = RequestTimedOut('batch request timed out')
+
+            async def send_batch_request(self, requests):
+                sent.append(requests)
+                raise self.error
+
+            async def send_request(self, method, params):
+                sent.append((method, params))
+                return params[0]
+        self.interface.session = session = MockBatchSession()
+        requests = [('m', ['aa']), ('m', ['bb'])]
+        res = asyncio.get_event_loop().run_until_complete(self.interface._send_batch_request(requests))
+        self.assertEqual(['aa', 'bb'], res)
+        self.assertTrue(self.interface.supports_batch_requests)
+        self.assertEqual([requests] + requests, sent)
+        # errors other than malformed requests don't disable batches either
+        session.error = RPCError(JSONRPC.SERVER_BUSY, 'server busy')
+        res = asyncio.get_event_loop().run_until_complete(self.interface._send_batch_request(requests))
+        self.assertEqual(['aa', 'bb'], res)
+        self.assertTrue(self.interface.supports_batch_requests)
+        self.assertEqual(2 * ([requests] + requests), sent)
+
+    def test_subscription_shards_balance_and_rebalance_on_drop(self):
+        class MockShardInterface:
+            server = 'shard'
+            session = None
+            got_disconnected = asyncio.Event()
+        sync = SynchronizerBase.__new__(SynchronizerBase)
+        sync.logger = get_logger(__name__)
+        sync.requested_addrs = set()
+        sync.scripthash_to_address = {}
+        sync._shards = [SubscriptionShard(MockShardInterface())]
+        sync._shard_of = {}
+        sync._num_main_subscriptions = 0
+        sync._wakeup_event = asyncio.Event()
+
+        async def run():
+            sync.add_queue = asyncio.Queue()
+            shard = sync._shards[0]
+            # the main server is picked first, then the least used one
+            self.assertIsNone(sync._pick_shard())
+            sync._num_main_subscriptions = 1
+            self.assertIs(shard, sync._pick_shard())
+            for h, addr in (('h1', 'a1'), ('h2', 'a2')):
+                sync.scripthash_to_address[h] = addr
+                shard.scripthashes.add(h)
+                sync._shard_of[h] = shard
+            sync.requested_addrs.add('a2')  # subscription still pending
+            dropped = asyncio.ensure_future(sync._drop_shard_on_disconnect(shard))
+            await asyncio.sleep(0)
+            self.assertEqual([shard], sync._shards)
+            shard.interface.got_disconnected.set()
+            await asyncio.wait_for(dropped, 1)
+            self.assertEqual([], sync._shards)
+            self.assertEqual({}, sync._shard_of)
+            self.assertIsNone(shard.status_queue.get_nowait())
+            self.assertEqual({'a1', 'a2'}, sync.requested_addrs)
+            self.assertEqual('a1', sync.add_queue.get_nowait())
+            self.assertTrue(sync.add_queue.empty())
+            self.assertTrue(sync._wakeup_event.is_set())
+        asyncio.get_event_loop().run_until_complete(run())
+
+
 
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
+
+    def test_cross_check_skipped_on_main_server_errors(self):
+        class MockMainInterface:
+            async def get_history_for_scripthash(self, h):
+                raise self.error
+        class MockShardInterface:
+            server = 'shard'
+            session = None
+        sync = SynchronizerBase.__new__(SynchronizerBase)
+        sync.logger = get_logger(__name__)
+        sync.network = MockNetwork()
+        sync.network.get_network_timeout_seconds = lambda timeout: 0
+        sync.interface = MockMainInterface()
+        shard = SubscriptionShard(MockShardInterface())
+        sync._shards = [shard]
+        shard.statuses['h1'] = 'ab' * 32
+
+        async def run():
+            sync._network_request_semaphore = asyncio.Semaphore(1)
+            for error in (RequestTimedOut('timeout'), RPCError(1, 'error')):
+                sync.interface.error = error
+                await sync._cross_check_status(shard, 'h1')
+            self.assertEqual([shard], sync._shards)
+        asyncio.get_event_loop().run_until_complete(run())
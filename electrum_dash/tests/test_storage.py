@@ -1,8 +1,12 @@
 import os
+import json
+import zlib
+import base64
 
 from unittest.mock import patch
 
-from electrum_dash.storage import WalletStorage
+from electrum_dash.storage import WalletStorage, StorageEncryptionVersion
+from electrum_dash.util import InvalidPassword, WalletFileException
 
 from . import ElectrumTestCase
 
@@ -49,3 +53,112 @@ class TestWalletStorage(ElectrumTestCase):
         with patch('os.replace', new_callable=ReplaceWithPermissionErrorMock):
             with self.assertRaises(PermissionError):
                 storage.write(data)
+
+    def test_encrypted_stream(self):
+        path = os.path.join(self.electrum_path, 'default_wallet')
+        storage = WalletStorage(path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        data = json.dumps({'a': 'x' * 100, 'b': 'é' * 100}, ensure_ascii=False)
+        with patch('electrum_dash.storage.ENCRYPTED_CHUNK_SIZE', 64):
+            storage.write(data)
+            storage.append(',\n{"op": "remove", "path": "/a"}')
+        with open(path, 'r') as fd:
+            lines = fd.read().splitlines()
+        self.assertEqual(b'BIS1', base64.b64decode(lines[0])[:4])
+        self.assertEqual(1 + -(-len(data) // 64) + 1, len(lines))
+        storage = WalletStorage(path)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt('wrong')
+        storage.decrypt('secret')
+        self.assertEqual(data + ',\n{"op": "remove", "path": "/a"}', storage.read())
+        # chunks can not be reordered
+        lines[2], lines[3] = lines[3], lines[2]
+        with open(path, 'w') as fd:
+            fd.write('\n'.join(lines))
+        storage = WalletStorage(path)
+        with self.assertRaises(WalletFileException):
+            storage.decrypt('secret')
+
+    def test_encrypted_stream_with_torn_last_chunk(self):
+        path = os.path.join(self.electrum_path, 'default_wallet')
+        storage = WalletStorage(path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        data = json.dumps({'a': 'x' * 100})
+        with patch('electrum_dash.storage.ENCRYPTED_CHUNK_SIZE', 64):
+            storage.write(data)
+            storage.append(',\n{"op": "remove", "path": "/a"}')
+        # cut off the appended chunk in the middle
+        with open(path, 'r+') as fd:
+            fd.truncate(os.path.getsize(path) - 20)
+        storage = WalletStorage(path)
+        storage.decrypt('secret')
+        self.assertEqual(data, storage.read())
+        self.assertTrue(storage.needs_consolidation())
+        storage.write(data)
+        self.assertFalse(storage.needs_consolidation())
+        storage.append(',\n{"op": "remove", "path": "/a"}')
+        storage = WalletStorage(path)
+        storage.decrypt('secret')
+        self.assertEqual(data + ',\n{"op": "remove", "path": "/a"}', storage.read())
+
+    def test_encrypted_stream_with_missing_last_chunks(self):
+        path = os.path.join(self.electrum_path, 'default_wallet')
+        storage = WalletStorage(path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        data = json.dumps({'a': 'x' * 100})
+        change = ',\n{"op": "replace", "path": "/a", "value": "%s"}' % ('y' * 100)
+        with patch('electrum_dash.storage.ENCRYPTED_CHUNK_SIZE', 64):
+            storage.write(data)
+            storage.append(change)
+        with open(path, 'r') as fd:
+            lines = fd.read().splitlines(keepends=True)
+        # the last chunk of the append is lost: the whole append is dropped
+        with open(path, 'w') as fd:
+            fd.write(''.join(lines[:-1]))
+        storage = WalletStorage(path)
+        storage.decrypt('secret')
+        self.assertEqual(data, storage.read())
+        self.assertTrue(storage.needs_consolidation())
+        # chunks of the snapshot are lost
+        with open(path, 'w') as fd:
+            fd.write(''.join(lines[:2]))
+        storage = WalletStorage(path)
+        with self.assertRaises(WalletFileException):
+            storage.decrypt('secret')
+
+    def test_encrypted_stream_with_tampered_last_chunk(self):
+        path = os.path.join(self.electrum_path, 'default_wallet')
+        storage = WalletStorage(path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        data = json.dumps({'a': 'x' * 100})
+        storage.write(data)
+        storage.append(',\n{"op": "remove", "path": "/a"}')
+        with open(path, 'r') as fd:
+            lines = fd.read().splitlines(keepends=True)
+        last = bytearray(base64.b64decode(lines[-1]))
+        last[-1] ^= 1
+        lines[-1] = base64.b64encode(bytes(last)).decode('ascii') + '\n'
+        with open(path, 'w') as fd:
+            fd.write(''.join(lines))
+        storage = WalletStorage(path)
+        with self.assertRaises(WalletFileException):
+            storage.decrypt('secret')
+
+    def test_legacy_encryption_is_migrated(self):
+        path = os.path.join(self.electrum_path, 'default_wallet')
+        data = json.dumps({'a': 1})
+        pubkey = WalletStorage.get_eckey_from_password('secret')
+        with open(path, 'w') as fd:
+            fd.write(pubkey.encrypt_message(zlib.compress(data.encode('utf8')), b'BIE1').decode('ascii'))
+        storage = WalletStorage(path)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        storage.decrypt('secret')
+        self.assertEqual(data, storage.read())
+        self.assertTrue(storage.needs_consolidation())
+        storage.write(data)
+        self.assertFalse(storage.needs_consolidation())
+        storage = WalletStorage(path)
+        storage.decrypt('secret')
+        self.assertEqual(data, storage.read())
+        self.assertIsNotNone(storage._stream_header)
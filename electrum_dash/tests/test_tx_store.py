@@ -0,0 +1,184 @@
+import os
+import json
+from unittest import mock
+
+from electrum_dash.json_db import load_json_with_patches
+from electrum_dash.storage import WalletStorage, StorageEncryptionVersion
+from electrum_dash.transaction import Transaction
+from electrum_dash.tx_store import TxStore, get_tx_store_path
+from electrum_dash.wallet_db import WalletDB
+
+from . import ElectrumTestCase
+
+
+RAW_TX = ('01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb4031000000006c4930460221'
+          '00a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100f9e80b7de89de861dc6fb0'
+          'c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd1d258a200ad9759ef63adf8e14cd97f5'
+          '3227bae35cdb84d2f6ffffffff0140420f00000000001976a914230ac37834073a42146f11ef8414ae929feaafc388'
+          'ac00000000')
+
+
+class TestTxStore(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'somewallet.txs')
+
+    def test_records_are_appended_and_read_back(self):
+        store = TxStore(self.path)
+        store.put('11' * 32, b'\x01\x02')
+        store.put('22' * 32, b'\x03')
+        self.assertFalse(os.path.exists(self.path))  # not flushed yet
+        self.assertEqual(b'\x01\x02', store.get('11' * 32))
+        store.flush()
+        store.put('11' * 32, b'\x04')
+        store.remove('22' * 32)
+        store.flush()
+        store.close()
+        store = TxStore(self.path)
+        self.assertEqual(['11' * 32], list(store))
+        self.assertEqual(b'\x04', store.get('11' * 32))
+        self.assertIsNone(store.get('22' * 32))
+        self.assertTrue(store.needs_rewrite(self.path, b'\x00' * 32))
+        store.close()
+
+    def test_interrupted_write_is_overwritten(self):
+        store = TxStore(self.path)
+        store.put('11' * 32, b'\x01\x02')
+        store.flush()
+        store.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, 'ab') as f:
+            f.write(bytes.fromhex('22' * 32) + b'\x00\x00\x00\x05\x01')
+        store = TxStore(self.path)
+        self.assertEqual(['11' * 32], list(store))
+        store.put('33' * 32, b'\x03')
+        store.flush()
+        store.close()
+        self.assertEqual(size + 36 + 1, os.path.getsize(self.path))
+        self.assertEqual(['11' * 32, '33' * 32], list(TxStore(self.path)))
+
+    def test_encrypted_records(self):
+        key = os.urandom(32)
+        store = TxStore(self.path, key=key)
+        store.put('11' * 32, b'secret tx')
+        store.flush()
+        store.close()
+        with open(self.path, 'rb') as f:
+            self.assertNotIn(b'secret tx', f.read())
+        self.assertEqual(b'secret tx', TxStore(self.path, key=key).get('11' * 32))
+        # another key, e.g. after an interrupted password change
+        self.assertEqual([], list(TxStore(self.path, key=os.urandom(32))))
+
+    def test_rewrite_drops_replaced_records(self):
+        store = TxStore(self.path)
+        for i in range(3):
+            store.put('11' * 32, bytes([i]) * 1000)
+            store.flush()
+        store.remove('11' * 32)
+        store.put('22' * 32, b'\x05')
+        new_path = self.path + '2'
+        key = os.urandom(32)
+        store.rewrite(new_path, key)
+        self.assertEqual(new_path, store.path)
+        self.assertLess(os.path.getsize(new_path), 100)
+        self.assertFalse(store.needs_rewrite(new_path, key))
+        self.assertEqual({'22' * 32: b'\x05'}, {txid: store.get(txid) for txid in store})
+
+
+class TestWalletDBTxStore(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'somewallet')
+        self.tx = Transaction(RAW_TX)
+        self.txid = self.tx.txid()
+
+    def _reload(self, password=None):
+        storage = WalletStorage(self.path)
+        if password:
+            storage.decrypt(password)
+        return storage, WalletDB(storage.read(), manual_upgrades=False, storage=storage)
+
+    def test_transactions_are_kept_out_of_the_wallet_file(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.add_transaction(self.txid, self.tx)
+        storage = WalletStorage(self.path)
+        db.write(storage)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            self.assertNotIn('transactions', json.loads(f.read()))
+        self.assertTrue(os.path.exists(get_tx_store_path(self.path)))
+        storage, db = self._reload()
+        self.assertEqual(RAW_TX, db.get_transaction(self.txid).serialize())
+        self.assertEqual([self.txid], db.list_transactions())
+        # copies of the db include them
+        self.assertEqual({self.txid: RAW_TX}, json.loads(db.dump())['transactions'])
+        # removals are appended to the tx store
+        db.remove_transaction(self.txid)
+        db.write(storage)
+        storage, db = self._reload()
+        self.assertEqual([], db.list_transactions())
+
+    def test_transactions_of_old_wallet_files_are_moved(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.add_transaction(self.txid, self.tx)
+        db.write(WalletStorage(self.path))
+        # as written by older versions
+        os.unlink(get_tx_store_path(self.path))
+        with open(self.path, 'r+', encoding='utf-8') as f:
+            data = json.loads(f.read())
+            data['transactions'] = {self.txid: RAW_TX}
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(data))
+        storage, db = self._reload()
+        self.assertEqual([self.txid], db.list_transactions())
+        db.write(storage)
+        storage, db = self._reload()
+        self.assertNotIn('transactions', load_json_with_patches(storage.read()))
+        self.assertEqual(RAW_TX, db.get_transaction(self.txid).serialize())
+
+    def test_password_change_rewrites_tx_store(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.add_transaction(self.txid, self.tx)
+        storage = WalletStorage(self.path)
+        storage.set_password('1234', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        db.write(storage)
+        with open(get_tx_store_path(self.path), 'rb') as f:
+            self.assertNotIn(bytes.fromhex(RAW_TX), f.read())
+        storage, db = self._reload('1234')
+        storage.set_password('5678', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        db.set_modified(True)
+        db.write(storage)
+        storage, db = self._reload('5678')
+        self.assertEqual(RAW_TX, db.get_transaction(self.txid).serialize())
+
+    def _write_encrypted_db(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.add_transaction(self.txid, self.tx)
+        storage = WalletStorage(self.path)
+        storage.set_password('1234', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        db.write(storage)
+        return self._reload('1234')
+
+    def test_interrupted_password_change_before_wallet_file_is_written(self):
+        storage, db = self._write_encrypted_db()
+        storage.set_password('5678', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        db.set_modified(True)
+        with mock.patch.object(WalletStorage, 'write', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                db.write(storage)
+        db.close()
+        storage, db = self._reload('1234')
+        self.assertEqual(RAW_TX, db.get_transaction(self.txid).serialize())
+
+    def test_interrupted_password_change_after_wallet_file_is_written(self):
+        storage, db = self._write_encrypted_db()
+        storage.set_password('5678', enc_version=StorageEncryptionVersion.USER_PASSWORD)
+        db.set_modified(True)
+        with mock.patch.object(TxStore, 'commit_rewrite'):
+            db.write(storage)
+        db.close()
+        storage, db = self._reload('5678')
+        self.assertEqual(RAW_TX, db.get_transaction(self.txid).serialize())
+        self.assertFalse(os.path.exists(get_tx_store_path(self.path) + '.new'))
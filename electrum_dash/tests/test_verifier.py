@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
+import asyncio
 
 from electrum_dash.bitcoin import hash_encode
 from electrum_dash.transaction import Transaction
 from electrum_dash.util import bfh
 from electrum_dash.verifier import SPV, InnerNodeOfSpvProofIsValidTx
+from electrum_dash.logging import Logger
 
 from . import TestCaseForTestnet
 
@@ -48,3 +50,84 @@ class VerifierTestCase(TestCaseForTestnet):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+class MockWallet:
+    def __init__(self, unverified):
+        self.unverified = unverified
+    def get_unverified_txs(self):
+        return dict(self.unverified)
+    def diagnostic_name(self):
+        return 'mock_wallet'
+
+
+class MockBlockchain:
+    def __init__(self, height):
+        self._height = height
+    def height(self):
+        return self._height
+    def read_header(self, height):
+        return {'block_height': height} if height <= self._height else None
+
+
+class MockTaskGroup:
+    def __init__(self):
+        self.spawned = []
+    async def spawn(self, coro, *args):
+        self.spawned.append((coro, args))
+
+
+class QueueTestCase(TestCaseForTestnet):
+
+    def setUp(self):
+        super().setUp()
+        self.spv = SPV.__new__(SPV)
+        self.spv.wallet = MockWallet({'a1': 10, 'a2': 10, 'b1': 12, 'c1': 15, 'u1': 0})
+        Logger.__init__(self.spv)
+        self.spv._reset()
+        self.spv.taskgroup = MockTaskGroup()
+        self.spv.blockchain = MockBlockchain(12)
+        self.spv._queue_all_unverified_txs()
+
+    def _request_proofs(self):
+        return asyncio.get_event_loop().run_until_complete(self.spv._request_proofs())
+
+    def _requested(self):
+        return [(args[0], sorted(args[1])) for coro, args in self.spv.taskgroup.spawned]
+
+    def test_proofs_are_requested_per_height(self):
+        self.assertTrue(self._request_proofs())
+        self.assertEqual([(10, ['a1', 'a2']), (12, ['b1'])], self._requested())
+        self.assertEqual({'a1', 'a2', 'b1'}, self.spv.requested_merkle)
+        # nothing more until new headers arrive
+        self.assertFalse(self._request_proofs())
+        self.spv.blockchain = MockBlockchain(15)
+        self.assertTrue(self._request_proofs())
+        self.assertEqual((15, ['c1']), self._requested()[-1])
+
+    def test_requeued_and_removed_txs(self):
+        # a2 got mined again at another height, b1 is not unverified anymore
+        self.spv.wallet.unverified['a2'] = 11
+        del self.spv.wallet.unverified['b1']
+        self.spv._queue_tx('a2', 11)
+        self._request_proofs()
+        self.assertEqual([(10, ['a1']), (11, ['a2'])], self._requested())
+
+    def test_txs_wait_for_missing_headers(self):
+        self.spv.blockchain.read_header = lambda height: None if height == 12 else {}
+        self._request_proofs()
+        # the chunk of the missing header is requested (in the checkpoint region)
+        coro, args = self.spv.taskgroup.spawned.pop()
+        self.assertEqual('_request_chunk', coro.__name__)
+        coro.close()
+        self.assertEqual([(10, ['a1', 'a2'])], self._requested())
+        self.assertEqual({12: {'b1'}}, self.spv._txs_waiting_for_header)
+        # no busy loop: nothing is queued until the header arrives
+        self.spv._wakeup_event.clear()
+        self.spv._on_blockchain_updated('blockchain_updated')
+        self.assertEqual([15], self.spv._heights)  # c1, above the local chain
+        self.spv.blockchain = MockBlockchain(15)
+        self.spv._on_blockchain_updated('blockchain_updated')
+        self.assertFalse(self.spv._txs_waiting_for_header)
+        self._request_proofs()
+        self.assertEqual([(12, ['b1']), (15, ['c1'])], self._requested()[1:])
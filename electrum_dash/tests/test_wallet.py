@@ -18,6 +18,7 @@ from electrum_dash.bitcoin import COIN
 from electrum_dash.wallet_db import WalletDB
 from electrum_dash.simple_config import SimpleConfig
 from electrum_dash import util
+from electrum_dash.address_synchronizer import AddressSynchronizer
 
 from . import ElectrumTestCase
 
@@ -152,6 +153,25 @@ class TestFiat(ElectrumTestCase):
         self.assertNotIn(ccy, self.fiat_value)
 
 
+class TestHistoryOrder(ElectrumTestCase):
+
+    def test_sorted_history_is_updated_in_place(self):
+        w = AddressSynchronizer.__new__(AddressSynchronizer)
+        w._history_order = []
+        w._history_sort_keys = {}
+        keys = {'%02x' % i: ((100 + i // 3, i % 3), '') for i in range(40)}
+        w._update_history_order(dict(keys))
+        self.assertEqual(sorted((k, txid) for txid, k in keys.items()), w._history_order)
+        order = w._history_order
+        # a tx got mined, one is new, one was removed
+        keys['00'] = ((200, 0), '')
+        keys['ff'] = ((1e10, -1), '')
+        del keys['01']
+        w._update_history_order(dict(keys))
+        self.assertIs(order, w._history_order)
+        self.assertEqual(sorted((k, txid) for txid, k in keys.items()), w._history_order)
+
+
 class TestCreateRestoreWallet(WalletTestCase):
 
     def test_create_new_wallet(self):
@@ -232,6 +252,24 @@ class TestCreateRestoreWallet(WalletTestCase):
         wallet.delete_address('XmQ3Tn67Fgs7bwNXthtiEnBFh7ZeDG3aw2')
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
 
+    def test_imported_privkey_persists_after_reopen(self):
+        text = 'p2pkh:XEn9o6oayjsRmoEQwDbvkrWVvjRNqPj3xNskJJPAKraJTrWuutwd'
+        d = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)
+        wallet = d['wallet']  # type: Imported_Wallet
+        addr1 = wallet.import_private_key(
+            'p2pkh:XGx8LpkmLRv9RiMvpYx965BCaQKQbeMVVqgAh7B5SQVdosQiKJ4i', password=None)
+        self.assertEqual('XmQ3Tn67Fgs7bwNXthtiEnBFh7ZeDG3aw2', addr1)
+        wallet.save_db()
+        # reopen
+        storage = WalletStorage(self.wallet_path)
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        wallet = Wallet(db, storage, config=self.config)
+        self.assertEqual(2, len(wallet.get_receiving_addresses()))
+        self.assertEqual('p2pkh:XEn9o6oayjsRmoEQwDbvkrWVvjRNqPj3xNskJJPAKraJTrWuutwd',
+                         wallet.export_private_key('Xci5KnMVkHrqBQk9cU4jwmzJfgaTPopHbz', password=None))
+        self.assertEqual('p2pkh:XGx8LpkmLRv9RiMvpYx965BCaQKQbeMVVqgAh7B5SQVdosQiKJ4i',
+                         wallet.export_private_key(addr1, password=None))
+
 
 class TestWalletPassword(WalletTestCase):
 
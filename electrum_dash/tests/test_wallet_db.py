@@ -1,8 +1,15 @@
+import os
 import json
+from unittest.mock import patch
 
+from electrum_dash.json_db import StoredDict
 from electrum_dash.wallet_db import WalletDB, FINAL_SEED_VERSION
+from electrum_dash.storage import WalletStorage, StorageEncryptionVersion
+from electrum_dash.transaction import TxOutpoint, Transaction
+from electrum_dash.util import history_status
 
-from . import SequentialTestCase
+from . import SequentialTestCase, ElectrumTestCase
+from .test_dash_tx import PRO_REG_TX, WRONG_SPEC_TX
 
 
 class WalletDBTestCase(SequentialTestCase):
@@ -40,3 +47,241 @@ class WalletDBTestCase(SequentialTestCase):
         del d['x1/']
         db = WalletDB(json.dumps(d), manual_upgrades=False)
         assert not db.check_unfinished_multisig()  # x2/, x3/ fails
+
+
+class TestAppendedChanges(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.electrum_path, 'somewallet')
+
+    def _reload(self, password=None):
+        storage = WalletStorage(self.path)
+        if password:
+            storage.decrypt(password)
+        return storage, WalletDB(storage.read(), manual_upgrades=False, storage=storage)
+
+    def _make_changes(self, storage, db):
+        db.put('labels', {'a': 'label a'})
+        db.write(storage)  # first write is a full one
+        db.put('labels', {'a': 'label a', 'b': 'label b'})
+        db.get('labels').pop('a')
+        db.put('somelist', [1, 2])
+        db.get('somelist').append(3)
+        db.get('somelist').remove(1)
+        db.add_prevout_by_scripthash('00' * 32, prevout=TxOutpoint.from_str('11' * 32 + ':0'), value=5)
+        db.add_prevout_by_scripthash('00' * 32, prevout=TxOutpoint.from_str('22' * 32 + ':1'), value=6)
+        db.remove_prevout_by_scripthash('00' * 32, prevout=TxOutpoint.from_str('11' * 32 + ':0'), value=5)
+        size = os.path.getsize(self.path)
+        db.write(storage)
+        self.assertLess(size, os.path.getsize(self.path))
+
+    def _check_changes(self, db):
+        self.assertEqual({'b': 'label b'}, db.get('labels'))
+        self.assertEqual([2, 3], db.get('somelist'))
+        self.assertEqual({(TxOutpoint.from_str('22' * 32 + ':1'), 6)},
+                         db.get_prevouts_by_scripthash('00' * 32))
+
+    def test_changes_are_appended(self):
+        storage = WalletStorage(self.path)
+        db = WalletDB('', manual_upgrades=False)
+        self._make_changes(storage, db)
+        with open(self.path, 'r') as f:
+            self.assertIn(',\n{"op": ', f.read())
+        storage, db = self._reload()
+        self._check_changes(db)
+        # consolidated into a single json document
+        with patch('electrum_dash.storage.APPENDED_CHANGES_MIN_SIZE', 0):
+            db.put('labels', {})
+            db.write(storage)
+        with open(self.path, 'r') as f:
+            data = json.loads(f.read())
+        self.assertEqual({}, data['labels'])
+        self.assertEqual([2, 3], data['somelist'])
+
+    def test_changes_are_appended_with_encryption(self):
+        storage = WalletStorage(self.path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        db = WalletDB('', manual_upgrades=False)
+        self._make_changes(storage, db)
+        storage, db = self._reload('secret')
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        self._check_changes(db)
+
+    def test_removing_password_rewrites_file(self):
+        storage = WalletStorage(self.path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        db = WalletDB('', manual_upgrades=False)
+        self._make_changes(storage, db)
+        storage, db = self._reload('secret')
+        storage.set_password(None, StorageEncryptionVersion.PLAINTEXT)
+        self.assertTrue(storage.needs_consolidation())
+        db.put('labels', {'c': 'label c'})
+        db.write(storage)
+        storage, db = self._reload()
+        self.assertFalse(storage.is_encrypted())
+        self.assertEqual({'c': 'label c'}, db.get('labels'))
+        self.assertEqual([2, 3], db.get('somelist'))
+
+    def test_in_place_changes_are_appended(self):
+        storage = WalletStorage(self.path)
+        db = WalletDB('', manual_upgrades=False)
+        db.put('keystore', {'type': 'bip32', 'xpub': 'xpub1'})
+        db.put('somelist', [[1, 2], {'a': 1}])
+        db.write(storage)
+        db.get('keystore')['xpub'] = 'xpub2'
+        db.put('keystore', db.get('keystore'))
+        db.get('somelist')[0].append(3)
+        db.get('somelist')[1]['b'] = [4]
+        db.get('somelist')[1]['b'].append(5)
+        self.assertFalse(db.needs_full_write())
+        db.write(storage)
+        with open(self.path, 'r') as f:
+            self.assertIn(',\n{"op": ', f.read())
+        storage, db = self._reload()
+        self.assertEqual('xpub2', db.get('keystore')['xpub'])
+        self.assertEqual([[1, 2, 3], {'a': 1, 'b': [4, 5]}], db.get('somelist'))
+
+    def test_prevouts_changes_are_small(self):
+        db = WalletDB('', manual_upgrades=False)
+        prevouts = [TxOutpoint.from_str('%02x' % i * 32 + ':0') for i in range(3)]
+        for prevout in prevouts:
+            db.add_prevout_by_scripthash('00' * 32, prevout=prevout, value=5)
+        db.set_modified(False)
+        db.add_prevout_by_scripthash('00' * 32, prevout=TxOutpoint.from_str('ff' * 32 + ':1'), value=6)
+        self.assertEqual(['{"op": "add", "path": "/prevouts_by_scripthash/%s/-", "value": ["%s:1", 6]}'
+                          % ('00' * 32, 'ff' * 32)],
+                         db.pending_changes)
+        db.add_prevout_by_scripthash('00' * 32, prevout=TxOutpoint.from_str('ff' * 32 + ':1'), value=6)
+        self.assertEqual(1, len(db.pending_changes))
+
+    def test_db_not_loaded_from_storage_is_written_in_full(self):
+        storage = WalletStorage(self.path)
+        db = WalletDB('', manual_upgrades=False)
+        db.put('labels', {'a': 'label a'})
+        db.write(storage)
+        db2 = WalletDB(db.dump(), manual_upgrades=False)
+        db2.put('labels', {'b': 'label b'})
+        db2.write(storage)
+        with open(self.path, 'r') as f:
+            data = json.loads(f.read())
+        self.assertEqual({'b': 'label b'}, data['labels'])
+
+    def test_interrupted_append_is_dropped(self):
+        storage = WalletStorage(self.path)
+        db = WalletDB('', manual_upgrades=False)
+        self._make_changes(storage, db)
+        db.put('labels', {'c': 'label c'})
+        db.write(storage)
+        # cut off the last change record
+        with open(self.path, 'r+') as f:
+            f.truncate(os.path.getsize(self.path) - 10)
+        storage, db = self._reload()
+        self._check_changes(db)
+        self.assertTrue(db.needs_full_write())
+        db.put('somelist', [4])
+        db.write(storage)
+        with open(self.path, 'r') as f:
+            data = json.loads(f.read())
+        self.assertEqual([4], data['somelist'])
+        self.assertEqual({'b': 'label b'}, data['labels'])
+
+
+class TestLazyLoading(ElectrumTestCase):
+
+    def _load_db(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.txo['11' * 32] = {'XaddrA': {'0': (5, False)}}
+        db.transactions['11' * 32] = '00'
+        db.transactions['22' * 32] = '00'  # unreferenced
+        db.spent_outpoints['33' * 32] = {'0': '22' * 32}
+        db.add_prevout_by_scripthash('00' * 32, prevout=TxOutpoint.from_str('11' * 32 + ':0'), value=5)
+        return WalletDB(db.dump(), manual_upgrades=False)
+
+    def test_subtrees_are_converted_on_access(self):
+        db = self._load_db()
+        txo = db.data['txo']
+        self.assertIn('11' * 32, txo._lazy_keys)
+        self.assertEqual({'XaddrA': {'0': [5, False]}}, dict.__getitem__(txo, '11' * 32))
+        d = txo['11' * 32]
+        self.assertEqual(StoredDict, type(d))
+        self.assertEqual(['txo', '11' * 32], d.path)
+        self.assertNotIn('11' * 32, txo._lazy_keys)
+        self.assertIs(d, txo.get('11' * 32))
+        self.assertEqual({'0': [5, False]}, dict(d['XaddrA']))
+        self.assertEqual(StoredDict, type(dict(db.data)['txo']))
+        # converted values are used from the start
+        self.assertEqual({(TxOutpoint.from_str('11' * 32 + ':0'), 5)},
+                         db.get_prevouts_by_scripthash('00' * 32))
+        self.assertEqual(json.loads(self._load_db().dump()), json.loads(db.dump()))
+
+    def test_changes_of_lazy_subtrees_are_recorded(self):
+        db = self._load_db()
+        db.set_modified(False)
+        db.txo['11' * 32]['XaddrA']['1'] = (6, False)
+        db.spent_outpoints.pop('33' * 32)
+        self.assertEqual(['{"op": "add", "path": "/txo/%s/XaddrA/1", "value": [6, false]}' % ('11' * 32),
+                          '{"op": "remove", "path": "/spent_outpoints/%s"}' % ('33' * 32)],
+                         db.pending_changes)
+
+    def test_remove_unreferenced_txs(self):
+        db = self._load_db()
+        self.assertIn('22' * 32, db.transactions)
+        db.remove_unreferenced_txs()
+        self.assertEqual(['11' * 32], list(db.transactions))
+        self.assertEqual({}, dict(db.spent_outpoints['33' * 32]))
+
+
+class TestAddrStatus(ElectrumTestCase):
+
+    ADDR = 'XmVCC9HGapsP5r2bcXbdBSnBBzSBYTNBdb'
+
+    def _db(self):
+        db = WalletDB('', manual_upgrades=False)
+        db.load_addresses('standard')
+        db.add_receiving_address(self.ADDR)
+        return db
+
+    def test_status_is_stored_with_history(self):
+        db = self._db()
+        self.assertIsNone(db.get_addr_status(self.ADDR))
+        hist = [('11' * 32, 10), ('22' * 32, 0)]
+        db.set_addr_history(self.ADDR, hist)
+        self.assertEqual(history_status(hist), db.get_addr_status(self.ADDR))
+        db.set_addr_history(self.ADDR, hist[:1], status='ab' * 32)
+        self.assertEqual('ab' * 32, db.addr_status[self.ADDR])
+        db.remove_addr_history(self.ADDR)
+        self.assertNotIn(self.ADDR, db.addr_status)
+
+    def test_status_of_older_wallets_is_computed_on_load(self):
+        db = self._db()
+        hist = [('11' * 32, 10)]
+        db.history[self.ADDR] = hist
+        self.assertIsNone(db.get_addr_status(self.ADDR))
+        db = WalletDB(db.dump(), manual_upgrades=False)
+        self.assertEqual(history_status(hist), db.addr_status[self.ADDR])
+        # reading does not modify the db
+        db.set_modified(False)
+        self.assertEqual(history_status(hist), db.get_addr_status(self.ADDR))
+        self.assertEqual([], db.pending_changes)
+
+
+class TestTxTypes(ElectrumTestCase):
+
+    def test_tx_type_is_stored_when_tx_is_added(self):
+        db = WalletDB('', manual_upgrades=False)
+        for raw, tx_type in ((PRO_REG_TX, 1), (WRONG_SPEC_TX, 0)):
+            tx = Transaction(raw)
+            db.add_transaction(tx.txid(), tx)
+            self.assertEqual(tx_type, db.tx_types[tx.txid()])
+            self.assertEqual(tx_type, db.get_tx_type(tx.txid()))
+        db.remove_transaction(tx.txid())
+        self.assertNotIn(tx.txid(), db.tx_types)
+        self.assertEqual(0, db.get_tx_type(tx.txid()))
+
+    def test_tx_type_of_older_wallets_is_computed(self):
+        db = WalletDB('', manual_upgrades=False)
+        tx = Transaction(PRO_REG_TX)
+        db.transactions[tx.txid()] = tx
+        self.assertEqual(1, db.get_tx_type(tx.txid()))
+        self.assertEqual(1, db.tx_types[tx.txid()])
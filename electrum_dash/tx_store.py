@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2019 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import mmap
+import hashlib
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Dict, Optional, Tuple, Iterator
+
+from . import crypto
+from .logging import Logger
+from .transaction import Transaction, tx_from_any
+
+
+# The raw transactions of a wallet are kept next to the wallet file, in a
+# file of records appended one after the other: a 32 byte txid, the 4 byte
+# length of the payload, and the payload, the raw transaction (or PSBT).
+# An empty payload removes the txid. With an encrypted wallet, payloads are
+# a random nonce and the transaction encrypted with chacha20-poly1305, the
+# txid being authenticated with it. The file starts with a magic and the
+# fingerprint of the key (zeros without encryption). It is rewritten without
+# the records that were replaced or removed once they take half of it.
+# A rewrite (e.g. with a new key) is first written next to the file, and
+# only replaces it once the wallet file that goes with it is written. A
+# rewritten file left over by a crash is used if it has the expected key.
+TX_STORE_SUFFIX = '.txs'
+TX_STORE_REWRITE_SUFFIX = '.new'
+TX_STORE_MAGIC = b'ETXS'
+TX_STORE_HEADER_SIZE = len(TX_STORE_MAGIC) + 8
+TX_STORE_RECORD_HEADER_SIZE = 32 + 4
+TX_STORE_GARBAGE_MIN_SIZE = 1024 * 1024
+NONCE_SIZE = 12
+
+
+def get_tx_store_path(wallet_path: str) -> str:
+    return wallet_path + TX_STORE_SUFFIX
+
+
+class TxStore(Logger):
+    """Raw transactions by txid, in an append-only file.
+
+    Changes are kept in memory until flush() is called, the records
+    already written are read through mmap. Not thread-safe, the wallet db
+    calls it under its lock.
+    """
+
+    def __init__(self, path: str, *, key: Optional[bytes] = None):
+        Logger.__init__(self)
+        self.path = path
+        self.key = key
+        self._index = {}  # type: Dict[str, Tuple[int, int]]  # txid -> (offset, size) of payload
+        self._pending = OrderedDict()  # type: Dict[str, Optional[bytes]]  # txid -> raw tx, None if removed
+        self._file_size = 0  # end of the last complete record
+        self._garbage = 0  # size of the records replaced or removed
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._rewrite = None  # type: Optional[Tuple[str, Optional[bytes]]]  # (path, key) of a prepared rewrite
+        self._recover_rewrite()
+        self._load()
+
+    def _recover_rewrite(self) -> None:
+        """Uses the rewritten file of an interrupted write if it goes
+        with the wallet file, i.e. has the expected key."""
+        new_path = self.path + TX_STORE_REWRITE_SUFFIX
+        if not os.path.exists(new_path):
+            return
+        with open(new_path, 'rb') as f:
+            header = f.read(TX_STORE_HEADER_SIZE)
+        if header == self._header():
+            self.logger.info(f'using rewritten tx store {new_path}')
+            os.replace(new_path, self.path)
+        else:
+            os.unlink(new_path)
+
+    def _load(self) -> None:
+        self._index = {}
+        self._file_size = 0
+        self._garbage = 0
+        if not os.path.exists(self.path):
+            return
+        self._map()
+        mm = self._mmap
+        if mm is None:
+            return  # empty file
+        if mm[:TX_STORE_HEADER_SIZE] != self._header():
+            # written with another key, or not a tx store
+            self.logger.warning(f'ignoring tx store with unexpected header: {self.path}')
+            self._garbage = len(mm)
+            self._unmap()
+            return
+        pos = TX_STORE_HEADER_SIZE
+        size = len(mm)
+        while pos + TX_STORE_RECORD_HEADER_SIZE <= size:
+            txid = mm[pos:pos+32].hex()
+            n = int.from_bytes(mm[pos+32:pos+TX_STORE_RECORD_HEADER_SIZE], byteorder='big')
+            end = pos + TX_STORE_RECORD_HEADER_SIZE + n
+            if end > size:
+                break  # interrupted write, overwritten by the next flush
+            old = self._index.pop(txid, None)
+            if old is not None:
+                self._garbage += TX_STORE_RECORD_HEADER_SIZE + old[1]
+            if n:
+                self._index[txid] = (pos + TX_STORE_RECORD_HEADER_SIZE, n)
+            else:
+                self._garbage += TX_STORE_RECORD_HEADER_SIZE
+            pos = end
+        self._file_size = pos
+
+    def _map(self) -> None:
+        self._unmap()
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def close(self) -> None:
+        self._unmap()
+
+    def __contains__(self, txid: str) -> bool:
+        if txid in self._pending:
+            return self._pending[txid] is not None
+        return txid in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        for txid in list(self._index):
+            if txid not in self._pending:
+                yield txid
+        for txid, raw in list(self._pending.items()):
+            if raw is not None:
+                yield txid
+
+    def __len__(self) -> int:
+        return sum(1 for txid in self)
+
+    def get(self, txid: str) -> Optional[bytes]:
+        if txid in self._pending:
+            return self._pending[txid]
+        item = self._index.get(txid)
+        if item is None:
+            return None
+        offset, size = item
+        if self._mmap is None:
+            self._map()  # closed
+        payload = self._mmap[offset:offset+size]
+        if not self.key:
+            return payload
+        try:
+            return crypto.chacha20_poly1305_decrypt(
+                key=self.key, nonce=payload[:NONCE_SIZE],
+                associated_data=bytes.fromhex(txid), data=payload[NONCE_SIZE:])
+        except ValueError:
+            self.logger.warning(f'cannot decrypt tx {txid} from tx store')
+            return None
+
+    def put(self, txid: str, raw: bytes) -> None:
+        assert raw
+        self._pending.pop(txid, None)
+        self._pending[txid] = raw
+
+    def remove(self, txid: str) -> None:
+        if txid in self._index:
+            self._pending.pop(txid, None)
+            self._pending[txid] = None
+        else:
+            self._pending.pop(txid, None)
+
+    def _serialize_record(self, txid: str, raw: Optional[bytes]) -> bytes:
+        txid_bytes = bytes.fromhex(txid)
+        if raw is None:
+            payload = b''
+        elif self.key:
+            nonce = os.urandom(NONCE_SIZE)
+            payload = nonce + crypto.chacha20_poly1305_encrypt(
+                key=self.key, nonce=nonce, associated_data=txid_bytes, data=raw)
+        else:
+            payload = raw
+        return txid_bytes + len(payload).to_bytes(4, byteorder='big') + payload
+
+    def _header(self) -> bytes:
+        fingerprint = hashlib.sha256(self.key).digest()[:8] if self.key else bytes(8)
+        return TX_STORE_MAGIC + fingerprint
+
+    def flush(self) -> None:
+        """Appends the pending changes to the file."""
+        if not self._pending:
+            return
+        self._unmap()
+        if not self._file_size:
+            # new file, or one we could not read
+            with open(self.path, 'wb') as f:
+                f.write(self._header())
+            self._file_size = TX_STORE_HEADER_SIZE
+            self._garbage = 0
+        with open(self.path, 'r+b') as f:
+            f.seek(self._file_size)
+            f.truncate()
+            pos = self._file_size
+            for txid, raw in self._pending.items():
+                record = self._serialize_record(txid, raw)
+                f.write(record)
+                old = self._index.pop(txid, None)
+                if old is not None:
+                    self._garbage += TX_STORE_RECORD_HEADER_SIZE + old[1]
+                if raw is not None:
+                    self._index[txid] = (pos + TX_STORE_RECORD_HEADER_SIZE,
+                                         len(record) - TX_STORE_RECORD_HEADER_SIZE)
+                else:
+                    self._garbage += len(record)
+                pos += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file_size = pos
+        self._pending.clear()
+        self._map()
+
+    def needs_rewrite(self, path: str, key: Optional[bytes]) -> bool:
+        return (path != self.path or key != self.key
+                or self._garbage > max(TX_STORE_GARBAGE_MIN_SIZE, self._file_size // 2))
+
+    def rewrite(self, path: str, key: Optional[bytes]) -> None:
+        """Writes the transactions, pending changes included, to a new
+        file at path, encrypted with key, and uses it from now on.
+        """
+        self.prepare_rewrite(path, key)
+        self.commit_rewrite()
+
+    def prepare_rewrite(self, path: str, key: Optional[bytes]) -> None:
+        """Writes the transactions, pending changes included, next to
+        path, encrypted with key. The file is used once commit_rewrite
+        is called, after the wallet file that goes with it is written.
+        """
+        txs = [(txid, self.get(txid)) for txid in self]
+        temp_path = "%s.tmp.%s" % (path, os.getpid())
+        old_key, self.key = self.key, key
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(self._header())
+                for txid, raw in txs:
+                    if raw is not None:
+                        f.write(self._serialize_record(txid, raw))
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            self.key = old_key
+        os.replace(temp_path, path + TX_STORE_REWRITE_SUFFIX)
+        self._rewrite = (path, key)
+
+    def commit_rewrite(self) -> None:
+        """Replaces the file with the one written by prepare_rewrite."""
+        if self._rewrite is None:
+            return
+        path, key = self._rewrite
+        self._rewrite = None
+        self._unmap()
+        os.replace(path + TX_STORE_REWRITE_SUFFIX, path)
+        self.path = path
+        self.key = key
+        self._pending.clear()
+        self._load()
+        self.logger.info(f'rewrote tx store {path}: {len(self._index)} txs')
+
+
+class StoredTransactions(MutableMapping):
+    """The transactions of a wallet db, txid -> Transaction, kept in a
+    TxStore. Transactions are created from their raw bytes when they are
+    read, and kept while in use or recently used.
+    """
+
+    CACHE_SIZE = 1000
+
+    def __init__(self, tx_store: TxStore):
+        self.tx_store = tx_store
+        self._in_use = weakref.WeakValueDictionary()  # type: Dict[str, Transaction]
+        self._recent = OrderedDict()  # type: Dict[str, Transaction]
+
+    def _remember(self, txid: str, tx: Transaction) -> None:
+        self._in_use[txid] = tx
+        self._recent[txid] = tx
+        self._recent.move_to_end(txid)
+        if len(self._recent) > self.CACHE_SIZE:
+            self._recent.popitem(last=False)
+
+    def _forget(self, txid: str) -> None:
+        self._in_use.pop(txid, None)
+        self._recent.pop(txid, None)
+
+    def __getitem__(self, txid: str) -> Transaction:
+        tx = self._in_use.get(txid)
+        if tx is None:
+            raw = self.tx_store.get(txid)
+            if raw is None:
+                raise KeyError(txid)
+            # note: for performance, "deserialize=False" so that we will deserialize these on-demand
+            tx = tx_from_any(raw.hex(), deserialize=False)
+        self._remember(txid, tx)
+        return tx
+
+    def __setitem__(self, txid: str, tx: Transaction) -> None:
+        self.tx_store.put(txid, tx.serialize_as_bytes())
+        self._remember(txid, tx)
+
+    def __delitem__(self, txid: str) -> None:
+        if txid not in self.tx_store:
+            raise KeyError(txid)
+        self.tx_store.remove(txid)
+        self._forget(txid)
+
+    def __contains__(self, txid) -> bool:
+        return txid in self.tx_store
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.tx_store)
+
+    def __len__(self) -> int:
+        return len(self.tx_store)
+
+    def clear(self) -> None:
+        for txid in list(self.tx_store):
+            self.tx_store.remove(txid)
+        self._in_use.clear()
+        self._recent.clear()
@@ -21,6 +21,7 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import binascii
+import hashlib
 import os, sys, re, json
 from collections import defaultdict, OrderedDict
 from typing import (NamedTuple, Union, TYPE_CHECKING, Tuple, Optional, Callable, Any,
@@ -564,6 +565,18 @@ def bh2u(x: bytes) -> str:
     return x.hex()
 
 
+def history_status(h) -> Optional[str]:
+    """Returns the electrum status of the address history h,
+    a list of (txid, height).
+    """
+    if not h:
+        return None
+    status = ''
+    for tx_hash, height in h:
+        status += tx_hash + ':%d:' % height
+    return bh2u(hashlib.sha256(status.encode('ascii')).digest())
+
+
 def is_android():
     return 'ANDROID_DATA' in os.environ
 
@@ -1163,6 +1176,10 @@ class NetworkJobOnDefaultServer(Logger, ABC):
     interface. Every time the main interface changes, the job is
     restarted, and some of its internals are reset.
     """
+
+    # jobs waiting for wakeups still run this often, in case an event was missed
+    SAFETY_SWEEP_INTERVAL = 10
+
     def __init__(self, network: 'Network'):
         Logger.__init__(self)
         asyncio.set_event_loop(network.asyncio_loop)
@@ -1172,6 +1189,8 @@ class NetworkJobOnDefaultServer(Logger, ABC):
         # Ensure fairness between NetworkJobs. e.g. if multiple wallets
         # are open, a large wallet's Synchronizer should not starve the small wallets:
         self._network_request_semaphore = asyncio.Semaphore(100)
+        self._num_wakeups = 0
+        self._num_useful_wakeups = 0
 
         self._reset()
         # every time the main interface changes, restart:
@@ -1184,6 +1203,31 @@ class NetworkJobOnDefaultServer(Logger, ABC):
         server connection changes.
         """
         self.taskgroup = SilentTaskGroup()
+        self._wakeup_event = asyncio.Event()
+        self._wakeup_event.set()  # first run
+
+    def wakeup(self):
+        """Makes the job look for work. Can be called from any thread."""
+        self.network.asyncio_loop.call_soon_threadsafe(self._wakeup_event.set)
+
+    async def _wait_for_wakeup(self, *, delay: float = 0.1) -> bool:
+        """Waits until woken up, or for SAFETY_SWEEP_INTERVAL. 'delay' is
+        slept after a wakeup, so that events that come together are handled
+        in one go. Returns False if nothing woke the job up.
+        """
+        try:
+            await asyncio.wait_for(self._wakeup_event.wait(), self.SAFETY_SWEEP_INTERVAL)
+        except asyncio.TimeoutError:
+            woken_up = False
+        else:
+            woken_up = True
+        await asyncio.sleep(delay)
+        self._wakeup_event.clear()
+        self._num_wakeups += 1
+        return woken_up
+
+    def num_wakeups_total_and_useful(self) -> Tuple[int, int]:
+        return self._num_wakeups, self._num_useful_wakeups
 
     async def _start(self, interface: 'Interface'):
         self.interface = interface
@@ -22,10 +22,13 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+import heapq
+from collections import defaultdict
+from typing import Sequence, Optional, TYPE_CHECKING, Dict, Set, List
 
 import aiorpcx
 
+from . import util
 from .util import bh2u, TxMinedInfo, NetworkJobOnDefaultServer
 from .crypto import sha256d
 from .bitcoin import hash_decode, hash_encode
@@ -46,77 +49,163 @@ class MerkleRootMismatch(MerkleVerificationFailure): pass
 class InnerNodeOfSpvProofIsValidTx(MerkleVerificationFailure): pass
 
 
+# max proofs requested in one batch
+MERKLE_BATCH_SIZE = 100
+
+
 class SPV(NetworkJobOnDefaultServer):
     """ Simple Payment Verification """
 
     def __init__(self, network: 'Network', wallet: 'AddressSynchronizer'):
         self.wallet = wallet
         NetworkJobOnDefaultServer.__init__(self, network)
+        util.register_callback(self._on_blockchain_updated, ['blockchain_updated'])
 
     def _reset(self):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        # unverified txs not requested yet, by height. heights are taken
+        # from the heap once the local chain reaches them
+        self._txs_by_height = defaultdict(set)  # type: Dict[int, Set[str]]
+        self._heights = []  # type: List[int]  # heap of the keys of _txs_by_height
+        self._queued_txs = {}  # type: Dict[str, int]  # txid -> height
+        # queued txs whose header is not available yet, by height. they
+        # are queued again once the header arrives
+        self._txs_waiting_for_header = defaultdict(set)  # type: Dict[int, Set[str]]
 
     async def _run_tasks(self, *, taskgroup):
         await super()._run_tasks(taskgroup=taskgroup)
         async with taskgroup as group:
             await group.spawn(self.main)
 
+    async def stop(self, *, full_shutdown: bool = True):
+        if full_shutdown:
+            util.unregister_callback(self._on_blockchain_updated)
+        await super().stop(full_shutdown=full_shutdown)
+
     def diagnostic_name(self):
         return self.wallet.diagnostic_name()
 
+    def _on_blockchain_updated(self, event, *args):
+        # new headers, or a reorg
+        self._queue_txs_with_header()
+        self._wakeup_event.set()
+
+    def _queue_txs_with_header(self) -> None:
+        for tx_height in [h for h in self._txs_waiting_for_header
+                          if self.blockchain.read_header(h) is not None]:
+            for tx_hash in self._txs_waiting_for_header.pop(tx_height):
+                if tx_hash not in self._queued_txs:  # else queued again at another height
+                    self._queue_tx(tx_hash, tx_height)
+
+    def add_unverified_tx(self, tx_hash: str, tx_height: int) -> None:
+        """Queues the tx for verification. Can be called from any thread."""
+        self.network.asyncio_loop.call_soon_threadsafe(self._queue_tx, tx_hash, tx_height)
+
+    def _queue_tx(self, tx_hash: str, tx_height: int) -> None:
+        if tx_height <= 0:
+            return  # not mined, the wallet updates the height once it is
+        if self._queued_txs.get(tx_hash) == tx_height:
+            return
+        # an entry at another height is skipped when its height is taken
+        self._queued_txs[tx_hash] = tx_height
+        if tx_height not in self._txs_by_height:
+            heapq.heappush(self._heights, tx_height)
+        self._txs_by_height[tx_height].add(tx_hash)
+        self._wakeup_event.set()
+
+    def _queue_all_unverified_txs(self) -> None:
+        for tx_hash, tx_height in self.wallet.get_unverified_txs().items():
+            if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
+                continue
+            self._queue_tx(tx_hash, tx_height)
+
     async def main(self):
         self.blockchain = self.network.blockchain()
+        self._queue_all_unverified_txs()
+        # woken up by new unverified txs and new headers
         while True:
-            await self._maybe_undo_verifications()
-            await self._request_proofs()
-            await asyncio.sleep(0.1)
+            if not await self._wait_for_wakeup():
+                self._queue_all_unverified_txs()  # safety net
+            undone = await self._maybe_undo_verifications()
+            requested = await self._request_proofs()
+            if undone or requested:
+                self._num_useful_wakeups += 1
 
-    async def _request_proofs(self):
+    async def _request_proofs(self) -> bool:
+        """Requests the proofs of the queued txs whose headers are
+        available. Returns whether anything was requested.
+        """
         local_height = self.blockchain.height()
+        if not self._heights or self._heights[0] > local_height:
+            return False
         unverified = self.wallet.get_unverified_txs()
-
-        for tx_hash, tx_height in unverified.items():
-            # do not request merkle branch if we already requested it
-            if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
-                continue
-            # or before headers are available
-            if tx_height <= 0 or tx_height > local_height:
+        requested = False
+        while self._heights and self._heights[0] <= local_height:
+            tx_height = heapq.heappop(self._heights)
+            tx_hashes = []
+            for tx_hash in self._txs_by_height.pop(tx_height):
+                if self._queued_txs.get(tx_hash) != tx_height:
+                    continue  # queued again at another height
+                del self._queued_txs[tx_hash]
+                # skip txs verified, removed or requested meanwhile
+                if (unverified.get(tx_hash) != tx_height
+                        or tx_hash in self.requested_merkle or tx_hash in self.merkle_roots):
+                    continue
+                tx_hashes.append(tx_hash)
+            if not tx_hashes:
                 continue
             # if it's in the checkpoint region, we still might not have the header
             header = self.blockchain.read_header(tx_height)
             if header is None:
+                self._txs_waiting_for_header[tx_height].update(tx_hashes)
                 if tx_height < constants.net.max_checkpoint():
-                    await self.taskgroup.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
+                    await self.taskgroup.spawn(self._request_chunk(tx_height))
+                    requested = True
                 continue
-            # request now
-            self.logger.info(f'requested merkle {tx_hash}')
-            self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
+            # request now, all txs of the block together
+            self.logger.info(f'requested merkle of {len(tx_hashes)} txs at height {tx_height}')
+            self.requested_merkle.update(tx_hashes)
+            await self.taskgroup.spawn(self._request_and_verify_proofs, tx_height, tx_hashes)
+            requested = True
+        return requested
 
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
+    async def _request_chunk(self, tx_height: int):
+        # returns early if the chunk is being requested already,
+        # the txs then wait for blockchain_updated
+        await self.network.request_chunk(tx_height, None, can_return_early=True)
+        self._queue_txs_with_header()
+
+    async def _request_and_verify_proofs(self, tx_height: int, tx_hashes: List[str]):
+        for i in range(0, len(tx_hashes), MERKLE_BATCH_SIZE):
+            batch = tx_hashes[i:i+MERKLE_BATCH_SIZE]
             async with self._network_request_semaphore:
-                merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
+                merkles = await self.network.get_merkles_for_transactions(batch, tx_height)
+            # we need to wait if header sync/reorg is still ongoing, hence lock:
+            async with self.network.bhi_lock:
+                header = self.network.blockchain().read_header(tx_height)
+            for tx_hash, merkle in zip(batch, merkles):
+                if isinstance(merkle, UntrustedServerReturnedError):
+                    if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                        raise merkle
+                    self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                    self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                    self.requested_merkle.discard(tx_hash)
+                    continue
+                await self._verify_proof(tx_hash, tx_height, merkle, header)
+
+    async def _verify_proof(self, tx_hash: str, tx_height: int, merkle: dict, header: Optional[dict]):
         # Verify the hash of the server-provided merkle branch to a
         # transaction matches the merkle root of its block
         if tx_height != merkle.get('block_height'):
             self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
                              .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
+            tx_height = merkle.get('block_height')
+            async with self.network.bhi_lock:
+                header = self.network.blockchain().read_header(tx_height)
         pos = merkle.get('pos')
         merkle_branch = merkle.get('merkle')
-        # we need to wait if header sync/reorg is still ongoing, hence lock:
-        async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
         try:
             verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
         except MerkleVerificationFailure as e:
@@ -173,17 +262,21 @@ class SPV(NetworkJobOnDefaultServer):
         else:
             raise InnerNodeOfSpvProofIsValidTx()
 
-    async def _maybe_undo_verifications(self):
+    async def _maybe_undo_verifications(self) -> bool:
         old_chain = self.blockchain
         cur_chain = self.network.blockchain()
-        if cur_chain != old_chain:
-            self.blockchain = cur_chain
-            above_height = cur_chain.get_height_of_last_common_block_with_chain(old_chain)
-            self.logger.info(f"undoing verifications above height {above_height}")
-            tx_hashes = self.wallet.undo_verifications(self.blockchain, above_height)
-            for tx_hash in tx_hashes:
-                self.logger.info(f"redoing {tx_hash}")
-                self.remove_spv_proof_for_tx(tx_hash)
+        if cur_chain == old_chain:
+            return False
+        self.blockchain = cur_chain
+        above_height = cur_chain.get_height_of_last_common_block_with_chain(old_chain)
+        self.logger.info(f"undoing verifications above height {above_height}")
+        tx_hashes = self.wallet.undo_verifications(self.blockchain, above_height)
+        unverified = self.wallet.get_unverified_txs()
+        for tx_hash in tx_hashes:
+            self.logger.info(f"redoing {tx_hash}")
+            self.remove_spv_proof_for_tx(tx_hash)
+            self._queue_tx(tx_hash, unverified.get(tx_hash, 0))
+        return True
 
     def remove_spv_proof_for_tx(self, tx_hash):
         self.merkle_roots.pop(tx_hash, None)
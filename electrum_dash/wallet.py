@@ -28,6 +28,7 @@
 
 import os
 import sys
+import asyncio
 import attr
 import random
 import time
@@ -57,7 +58,8 @@ from .util import (NotEnoughFunds, UserCancelled, profiler,
                    format_satoshis, format_fee_satoshis, NoDynamicFeeEstimates,
                    WalletFileException, BitcoinException, MultipleSpendMaxTxOutputs,
                    InvalidPassword, format_time, timestamp_to_datetime, Satoshis,
-                   Fiat, bfh, bh2u, TxMinedInfo, quantize_feerate, create_bip21_uri, OrderedDictWithIndex)
+                   Fiat, bfh, bh2u, TxMinedInfo, quantize_feerate, create_bip21_uri, OrderedDictWithIndex,
+                   log_exceptions)
 from .simple_config import SimpleConfig, FEE_RATIO_HIGH_WARNING, FEERATE_WARNING_HIGH_FEE
 from .bitcoin import COIN, TYPE_ADDRESS
 from .bitcoin import is_address, address_to_script, is_minikey, relayfee, dust_threshold
@@ -69,6 +71,7 @@ from .keystore import (load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithM
 from .util import multisig_type
 from .storage import StorageEncryptionVersion, WalletStorage
 from .wallet_db import WalletDB
+from .tx_store import TX_STORE_SUFFIX
 from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32
 from .transaction import (Transaction, TxInput, UnknownTxinType, TxOutput,
                           PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint)
@@ -307,6 +310,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
             if any([ks.is_requesting_to_be_rewritten_to_wallet_file for ks in self.get_keystores()]):
                 self.save_keystore()
             self.save_db()
+            self.db.close()
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -324,6 +328,18 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
 
     def start_network(self, network):
         AddressSynchronizer.start_network(self, network)
+        # unreferenced txs do not affect the wallet, so with a network
+        # they are removed in the background, not to delay the startup
+        if network and self.config.get('cleanup_db_in_background', True):
+            asyncio.run_coroutine_threadsafe(self._remove_unreferenced_txs(),
+                                             network.asyncio_loop)
+        else:
+            self.remove_unreferenced_txs()
+
+    @log_exceptions
+    async def _remove_unreferenced_txs(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.remove_unreferenced_txs)
 
     def load_and_cleanup(self):
         self.load_keystore()
@@ -2949,7 +2965,7 @@ def check_password_for_directory(config: SimpleConfig, old_password, new_passwor
     is_unified = True
     for filename in os.listdir(dirname):
         path = os.path.join(dirname, filename)
-        if not os.path.isfile(path):
+        if not os.path.isfile(path) or filename.endswith(TX_STORE_SUFFIX):
             continue
         basename = os.path.basename(path)
         storage = WalletStorage(path)
@@ -2958,7 +2974,7 @@ def check_password_for_directory(config: SimpleConfig, old_password, new_passwor
             # it is a bit wasteful load the wallet here, but that is fine
             # because we are progressively enforcing storage encryption.
             try:
-                db = WalletDB(storage.read(), manual_upgrades=False)
+                db = WalletDB(storage.read(), manual_upgrades=False, storage=storage)
                 wallet = Wallet(db, storage, config=config)
             except:
                 _logger.exception(f'failed to load {basename}:')
@@ -2985,7 +3001,7 @@ def check_password_for_directory(config: SimpleConfig, old_password, new_passwor
             failed.append(basename)
             continue
         try:
-            db = WalletDB(storage.read(), manual_upgrades=False)
+            db = WalletDB(storage.read(), manual_upgrades=False, storage=storage)
             wallet = Wallet(db, storage, config=config)
         except:
             _logger.exception(f'failed to load {basename}:')
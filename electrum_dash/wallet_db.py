@@ -28,17 +28,20 @@ import json
 import copy
 import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, Counter
 from typing import Dict, Optional, List, Tuple, Set, Iterable, NamedTuple, Sequence, TYPE_CHECKING, Union
 import binascii
 
 from . import util, bitcoin
-from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, bfh
+from .util import profiler, WalletFileException, multisig_type, TxMinedInfo, bfh, history_status
 from .invoices import PR_TYPE_ONCHAIN, Invoice, InvoiceExt
 from .keystore import bip44_derivation
 from .transaction import Transaction, TxOutpoint, tx_from_any, PartialTransaction, PartialTxOutput
+from .dash_tx import tx_header_to_tx_type
 from .logging import Logger
-from .json_db import StoredDict, JsonDB, locked, modifier
+from .json_db import (StoredDict, JsonDB, JsonDBJsonEncoder, locked, modifier,
+                      parse_json_with_patches)
+from .tx_store import TxStore, StoredTransactions
 from .plugin import run_hook, plugin_loaders
 from .paymentrequest import PaymentRequest
 
@@ -62,9 +65,13 @@ class TxFeesValue(NamedTuple):
 
 class WalletDB(JsonDB):
 
-    def __init__(self, raw, *, manual_upgrades: bool):
+    def __init__(self, raw, *, manual_upgrades: bool, storage: 'WalletStorage' = None):
         JsonDB.__init__(self, {})
         self._manual_upgrades = manual_upgrades
+        # the storage 'raw' was read from. changes are only appended to
+        # the file the db was loaded from or last fully written to
+        self._storage = storage
+        self._tx_store = None  # type: Optional[TxStore]
         self._called_after_upgrade_tasks = False
         self.upgrade_done = False
         if raw:  # loading existing db
@@ -78,8 +85,12 @@ class WalletDB(JsonDB):
 
     def load_data(self, s):
         try:
-            self.data = json.loads(s)
+            self.data, torn = parse_json_with_patches(s)
+            if torn:
+                # don't append after the remainder of the interrupted write
+                self._needs_full_write = True
         except:
+            self._needs_full_write = True
             try:
                 d = ast.literal_eval(s)
                 labels = d.get('labels', {})
@@ -179,6 +190,7 @@ class WalletDB(JsonDB):
     @profiler
     def upgrade(self):
         self.logger.info('upgrading wallet format')
+        self._needs_full_write = True
         if self._called_after_upgrade_tasks:
             # we need strict ordering between upgrade() and after_upgrade_tasks()
             raise Exception("'after_upgrade_tasks' must NOT be called before 'upgrade'")
@@ -214,6 +226,8 @@ class WalletDB(JsonDB):
         self._convert_version_39()
         self._convert_version_40()
         self._convert_version_41()
+        # statuses are computed again from the upgraded histories
+        self.data.pop('addr_status', None)
         self.put('seed_version', FINAL_SEED_VERSION)  # just to be sure
         self.upgrade_done = True
 
@@ -971,8 +985,9 @@ class WalletDB(JsonDB):
         assert isinstance(tx_hash, str)
         assert isinstance(tx, Transaction), tx
         # note that tx might be a PartialTransaction
-        # serialize and de-serialize tx now. this might e.g. convert a complete PartialTx to a Tx
-        tx = tx_from_any(str(tx))
+        # serialize and de-serialize it now. this might e.g. convert a complete PartialTx to a Tx
+        if isinstance(tx, PartialTransaction):
+            tx = tx_from_any(tx.serialize_as_bytes())
         if not tx_hash:
             raise Exception("trying to add tx to db without txid")
         if tx_hash != tx.txid():
@@ -981,12 +996,33 @@ class WalletDB(JsonDB):
         tx_we_already_have = self.transactions.get(tx_hash, None)
         if tx_we_already_have is None or isinstance(tx_we_already_have, PartialTransaction):
             self.transactions[tx_hash] = tx
+            self.tx_types[tx_hash] = self._get_dip2_tx_type(tx)
 
     @modifier
     def remove_transaction(self, tx_hash: str) -> Optional[Transaction]:
         assert isinstance(tx_hash, str)
+        self.tx_types.pop(tx_hash, None)
         return self.transactions.pop(tx_hash, None)
 
+    @staticmethod
+    def _get_dip2_tx_type(tx: Transaction) -> int:
+        if isinstance(tx, PartialTransaction):
+            return tx.tx_type
+        # read from the header, without deserializing the tx
+        return tx_header_to_tx_type(bfh(tx.serialize()[:8]))
+
+    @locked
+    def get_tx_type(self, tx_hash: str) -> int:
+        """Returns the DIP2 type of a tx of the wallet, 0 if we don't have it."""
+        tx_type = self.tx_types.get(tx_hash)
+        if tx_type is None:
+            # txs added by older versions
+            tx = self.transactions.get(tx_hash)
+            if tx is None:
+                return 0
+            tx_type = self.tx_types[tx_hash] = self._get_dip2_tx_type(tx)
+        return tx_type
+
     @locked
     def get_transaction(self, tx_hash: Optional[str]) -> Optional[Transaction]:
         if tx_hash is None:
@@ -1023,12 +1059,19 @@ class WalletDB(JsonDB):
             return []
 
     @modifier
-    def set_addr_history(self, addr: str, hist) -> None:
+    def set_addr_history(self, addr: str, hist, *, status: Optional[str] = None) -> None:
+        """'status' is the status of hist, if the caller already has it."""
         assert isinstance(addr, str)
         if self.get_address_index(addr, ps_ks=True):
             self.ps_ks_hist[addr] = hist
         else:
             self.history[addr] = hist
+        if status is None:
+            status = history_status(hist)
+        if status is None:
+            self.addr_status.pop(addr, None)
+        else:
+            self.addr_status[addr] = status
 
     @modifier
     def remove_addr_history(self, addr: str) -> None:
@@ -1037,6 +1080,12 @@ class WalletDB(JsonDB):
             self.ps_ks_hist.pop(addr, None)
         else:
             self.history.pop(addr, None)
+        self.addr_status.pop(addr, None)
+
+    @locked
+    def get_addr_status(self, addr: str) -> Optional[str]:
+        """Returns the electrum status of the history of addr."""
+        return self.addr_status.get(addr)
 
     @locked
     def get_protx_mns(self):
@@ -1134,11 +1183,11 @@ class WalletDB(JsonDB):
 
     @modifier
     def add_ps_collateral(self, outpoint, ps_collateral):
-        self.ps_collaterals[outpoint] = ps_collateral
+        self._set_ps_item(self.ps_collaterals, outpoint, ps_collateral, unspent=True)
 
     @modifier
     def pop_ps_collateral(self, outpoint):
-        return self.ps_collaterals.pop(outpoint, None)
+        return self._pop_ps_item(self.ps_collaterals, outpoint, unspent=True)
 
     @locked
     def get_ps_collateral(self, outpoint=None):
@@ -1179,10 +1228,15 @@ class WalletDB(JsonDB):
         if addr in self.ps_reserved:
             raise WalletFileException(f'Address {addr} already in ps_reserved')
         self.ps_reserved[addr] = data
+        self._index_ps_reserved(addr, data)
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _pop_ps_reserved(self, addr):
-        return self.ps_reserved.pop(addr, None)
+        if addr not in self.ps_reserved:
+            return None
+        data = self.ps_reserved.pop(addr)
+        self._index_ps_reserved(addr, data, remove=True)
+        return data
 
     @locked
     def get_ps_reserved(self, addr=None):
@@ -1194,29 +1248,36 @@ class WalletDB(JsonDB):
     @locked
     def select_ps_reserved(self, for_change=False, data=None):
         imp_addrs = getattr(self, 'imported_addresses', None)
-        imp_addrs = list(imp_addrs.keys()) if imp_addrs else []
-        if for_change:
-            w_addrs = imp_addrs if imp_addrs else self.change_addresses
-            sub_addrs = w_addrs + self.ps_ks_change_addrs
-        else:
-            w_addrs = imp_addrs if imp_addrs else self.receiving_addresses
-            sub_addrs = w_addrs + self.ps_ks_receiving_addrs
         res = []
-        for addr, addr_data in self.ps_reserved.items():
-            if addr not in sub_addrs:
-                continue
-            if addr_data != data:
-                continue
-            res.append(addr)
+        for addr in self._ps_reserved_by_data.get(data, ()):
+            if imp_addrs:
+                if addr in imp_addrs:
+                    res.append(addr)
+                    continue
+            else:
+                addr_index = self._addr_to_addr_index.get(addr)
+                if addr_index and bool(addr_index[0]) == for_change:
+                    res.append(addr)
+                    continue
+            addr_index = self._ps_ks_addr_to_addr_index.get(addr)
+            if addr_index and bool(addr_index[0]) == for_change:
+                res.append(addr)
         return res
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _add_ps_denom(self, outpoint, denom):
+        old_denom = self.ps_denoms.get(outpoint)
+        if old_denom is not None:
+            self._index_ps_denom(outpoint, old_denom, remove=True)
         self.ps_denoms[outpoint] = denom
+        self._index_ps_denom(outpoint, denom)
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _pop_ps_denom(self, outpoint):
-        return self.ps_denoms.pop(outpoint, None)
+        denom = self.ps_denoms.pop(outpoint, None)
+        if denom is not None:
+            self._index_ps_denom(outpoint, denom, remove=True)
+        return denom
 
     @locked
     def get_ps_denom(self, outpoint):
@@ -1230,8 +1291,15 @@ class WalletDB(JsonDB):
             min_rounds = 0
         if max_rounds is None:
             max_rounds = 1e9
-        return {k: v for k, v in self.ps_denoms.items()
-                if max_rounds >= v[2] >= min_rounds}
+        return {k: self.ps_denoms[k]
+                for rounds, outpoints in self._ps_denoms_by_rounds.items()
+                if max_rounds >= rounds >= min_rounds
+                for k in outpoints}
+
+    @locked
+    def get_ps_denoms_count_by_value(self):
+        return {val: len(outpoints)
+                for val, outpoints in self._ps_denoms_by_value.items()}
 
     @modifier  # do not use directly, use PSManager method of the same name
     def _add_ps_spending_denom(self, outpoint, uuid):
@@ -1251,11 +1319,11 @@ class WalletDB(JsonDB):
 
     @modifier
     def add_ps_spent_denom(self, outpoint, spent):
-        self.ps_spent_denoms[outpoint] = spent
+        self._set_ps_item(self.ps_spent_denoms, outpoint, spent)
 
     @modifier
     def pop_ps_spent_denom(self, outpoint):
-        return self.ps_spent_denoms.pop(outpoint, None)
+        return self._pop_ps_item(self.ps_spent_denoms, outpoint)
 
     @locked
     def get_ps_spent_denom(self, outpoint):
@@ -1267,11 +1335,11 @@ class WalletDB(JsonDB):
 
     @modifier
     def add_ps_other(self, outpoint, unknown):
-        self.ps_others[outpoint] = unknown
+        self._set_ps_item(self.ps_others, outpoint, unknown, unspent=True)
 
     @modifier
     def pop_ps_other(self, outpoint):
-        return self.ps_others.pop(outpoint, None)
+        return self._pop_ps_item(self.ps_others, outpoint, unspent=True)
 
     @locked
     def get_ps_other(self, outpoint):
@@ -1283,11 +1351,11 @@ class WalletDB(JsonDB):
 
     @modifier
     def add_ps_spent_other(self, outpoint, spent):
-        self.ps_spent_others[outpoint] = spent
+        self._set_ps_item(self.ps_spent_others, outpoint, spent)
 
     @modifier
     def pop_ps_spent_other(self, outpoint):
-        return self.ps_spent_others.pop(outpoint, None)
+        return self._pop_ps_item(self.ps_spent_others, outpoint)
 
     @locked
     def get_ps_spent_other(self, outpoint):
@@ -1299,11 +1367,11 @@ class WalletDB(JsonDB):
 
     @modifier
     def add_ps_spent_collateral(self, outpoint, spent_collateral):
-        self.ps_spent_collaterals[outpoint] = spent_collateral
+        self._set_ps_item(self.ps_spent_collaterals, outpoint, spent_collateral)
 
     @modifier
     def pop_ps_spent_collateral(self, outpoint):
-        return self.ps_spent_collaterals.pop(outpoint, None)
+        return self._pop_ps_item(self.ps_spent_collaterals, outpoint)
 
     @locked
     def get_ps_spent_collateral(self, outpoint):
@@ -1342,51 +1410,16 @@ class WalletDB(JsonDB):
         Limited by min_rounds (<0 for ps[_spent]_collaterals, ps_spent_denoms,
         ps_reserved, 0 for created denominations, 1 for 1 mix, and so forth).
         '''
-        ps_addr_list = []
-        denoms = self.get_ps_denoms(min_rounds=min_rounds).values()
-        if denoms:
-            ps_addr_list.extend(map(lambda x: x[0], denoms))
-
         if min_rounds is not None and min_rounds >= 0:
-            return set(ps_addr_list)
-
-        spent_denoms = self.get_ps_spent_denoms().values()
-        if spent_denoms:
-            ps_addr_list.extend(map(lambda x: x[0], spent_denoms))
-
-        collaterals = self.get_ps_collaterals().values()
-        if collaterals:
-            ps_addr_list.extend(map(lambda x: x[0], collaterals))
-
-        spent_collaterals = self.get_ps_spent_collaterals().values()
-        if spent_collaterals:
-            ps_addr_list.extend(map(lambda x: x[0], spent_collaterals))
-
-        others = self.get_ps_others().values()
-        if others:
-            ps_addr_list.extend(map(lambda x: x[0], others))
-
-        spent_others = self.get_ps_spent_others().values()
-        if spent_others:
-            ps_addr_list.extend(map(lambda x: x[0], spent_others))
-
-        ps_addr_list.extend(self.ps_reserved.keys())
-        return set(ps_addr_list)
+            return {self.ps_denoms[k][0]
+                    for rounds, outpoints in self._ps_denoms_by_rounds.items()
+                    if rounds >= min_rounds
+                    for k in outpoints}
+        return set(self._ps_addrs)
 
     @locked
     def get_unspent_ps_addresses(self):
-        ps_addr_list = []
-        collaterals = self.get_ps_collaterals().values()
-        if collaterals:
-            ps_addr_list.extend(map(lambda x: x[0], collaterals))
-        denoms = self.get_ps_denoms().values()
-        if denoms:
-            ps_addr_list.extend(map(lambda x: x[0], denoms))
-        others = self.get_ps_others().values()
-        if others:
-            ps_addr_list.extend(map(lambda x: x[0], others))
-        ps_addr_list.extend(self.ps_reserved.keys())
-        return set(ps_addr_list)
+        return set(self._ps_unspent_addrs)
 
     @locked
     def list_verified_tx(self) -> Sequence[str]:
@@ -1613,9 +1646,16 @@ class WalletDB(JsonDB):
         self.txi = self.get_dict('txi')                          # type: Dict[str, Dict[str, Dict[str, int]]]
         # txid -> address -> output_index -> (value, is_coinbase)
         self.txo = self.get_dict('txo')                          # type: Dict[str, Dict[str, Dict[str, Tuple[int, bool]]]]
-        self.transactions = self.get_dict('transactions')        # type: Dict[str, Transaction]
+        # txid -> Transaction, kept in a separate file if possible, see tx_store.py
+        tx_store_path, tx_store_key = (self._storage.get_tx_store_path_and_key()
+                                       if self._storage else (None, None))
+        if tx_store_path:
+            self._use_tx_store(tx_store_path, tx_store_key)
+        else:
+            self.transactions = self.get_dict('transactions')    # type: Dict[str, Transaction]
         self.spent_outpoints = self.get_dict('spent_outpoints')  # txid -> output_index -> next_txid
         self.history = self.get_dict('addr_history')             # address -> list of (txid, height)
+        self.addr_status = self.get_dict('addr_status')          # address -> status of addr_history/ps_ks_addr_hist
         self.ps_ks_hist = self.get_dict('ps_ks_addr_hist')  # address -> list of (txid, height)
         self.verified_tx = self.get_dict('verified_tx3')         # txid -> (height, timestamp, txpos, header_hash)
         self.islocks = self.get_dict('islocks')  # txid -> (height, timestamp)
@@ -1633,13 +1673,155 @@ class WalletDB(JsonDB):
         self.ps_spent_collaterals = self.get_dict('ps_spent_collaterals')  # outpoint -> (addr, val)
         self.ps_origin_addrs = self.get_dict('ps_origin_addrs')  # txid -> [addr, ...] new denoms/new collateral inputs
         self.tx_fees = self.get_dict('tx_fees')                  # type: Dict[str, TxFeesValue]
+        self.tx_types = self.get_dict('tx_types')                # txid -> DIP2 tx type
         # scripthash -> set of (outpoint, value)
         self._prevouts_by_scripthash = self.get_dict('prevouts_by_scripthash')  # type: Dict[str, Set[Tuple[str, int]]]
+        self._load_addr_status()
+        self._load_ps_indexes()
+
+    def _load_addr_status(self):
+        # the statuses are not stored by older versions
+        for hist in (self.history, self.ps_ks_hist):
+            for addr in hist:
+                if addr not in self.addr_status:
+                    status = history_status(hist[addr])
+                    if status is not None:
+                        self.addr_status[addr] = status
+
+    def _load_ps_indexes(self):
+        # indexes of the PS data, kept up to date by the _add/_pop modifiers
+        self._ps_denoms_by_rounds = defaultdict(dict)  # type: Dict[int, Dict[str, None]]  # round_n -> outpoints
+        self._ps_denoms_by_value = defaultdict(dict)  # type: Dict[int, Dict[str, None]]  # val -> outpoints
+        self._ps_reserved_by_data = defaultdict(dict)  # type: Dict[str, Dict[str, None]]  # data -> addrs
+        self._ps_addrs = Counter()  # addr -> count of references in the PS maps
+        self._ps_unspent_addrs = Counter()  # same, without the ps_spent_* maps
+        for outpoint, denom in self.ps_denoms.items():
+            self._index_ps_denom(outpoint, denom)
+        for addr, data in self.ps_reserved.items():
+            self._index_ps_reserved(addr, data)
+        for d in (self.ps_collaterals, self.ps_others):
+            for v in d.values():
+                self._ref_ps_addr(v[0], 1, unspent=True)
+        for d in (self.ps_spent_denoms, self.ps_spent_collaterals, self.ps_spent_others):
+            for v in d.values():
+                self._ref_ps_addr(v[0], 1)
+
+    def _ref_ps_addr(self, addr, n, *, unspent=False):
+        counters = (self._ps_addrs, self._ps_unspent_addrs) if unspent else (self._ps_addrs,)
+        for counter in counters:
+            counter[addr] += n
+            if counter[addr] <= 0:
+                del counter[addr]
+
+    def _index_ps_denom(self, outpoint, denom, *, remove=False):
+        addr, val, rounds = denom[0], denom[1], denom[2]
+        for index, key in ((self._ps_denoms_by_rounds, rounds),
+                           (self._ps_denoms_by_value, val)):
+            if remove:
+                index[key].pop(outpoint, None)
+                if not index[key]:
+                    del index[key]
+            else:
+                index[key][outpoint] = None
+        self._ref_ps_addr(addr, -1 if remove else 1, unspent=True)
+
+    def _index_ps_reserved(self, addr, data, *, remove=False):
+        if remove:
+            self._ps_reserved_by_data[data].pop(addr, None)
+            if not self._ps_reserved_by_data[data]:
+                del self._ps_reserved_by_data[data]
+        else:
+            self._ps_reserved_by_data[data][addr] = None
+        self._ref_ps_addr(addr, -1 if remove else 1, unspent=True)
+
+    def _set_ps_item(self, d, outpoint, value, *, unspent=False):
+        # for the maps of outpoint -> (addr, val, ...) other than ps_denoms
+        old_value = d.get(outpoint)
+        if old_value is not None:
+            self._ref_ps_addr(old_value[0], -1, unspent=unspent)
+        d[outpoint] = value
+        self._ref_ps_addr(value[0], 1, unspent=unspent)
+
+    def _pop_ps_item(self, d, outpoint, *, unspent=False):
+        value = d.pop(outpoint, None)
+        if value is not None:
+            self._ref_ps_addr(value[0], -1, unspent=unspent)
+        return value
+
+    def _use_tx_store(self, path: str, key: Optional[bytes]) -> None:
+        """Moves the transactions kept in the db to the tx store at path."""
+        assert self._tx_store is None
+        self._tx_store = TxStore(path, key=key)
+        transactions = self.data.get('transactions')
+        self.transactions = StoredTransactions(self._tx_store)
+        if transactions is not None:
+            for tx_hash, tx in transactions.items():
+                self.transactions[tx_hash] = tx
+            # written after the tx store, see write()
+            self.data.pop('transactions')
+
+    def _move_transactions_to_db(self) -> None:
+        """Moves the transactions back into the db, e.g. to write it to
+        a storage we can not keep a tx store for.
+        """
+        if self._tx_store is None:
+            return
+        transactions = dict(self.transactions)
+        self._tx_store.close()
+        self._tx_store = None
+        self.transactions = self.get_dict('transactions')
+        self.transactions.update(transactions)
+
+    def _update_tx_store(self, storage: 'WalletStorage') -> None:
+        """Writes the pending changes of the tx store before the db is
+        fully written to storage, to the tx store that goes with it.
+        A rewritten tx store is only used once the db is written,
+        see _write.
+        """
+        path, key = storage.get_tx_store_path_and_key()
+        if path is None:
+            self._move_transactions_to_db()
+        elif self._tx_store is None:
+            self._use_tx_store(path, key)
+            self._tx_store.flush()
+        elif self._tx_store.needs_rewrite(path, key):
+            self._tx_store.prepare_rewrite(path, key)
+        else:
+            self._tx_store.flush()
+
+    def close(self) -> None:
+        """Releases the files kept open, they are opened again if needed."""
+        with self.lock:
+            if self._tx_store is not None:
+                self._tx_store.close()
+
+    @locked
+    def dump(self, *, human_readable: bool = True, with_transactions: bool = True) -> str:
+        """Serializes the DB as a string. Unless 'with_transactions' is False,
+        the transactions kept in the tx store are included.
+        """
+        if not with_transactions or self._tx_store is None:
+            return JsonDB.dump(self, human_readable=human_readable)
+        data = dict(self.data)
+        data['transactions'] = dict(self.transactions)
+        return json.dumps(
+            data,
+            indent=4 if human_readable else None,
+            sort_keys=bool(human_readable),
+            cls=JsonDBJsonEncoder,
+        )
+
+    @locked
+    def remove_unreferenced_txs(self):
+        """Removes transactions and spent outpoints no longer referenced
+        from txi/txo. Not needed to use the db, see Abstract_Wallet.start_network.
+        """
         # remove unreferenced tx
         for tx_hash in list(self.transactions.keys()):
             if not self.get_txi_addresses(tx_hash) and not self.get_txo_addresses(tx_hash):
                 self.logger.info(f"removing unreferenced tx: {tx_hash}")
                 self.transactions.pop(tx_hash)
+                self.tx_types.pop(tx_hash, None)
         # remove unreferenced outpoints
         for prevout_hash in self.spent_outpoints.keys():
             d = self.spent_outpoints[prevout_hash]
@@ -1652,8 +1834,10 @@ class WalletDB(JsonDB):
     def clear_history(self):
         self.txi.clear()
         self.txo.clear()
+        self.addr_status.clear()
         self.spent_outpoints.clear()
         self.transactions.clear()
+        self.tx_types.clear()
         self.history.clear()
         self.ps_ks_hist.clear()
         self.verified_tx.clear()
@@ -1679,6 +1863,7 @@ class WalletDB(JsonDB):
         self.ps_spent_denoms.clear()
         self.ps_others.clear()
         self.ps_spent_others.clear()
+        self._load_ps_indexes()
 
     def _convert_dict(self, path, key, v):
         if key == 'transactions':
@@ -1709,7 +1894,13 @@ class WalletDB(JsonDB):
 
     def write(self, storage: 'WalletStorage'):
         with self.lock:
-            self._write(storage)
+            if (self.needs_full_write()
+                    or storage is not self._storage
+                    or not storage.file_exists()
+                    or storage.needs_consolidation()):
+                self._write(storage)
+            else:
+                self._append_pending_changes(storage)
 
     @profiler
     def _write(self, storage: 'WalletStorage'):
@@ -1718,8 +1909,25 @@ class WalletDB(JsonDB):
             return
         if not self.modified():
             return
-        json_str = self.dump(human_readable=not storage.is_encrypted())
+        # the tx store is written first, the db refers to its transactions
+        self._update_tx_store(storage)
+        json_str = self.dump(human_readable=not storage.is_encrypted(), with_transactions=False)
         storage.write(json_str)
+        if self._tx_store is not None:
+            self._tx_store.commit_rewrite()
+        self._storage = storage
+        self.set_modified(False)
+
+    def _append_pending_changes(self, storage: 'WalletStorage'):
+        if threading.currentThread().isDaemon():
+            self.logger.warning('daemon thread cannot write db')
+            return
+        if not self.modified():
+            return
+        if self._tx_store is not None:
+            self._tx_store.flush()
+        if self.pending_changes:
+            storage.append(''.join(',\n' + x for x in self.pending_changes))
         self.set_modified(False)
 
     def is_ready_to_be_used_by_wallet(self):
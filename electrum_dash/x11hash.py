@@ -30,9 +30,10 @@ if load_libx11hash:
 
 
 if load_libx11hash:
-    hash_out = create_string_buffer(32)
-
     def getPoWHash(header):
+        # output buffer is allocated per call, so this can be used
+        # from several threads (ctypes releases the GIL during the call)
+        hash_out = create_string_buffer(32)
         x11_hash(header, byref(hash_out))
         return hash_out.raw
 